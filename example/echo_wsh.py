@@ -51,4 +51,15 @@ def web_socket_transfer_data(request):
             request.ws_stream.send_message(line, binary=True)
 
 
+def web_socket_on_message(request, message):
+    # Called instead of web_socket_transfer_data in the event loop server
+    # mode.
+    if isinstance(message, unicode):
+        request.ws_stream.send_message(message, binary=False)
+        if message == _GOODBYE_MESSAGE:
+            request.ws_stream.close_connection()
+    else:
+        request.ws_stream.send_message(message, binary=True)
+
+
 # vi:sts=4 sw=4 et
@@ -67,6 +67,14 @@ Installation
 
        PythonOption mod_pywebsocket.allow_handlers_outside_root_dir On
 
+   To limit the size of incoming frames, messages and decompressed messages
+   in bytes, configure as follows. Connections exceeding them are closed
+   with status code 1009.
+
+       PythonOption mod_pywebsocket.max_frame_size <bytes>
+       PythonOption mod_pywebsocket.max_message_size <bytes>
+       PythonOption mod_pywebsocket.max_decompressed_size <bytes>
+
    Example snippet of httpd.conf:
    (mod_pywebsocket is in /websock_lib, WebSocket handlers are in
    /websock_handlers, port is 80 for ws, 443 for wss.)
@@ -164,6 +172,20 @@ You can send a message by the following statement.
 
     request.ws_stream.send_message(message)
 
+To send many small messages, the following statement writes frames for all
+of them to the connection at once.
+
+    request.ws_stream.send_messages(messages)
+
+When cork mode is enabled (e.g. by the --cork-flush-delay-ms option of
+standalone.py), frames are buffered for a short time and written together.
+web_socket_do_extra_handshake can enable it for its resource by setting
+request.ws_cork_flush_delay to the delay in seconds. Call
+
+    request.ws_stream.flush()
+
+to write buffered frames immediately.
+
 
 Closing Connection
 ------------------
@@ -186,6 +208,67 @@ use in web_socket_passive_closing_handshake.
 - ws_close_reason
 
 
+Limiting Incoming Data
+----------------------
+
+web_socket_do_extra_handshake can change the limits on the size of incoming
+data for its resource by setting the following properties of the request.
+Their initial values come from the server configuration. None means no
+limit.
+- ws_incoming_max_frame_payload_size
+- ws_incoming_max_message_size
+- ws_incoming_max_decompressed_size
+
+
+Keepalive
+---------
+
+When keepalive is enabled (e.g. by the --keepalive-interval option of
+standalone.py, or by setting request.ws_keepalive_interval in
+web_socket_do_extra_handshake), a ping is sent on connections on which
+nothing has been received for the interval, and connections which don't
+answer it in request.ws_keepalive_timeout seconds are failed. One thread
+runs the timers of all connections. Pongs are read by the handler thread,
+so both the interval and the timeout count only the time the handler spends
+waiting for frames in receive_message (or receive_message_stream and
+close_connection). Connections of handlers which only send, or which are
+busy with other work, are never pinged nor failed.
+
+The thread running the timers writes pings to connections while their
+handler threads may be reading from them. Writes of the two threads are
+serialized. TLS connections of the ssl module allow this, but those of
+pyOpenSSL don't, so standalone.py refuses to enable keepalive with pyOpenSSL.
+
+request.ws_rtt holds the round-trip time in seconds, smoothed over the
+pongs received for the pings sent by keepalive and send_ping, or None until
+the first pong arrives.
+
+
+Event Handlers
+--------------
+
+Instead of web_socket_transfer_data, a handler may define the following
+functions, which are called for each event on the connection:
+
+    web_socket_on_open(request)
+    web_socket_on_message(request, message)
+    web_socket_on_close(request)
+
+web_socket_on_open is called when the handshake has completed,
+web_socket_on_message for each received message (unicode for text, str for
+binary), and web_socket_on_close when the connection has been closed, with
+ws_close_code and ws_close_reason of request set if a close frame was
+received. Only web_socket_on_message is required. Messages are sent by
+request.ws_stream.send_message, and request.ws_stream.close_connection
+starts the closing handshake without waiting for its acknowledgement.
+
+The event loop mode of standalone.py (--server-mode=eventloop) serves many
+connections on one thread by calling these functions, so they must not
+block. It serves only handlers defining web_socket_on_message. In the other
+servers, a handler defining them but not web_socket_transfer_data runs on a
+thread that receives messages and calls them.
+
+
 Threading
 ---------
 
@@ -39,11 +39,27 @@
 # writing/reading.
 
 
+import heapq
+import itertools
 import socket
+import threading
+import time
 
 from mod_pywebsocket import util
 
 
+# Bounds of the size of chunks read ahead from connections which support
+# read_available. The actual size adapts between them depending on how much
+# data each read returns.
+_MIN_READ_AHEAD_SIZE = 4 * 1024
+_MAX_READ_AHEAD_SIZE = 256 * 1024
+
+# Buffers passed to _write_buffers are concatenated before being written when
+# their total size is smaller than this, since a copy of a small frame is
+# cheaper than an extra write call.
+_MIN_SCATTER_WRITE_SIZE = 16 * 1024
+
+
 # Exceptions
 
 
@@ -89,6 +105,88 @@ class InvalidUTF8Exception(Exception):
     pass
 
 
+class MessageTooBigException(Exception):
+    """This exception will be raised when we receive a frame or a message
+    larger than the configured limit. The rest of the frame is not read, so
+    the connection cannot be used for receiving any more.
+    """
+
+    pass
+
+
+class _CorkFlusher(threading.Thread):
+    """A thread which flushes the output buffer of streams in cork mode when
+    their flush deadline passes. One instance is shared by all streams.
+    """
+
+    daemon = True
+
+    def __init__(self):
+        threading.Thread.__init__(self, name='CorkFlusher')
+
+        self._logger = util.get_class_logger(self)
+
+        # Heap of (deadline, sequence number, stream). The sequence number
+        # keeps streams with the same deadline from being compared.
+        self._schedule = []
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+
+    def schedule(self, deadline, stream):
+        """Makes stream flushed at deadline (in time.time() seconds)."""
+
+        self._condition.acquire()
+        try:
+            heapq.heappush(
+                self._schedule, (deadline, self._sequence.next(), stream))
+            if self._schedule[0][2] is stream:
+                self._condition.notify()
+        finally:
+            self._condition.release()
+
+    def run(self):
+        while True:
+            self._condition.acquire()
+            try:
+                while True:
+                    if not self._schedule:
+                        self._condition.wait()
+                        continue
+                    timeout = self._schedule[0][0] - time.time()
+                    if timeout <= 0:
+                        break
+                    self._condition.wait(timeout)
+                stream = heapq.heappop(self._schedule)[2]
+            finally:
+                self._condition.release()
+
+            try:
+                stream._flush_on_deadline()
+            except Exception, e:
+                # The handler thread will notice the broken connection on
+                # its next read or write.
+                self._logger.debug('Failed to flush: %s', e)
+
+
+_cork_flusher = None
+_cork_flusher_lock = threading.Lock()
+
+
+def _get_cork_flusher():
+    """Returns the _CorkFlusher instance, starting it on the first call."""
+
+    global _cork_flusher
+
+    _cork_flusher_lock.acquire()
+    try:
+        if _cork_flusher is None:
+            _cork_flusher = _CorkFlusher()
+            _cork_flusher.start()
+        return _cork_flusher
+    finally:
+        _cork_flusher_lock.release()
+
+
 class StreamBase(object):
     """Base stream class."""
 
@@ -103,6 +201,28 @@ class StreamBase(object):
 
         self._request = request
 
+        # Bytes read ahead from the connection but not consumed yet. Reading
+        # ahead is done only when the connection has read_available method
+        # which returns as soon as any data is available, since
+        # connection.read may block until the specified length is filled.
+        self._read_ahead_buffer = ''
+        self._read_ahead_position = 0
+        self._read_ahead_size = _MIN_READ_AHEAD_SIZE
+
+        # Output buffer for cork mode. _cork_lock is None unless cork mode is
+        # enabled by enable_cork().
+        self._cork_lock = None
+        self._cork_buffer = []
+        self._cork_buffer_size = 0
+        self._cork_flush_threshold = 0
+        self._cork_flush_delay = 0
+        self._cork_flush_scheduled = False
+
+        # Lock serializing writes from multiple threads when cork mode is not
+        # enabled. None unless set by a subclass which writes from another
+        # thread (e.g. keepalive pings).
+        self._write_lock = None
+
     def _read(self, length):
         """Reads length bytes from connection. In case we catch any exception,
         prepends remote address to the exception message and raise again.
@@ -111,8 +231,15 @@ class StreamBase(object):
             ConnectionTerminatedException: when read returns empty string.
         """
 
+        return self._read_using(self._request.connection.read, length)
+
+    def _read_using(self, read_method, length):
+        """Reads at most length bytes using the given read method of the
+        connection. See _read for the details.
+        """
+
         try:
-            read_bytes = self._request.connection.read(length)
+            read_bytes = read_method(length)
             if not read_bytes:
                 raise ConnectionTerminatedException(
                     'Receiving %d byte failed. Peer (%r) closed connection' %
@@ -135,8 +262,22 @@ class StreamBase(object):
     def _write(self, bytes_to_write):
         """Writes given bytes to connection. In case we catch any exception,
         prepends remote address to the exception message and raise again.
+        In cork mode, the bytes may be buffered instead.
         """
 
+        if self._cork_lock is not None:
+            self._buffer_for_cork([bytes_to_write])
+            return
+        if self._write_lock is not None:
+            self._write_lock.acquire()
+            try:
+                self._write_to_connection(bytes_to_write)
+            finally:
+                self._write_lock.release()
+            return
+        self._write_to_connection(bytes_to_write)
+
+    def _write_to_connection(self, bytes_to_write):
         try:
             self._request.connection.write(bytes_to_write)
         except Exception, e:
@@ -146,6 +287,188 @@ class StreamBase(object):
                     e)
             raise
 
+    def _write_buffers(self, buffers):
+        """Writes given buffers to connection in order as one byte sequence.
+        Large buffers are written without being concatenated, using
+        connection.write_buffers if available. In case we catch any
+        exception, prepends remote address to the exception message and raise
+        again. In cork mode, the buffers may be buffered instead.
+        """
+
+        if self._cork_lock is not None:
+            self._buffer_for_cork(buffers)
+            return
+        if self._write_lock is not None:
+            self._write_lock.acquire()
+            try:
+                self._write_buffers_to_connection(buffers)
+            finally:
+                self._write_lock.release()
+            return
+        self._write_buffers_to_connection(buffers)
+
+    def _write_buffers_to_connection(self, buffers):
+        total_length = 0
+        for buffer_ in buffers:
+            total_length += len(buffer_)
+        if len(buffers) == 1 or total_length < _MIN_SCATTER_WRITE_SIZE:
+            # str() converts buffer objects (slices of a message) to str.
+            self._write_to_connection(
+                ''.join([str(buffer_) for buffer_ in buffers]))
+            return
+
+        try:
+            write_buffers = getattr(
+                self._request.connection, 'write_buffers', None)
+            if write_buffers is not None:
+                write_buffers(buffers)
+            else:
+                for buffer_ in buffers:
+                    self._request.connection.write(buffer_)
+        except Exception, e:
+            util.prepend_message_to_exception(
+                    'Failed to send message to %r: ' %
+                            (self._request.connection.remote_addr,),
+                    e)
+            raise
+
+    def enable_cork(self, flush_threshold, flush_delay):
+        """Enables cork mode. In cork mode, outgoing data is kept in a buffer
+        and written to the connection at once when the buffer reaches
+        flush_threshold bytes, when flush_delay seconds pass after data is
+        put into the empty buffer, or when flush() is called.
+        """
+
+        self._cork_flush_threshold = flush_threshold
+        self._cork_flush_delay = flush_delay
+        self._cork_lock = threading.Lock()
+
+    def flush(self):
+        """Writes data buffered in cork mode to the connection. Does nothing
+        when cork mode is not enabled.
+        """
+
+        if self._cork_lock is None:
+            return
+
+        self._cork_lock.acquire()
+        try:
+            self._flush_cork_buffer()
+        finally:
+            self._cork_lock.release()
+
+    def _buffer_for_cork(self, buffers):
+        self._cork_lock.acquire()
+        try:
+            self._cork_buffer.extend(buffers)
+            for buffer_ in buffers:
+                self._cork_buffer_size += len(buffer_)
+
+            if self._cork_buffer_size >= self._cork_flush_threshold:
+                self._flush_cork_buffer()
+            elif not self._cork_flush_scheduled:
+                # Data buffered after an explicit flush is flushed by the
+                # deadline already scheduled.
+                self._cork_flush_scheduled = True
+                _get_cork_flusher().schedule(
+                    time.time() + self._cork_flush_delay, self)
+        finally:
+            self._cork_lock.release()
+
+    def _flush_cork_buffer(self):
+        if not self._cork_buffer:
+            return
+
+        buffers = self._cork_buffer
+        self._cork_buffer = []
+        self._cork_buffer_size = 0
+        self._write_buffers_to_connection(buffers)
+
+    def _try_write_now(self, bytes_to_write):
+        """Writes given bytes to connection after the data buffered in cork
+        mode, unless another thread is writing. Used by threads which must
+        not block on a connection (e.g. the keepalive scheduler).
+
+        Returns:
+            True iff the bytes were written.
+        """
+
+        lock = self._cork_lock or self._write_lock
+        if lock is None:
+            self._write_to_connection(bytes_to_write)
+            return True
+
+        if not lock.acquire(False):
+            return False
+        try:
+            if self._cork_lock is not None:
+                self._flush_cork_buffer()
+            self._write_to_connection(bytes_to_write)
+        finally:
+            lock.release()
+        return True
+
+    def stop_keepalive(self):
+        """Stops sending keepalive pings. Called when the connection is no
+        longer used. Does nothing for streams which don't send them.
+        """
+
+        pass
+
+    def _flush_on_deadline(self):
+        """Called by _CorkFlusher when the flush deadline passes."""
+
+        self._cork_lock.acquire()
+        try:
+            self._cork_flush_scheduled = False
+            self._flush_cork_buffer()
+        finally:
+            self._cork_lock.release()
+
+    def _receive_some(self, length):
+        """Receives bytes for a parser which buffers them by itself. Returns
+        at least one byte, and may return more than length bytes when the
+        connection has read_available method.
+
+        Raises:
+            ConnectionTerminatedException: when read returns empty string.
+        """
+
+        read_bytes = self._take_read_ahead_bytes()
+        if read_bytes:
+            return read_bytes
+        return self._read_chunk(length)
+
+    def _take_read_ahead_bytes(self):
+        """Returns the unconsumed bytes in the read-ahead buffer and empties
+        it.
+        """
+
+        read_bytes = self._read_ahead_buffer[self._read_ahead_position:]
+        self._read_ahead_buffer = ''
+        self._read_ahead_position = 0
+        return read_bytes
+
+    def _read_chunk(self, length):
+        """Reads at least one byte from the connection. When the connection
+        has read_available method, reads whatever is available up to the
+        read-ahead size, which may be more than length bytes. Otherwise,
+        reads at most length bytes.
+
+        Raises:
+            ConnectionTerminatedException: when read returns empty string.
+        """
+
+        read_available = getattr(
+            self._request.connection, 'read_available', None)
+        if read_available is None:
+            return self._read(length)
+
+        read_bytes = self._read_using(
+            read_available, max(length, self._read_ahead_size))
+        self._adapt_read_ahead_size(len(read_bytes))
+        return read_bytes
+
     def receive_bytes(self, length):
         """Receives multiple bytes. Retries read when we couldn't receive the
         specified amount.
@@ -154,13 +477,44 @@ class StreamBase(object):
             ConnectionTerminatedException: when read returns empty string.
         """
 
+        # Fast path. Small frames are usually served from the read-ahead
+        # buffer without touching the connection.
+        position = self._read_ahead_position
+        end = position + length
+        if end <= len(self._read_ahead_buffer):
+            self._read_ahead_position = end
+            return self._read_ahead_buffer[position:end]
+
         read_bytes = []
+        buffered_bytes = self._take_read_ahead_bytes()
+        if buffered_bytes:
+            read_bytes.append(buffered_bytes)
+            length -= len(buffered_bytes)
+
         while length > 0:
-            new_read_bytes = self._read(length)
+            new_read_bytes = self._read_chunk(length)
+            if len(new_read_bytes) > length:
+                # Keep the surplus for the following calls.
+                read_bytes.append(new_read_bytes[:length])
+                self._read_ahead_buffer = new_read_bytes
+                self._read_ahead_position = length
+                break
             read_bytes.append(new_read_bytes)
             length -= len(new_read_bytes)
         return ''.join(read_bytes)
 
+    def _adapt_read_ahead_size(self, read_size):
+        """Grows the read-ahead chunk size when reads fill the whole chunk,
+        and shrinks it when reads return much less than the chunk.
+        """
+
+        if read_size >= self._read_ahead_size:
+            self._read_ahead_size = min(
+                self._read_ahead_size * 2, _MAX_READ_AHEAD_SIZE)
+        elif read_size < self._read_ahead_size / 4:
+            self._read_ahead_size = max(
+                self._read_ahead_size / 2, _MIN_READ_AHEAD_SIZE)
+
     def _read_until(self, delim_char):
         """Reads bytes until we encounter delim_char. The result will not
         contain delim_char.
@@ -171,7 +525,7 @@ class StreamBase(object):
 
         read_bytes = []
         while True:
-            ch = self._read(1)
+            ch = self.receive_bytes(1)
             if ch == delim_char:
                 break
             read_bytes.append(ch)
@@ -96,6 +96,42 @@ class StreamHixie75(StreamBase):
 
         self._write(''.join(['\x00', message.encode('utf-8'), '\xff']))
 
+    def send_messages(self, messages, binary=False):
+        """Send messages at once by one write call.
+
+        Args:
+            messages: an iterable of unicode strings to send.
+            binary: not used in hixie75.
+
+        Raises:
+            BadOperationException: when called on a server-terminated
+                connection.
+        """
+
+        if binary:
+            raise BadOperationException(
+                'StreamHixie75 doesn\'t support send_messages with '
+                'binary=True')
+
+        if self._request.server_terminated:
+            raise BadOperationException(
+                'Requested send_messages after sending out a closing '
+                'handshake')
+
+        frames = []
+        for message in messages:
+            frames.extend(['\x00', message.encode('utf-8'), '\xff'])
+        if frames:
+            self._write(''.join(frames))
+
+    def send_prepared(self, prepared_message):
+        """Send a PreparedMessage. Hixie 75 frames are cheap to build, so
+        this just calls send_message.
+        """
+
+        self.send_message(
+            prepared_message.message, binary=prepared_message.binary)
+
     def _read_payload_length_hixie75(self):
         """Reads a length header in a Hixie75 version frame with length.
 
@@ -105,7 +141,7 @@ class StreamHixie75(StreamBase):
 
         length = 0
         while True:
-            b_str = self._read(1)
+            b_str = self.receive_bytes(1)
             b = ord(b_str)
             length = length * 128 + (b & 0x7f)
             if (b & 0x80) == 0:
@@ -174,6 +210,22 @@ class StreamHixie75(StreamBase):
                     return message
                 # Discard data of other types.
 
+    def receive_message_stream(self):
+        """Receive a WebSocket frame and return an iterator over its payload.
+
+        Hixie 75 frames are not fragmented, so the iterator yields the whole
+        payload at once.
+
+        Returns:
+            an iterator yielding a unicode string, or None iff received
+            closing handshake.
+        """
+
+        message = self.receive_message()
+        if message is None:
+            return None
+        return iter([message])
+
     def _send_closing_handshake(self):
         if not self._enable_closing_handshake:
             raise BadOperationException(
@@ -36,10 +36,12 @@ http://tools.ietf.org/html/rfc6455
 """
 
 
+import codecs
 from collections import deque
 import logging
 import os
 import struct
+import threading
 import time
 
 from mod_pywebsocket import common
@@ -48,15 +50,27 @@ from mod_pywebsocket._stream_base import BadOperationException
 from mod_pywebsocket._stream_base import ConnectionTerminatedException
 from mod_pywebsocket._stream_base import InvalidFrameException
 from mod_pywebsocket._stream_base import InvalidUTF8Exception
+from mod_pywebsocket._stream_base import MessageTooBigException
 from mod_pywebsocket._stream_base import StreamBase
 from mod_pywebsocket._stream_base import UnsupportedFrameException
 
 
 _NOOP_MASKER = util.NoopMasker()
 
+# Resolution and number of slots of the timer wheel of _KeepaliveScheduler.
+# Timers farther than one revolution (64 seconds) stay in their slot for
+# several revolutions.
+_KEEPALIVE_TICK = 0.5
+_KEEPALIVE_WHEEL_SIZE = 128
+
+# Weight of a new sample in the smoothed round-trip time (RFC 6298).
+_RTT_ALPHA = 0.125
+
 
 class Frame(object):
 
+    __slots__ = ('fin', 'rsv1', 'rsv2', 'rsv3', 'opcode', 'payload')
+
     def __init__(self, fin=1, rsv1=0, rsv2=0, rsv3=0,
                  opcode=None, payload=''):
         self.fin = fin
@@ -71,6 +85,50 @@ class Frame(object):
 # clients.
 
 
+# Precompiled encoders of frame headers. The first byte holds FIN, RSV1-3 and
+# the opcode, and the second byte holds the mask bit and the payload length
+# or 126/127 indicating that a 16/64-bit extended payload length follows.
+_HEADER_STRUCT = struct.Struct('!BB')
+_HEADER_WITH_16BIT_LENGTH_STRUCT = struct.Struct('!BBH')
+_HEADER_WITH_64BIT_LENGTH_STRUCT = struct.Struct('!BBQ')
+_LENGTH_HEADER_WITH_16BIT_LENGTH_STRUCT = struct.Struct('!BH')
+_LENGTH_HEADER_WITH_64BIT_LENGTH_STRUCT = struct.Struct('!BQ')
+
+# Ready-made length headers for payloads of 125 bytes or less, indexed by
+# the mask bit and the payload length.
+_SMALL_LENGTH_HEADERS = [
+    [chr(length) for length in xrange(126)],
+    [chr((1 << 7) | length) for length in xrange(126)],
+]
+
+
+def _build_small_header_table():
+    """Builds a table of ready-made headers for payloads of 125 bytes or less.
+    The keys are (opcode, fin, rsv1, rsv2, rsv3, mask) for the opcodes
+    defined by RFC 6455 with RSV2 and RSV3 unset, and the values are lists of
+    headers indexed by the payload length.
+    """
+
+    table = {}
+    for opcode in (common.OPCODE_CONTINUATION,
+                   common.OPCODE_TEXT,
+                   common.OPCODE_BINARY,
+                   common.OPCODE_CLOSE,
+                   common.OPCODE_PING,
+                   common.OPCODE_PONG):
+        for fin in (0, 1):
+            for rsv1 in (0, 1):
+                for mask in (0, 1):
+                    first_byte = chr((fin << 7) | (rsv1 << 6) | opcode)
+                    table[(opcode, fin, rsv1, 0, 0, mask)] = [
+                        first_byte + length_header
+                        for length_header in _SMALL_LENGTH_HEADERS[mask]]
+    return table
+
+
+_SMALL_HEADERS = _build_small_header_table()
+
+
 def create_length_header(length, mask):
     """Creates a length header.
 
@@ -90,11 +148,13 @@ def create_length_header(length, mask):
     if length < 0:
         raise ValueError('length must be non negative integer')
     elif length <= 125:
-        return chr(mask_bit | length)
+        return _SMALL_LENGTH_HEADERS[mask_bit >> 7][length]
     elif length < (1 << 16):
-        return chr(mask_bit | 126) + struct.pack('!H', length)
+        return _LENGTH_HEADER_WITH_16BIT_LENGTH_STRUCT.pack(
+            mask_bit | 126, length)
     elif length < (1 << 63):
-        return chr(mask_bit | 127) + struct.pack('!Q', length)
+        return _LENGTH_HEADER_WITH_64BIT_LENGTH_STRUCT.pack(
+            mask_bit | 127, length)
     else:
         raise ValueError('Payload is too big for one frame')
 
@@ -106,6 +166,13 @@ def create_header(opcode, payload_length, fin, rsv1, rsv2, rsv3, mask):
         Exception: when bad data is given.
     """
 
+    # Fast path. Headers of most frames are in the table. Only valid
+    # parameters are in its keys.
+    if 0 <= payload_length <= 125:
+        headers = _SMALL_HEADERS.get((opcode, fin, rsv1, rsv2, rsv3, mask))
+        if headers is not None:
+            return headers[payload_length]
+
     if opcode < 0 or 0xf < opcode:
         raise ValueError('Opcode out of range')
 
@@ -115,35 +182,123 @@ def create_header(opcode, payload_length, fin, rsv1, rsv2, rsv3, mask):
     if (fin | rsv1 | rsv2 | rsv3) & ~1:
         raise ValueError('FIN bit and Reserved bit parameter must be 0 or 1')
 
-    header = ''
-
     first_byte = ((fin << 7)
                   | (rsv1 << 6) | (rsv2 << 5) | (rsv3 << 4)
                   | opcode)
-    header += chr(first_byte)
-    header += create_length_header(payload_length, mask)
 
-    return header
+    if mask:
+        mask_bit = 1 << 7
+    else:
+        mask_bit = 0
+
+    if payload_length <= 125:
+        return _HEADER_STRUCT.pack(first_byte, mask_bit | payload_length)
+    elif payload_length < (1 << 16):
+        return _HEADER_WITH_16BIT_LENGTH_STRUCT.pack(
+            first_byte, mask_bit | 126, payload_length)
+    else:
+        return _HEADER_WITH_64BIT_LENGTH_STRUCT.pack(
+            first_byte, mask_bit | 127, payload_length)
 
 
-def _build_frame(header, body, mask):
+def _get_payload_length(payload):
+    """Returns the length of payload given as a str or a list of str."""
+
+    if isinstance(payload, list):
+        length = 0
+        for part in payload:
+            length += len(part)
+        return length
+    return len(payload)
+
+
+def _build_frame_buffers(header, body, mask):
+    """Builds a frame as a list of buffers which form the frame when they are
+    concatenated. body is not copied unless it needs to be masked.
+
+    Args:
+        header: frame header.
+        body: payload data as a str or a list of str.
+        mask: mask the payload data.
+    """
+
+    if not isinstance(body, list):
+        body = [body]
+
     if not mask:
-        return header + body
+        return [header] + body
 
     masking_nonce = os.urandom(4)
     masker = util.RepeatedXorMasker(masking_nonce)
 
-    return header + masking_nonce + masker.mask(body)
+    return [header + masking_nonce] + [masker.mask(part) for part in body]
 
 
-def _filter_and_format_frame_object(frame, mask, frame_filters):
-    for frame_filter in frame_filters:
-        frame_filter.filter(frame)
+def _build_frame(header, body, mask):
+    return ''.join(_build_frame_buffers(header, body, mask))
+
+
+def _compile_frame_filters(frame_filters):
+    """Compiles frame filters into one function applying all of them to a
+    frame in order. Returns None when there are no filters so that callers
+    can skip filtering entirely.
+    """
+
+    if not frame_filters:
+        return None
+    if len(frame_filters) == 1:
+        return frame_filters[0].filter
+
+    filter_methods = [frame_filter.filter for frame_filter in frame_filters]
+
+    def filter_frame(frame):
+        for filter_method in filter_methods:
+            filter_method(frame)
+    return filter_frame
+
+
+def _compile_message_filters(message_filters):
+    """Compiles message filters into one function applying all of them to a
+    message in order and returning the result. The arguments following the
+    message are passed to each filter. Returns None when there are no
+    filters so that callers can skip filtering entirely.
+    """
+
+    if not message_filters:
+        return None
+    if len(message_filters) == 1:
+        return message_filters[0].filter
+
+    filter_methods = [
+        message_filter.filter for message_filter in message_filters]
+
+    def filter_message(message, *args):
+        for filter_method in filter_methods:
+            message = filter_method(message, *args)
+        return message
+    return filter_message
+
+
+def _filter_and_format_frame_object_as_buffers(frame, mask, frame_filter):
+    """Applies frame_filter, a function compiled by _compile_frame_filters,
+    to frame and builds it as a list of buffers.
+    """
+
+    if frame_filter is not None:
+        if isinstance(frame.payload, list):
+            # Frame filters work on a payload given as a str.
+            frame.payload = ''.join(frame.payload)
+        frame_filter(frame)
 
     header = create_header(
-        frame.opcode, len(frame.payload), frame.fin,
+        frame.opcode, _get_payload_length(frame.payload), frame.fin,
         frame.rsv1, frame.rsv2, frame.rsv3, mask)
-    return _build_frame(header, frame.payload, mask)
+    return _build_frame_buffers(header, frame.payload, mask)
+
+
+def _filter_and_format_frame_object(frame, mask, frame_filters):
+    return ''.join(_filter_and_format_frame_object_as_buffers(
+        frame, mask, _compile_frame_filters(frame_filters)))
 
 
 def create_binary_frame(
@@ -154,6 +309,16 @@ def create_binary_frame(
     return _filter_and_format_frame_object(frame, mask, frame_filters)
 
 
+def _encode_text(text):
+    """Encodes text in unicode to UTF-8. Text in str is taken as already
+    encoded and returned as is.
+    """
+
+    if isinstance(text, unicode):
+        return text.encode('utf-8')
+    return text
+
+
 def create_text_frame(
     message, opcode=common.OPCODE_TEXT, fin=1, mask=False, frame_filters=[]):
     """Creates a simple text frame with no extension, reserved bit."""
@@ -165,7 +330,7 @@ def create_text_frame(
 
 def parse_frame(receive_bytes, logger=None,
                 ws_version=common.VERSION_HYBI_LATEST,
-                unmask_receive=True):
+                unmask_receive=True, max_payload_size=None):
     """Parses a frame. Returns a tuple containing each header field and
     payload.
 
@@ -178,34 +343,57 @@ def parse_frame(receive_bytes, logger=None,
         ws_version: the version of WebSocket protocol.
         unmask_receive: unmask received frames. When received unmasked
             frame, raises InvalidFrameException.
+        max_payload_size: maximum payload length to accept. None means no
+            limit.
 
     Raises:
         ConnectionTerminatedException: when receive_bytes raises it.
         InvalidFrameException: when the frame contains invalid data.
+        MessageTooBigException: when the payload length exceeds
+            max_payload_size. The payload is not read in this case.
+    """
+
+    frame = parse_frame_as_frame_object(
+        receive_bytes, logger, ws_version, unmask_receive, max_payload_size)
+    return (frame.opcode, frame.payload,
+            frame.fin, frame.rsv1, frame.rsv2, frame.rsv3)
+
+
+def parse_frame_as_frame_object(receive_bytes, logger=None,
+                                ws_version=common.VERSION_HYBI_LATEST,
+                                unmask_receive=True, max_payload_size=None):
+    """Parses a frame. Returns a Frame object. See parse_frame for the
+    arguments and the exceptions raised.
+
+    This reads the frame with as few receive_bytes calls as possible
+    without reading beyond it. Use FrameParser to parse frames from bytes
+    received in pieces of arbitrary size.
     """
 
     if not logger:
         logger = logging.getLogger()
+    # Checked once so that no log record arguments are built per frame
+    # unless fine logging is enabled.
+    log_fine = logger.isEnabledFor(common.LOGLEVEL_FINE)
 
-    logger.log(common.LOGLEVEL_FINE, 'Receive the first 2 octets of a frame')
+    if log_fine:
+        logger.log(common.LOGLEVEL_FINE,
+                   'Receive the first 2 octets of a frame')
 
     received = receive_bytes(2)
 
     first_byte = ord(received[0])
-    fin = (first_byte >> 7) & 1
-    rsv1 = (first_byte >> 6) & 1
-    rsv2 = (first_byte >> 5) & 1
-    rsv3 = (first_byte >> 4) & 1
-    opcode = first_byte & 0xf
-
     second_byte = ord(received[1])
-    mask = (second_byte >> 7) & 1
+    mask = second_byte >> 7
     payload_length = second_byte & 0x7f
 
-    logger.log(common.LOGLEVEL_FINE,
-               'FIN=%s, RSV1=%s, RSV2=%s, RSV3=%s, opcode=%s, '
-               'Mask=%s, Payload_length=%s',
-               fin, rsv1, rsv2, rsv3, opcode, mask, payload_length)
+    if log_fine:
+        logger.log(common.LOGLEVEL_FINE,
+                   'FIN=%s, RSV1=%s, RSV2=%s, RSV3=%s, opcode=%s, '
+                   'Mask=%s, Payload_length=%s',
+                   (first_byte >> 7) & 1, (first_byte >> 6) & 1,
+                   (first_byte >> 5) & 1, (first_byte >> 4) & 1,
+                   first_byte & 0xf, mask, payload_length)
 
     if (mask == 1) != unmask_receive:
         raise InvalidFrameException(
@@ -218,8 +406,9 @@ def parse_frame(receive_bytes, logger=None,
     valid_length_encoding = True
     length_encoding_bytes = 1
     if payload_length == 127:
-        logger.log(common.LOGLEVEL_FINE,
-                   'Receive 8-octet extended payload length')
+        if log_fine:
+            logger.log(common.LOGLEVEL_FINE,
+                       'Receive 8-octet extended payload length')
 
         extended_payload_length = receive_bytes(8)
         payload_length = struct.unpack(
@@ -231,11 +420,13 @@ def parse_frame(receive_bytes, logger=None,
             valid_length_encoding = False
             length_encoding_bytes = 8
 
-        logger.log(common.LOGLEVEL_FINE,
-                   'Decoded_payload_length=%s', payload_length)
+        if log_fine:
+            logger.log(common.LOGLEVEL_FINE,
+                       'Decoded_payload_length=%s', payload_length)
     elif payload_length == 126:
-        logger.log(common.LOGLEVEL_FINE,
-                   'Receive 2-octet extended payload length')
+        if log_fine:
+            logger.log(common.LOGLEVEL_FINE,
+                       'Receive 2-octet extended payload length')
 
         extended_payload_length = receive_bytes(2)
         payload_length = struct.unpack(
@@ -244,8 +435,9 @@ def parse_frame(receive_bytes, logger=None,
             valid_length_encoding = False
             length_encoding_bytes = 2
 
-        logger.log(common.LOGLEVEL_FINE,
-                   'Decoded_payload_length=%s', payload_length)
+        if log_fine:
+            logger.log(common.LOGLEVEL_FINE,
+                       'Decoded_payload_length=%s', payload_length)
 
     if not valid_length_encoding:
         logger.warning(
@@ -254,41 +446,269 @@ def parse_frame(receive_bytes, logger=None,
             payload_length,
             length_encoding_bytes)
 
+    if max_payload_size is not None and payload_length > max_payload_size:
+        raise MessageTooBigException(
+            'Payload length %d exceeds the limit %d' %
+            (payload_length, max_payload_size))
+
     if mask == 1:
-        logger.log(common.LOGLEVEL_FINE, 'Receive mask')
+        if log_fine:
+            logger.log(common.LOGLEVEL_FINE, 'Receive mask')
 
         masking_nonce = receive_bytes(4)
         masker = util.RepeatedXorMasker(masking_nonce)
 
-        logger.log(common.LOGLEVEL_FINE, 'Mask=%r', masking_nonce)
+        if log_fine:
+            logger.log(common.LOGLEVEL_FINE, 'Mask=%r', masking_nonce)
     else:
         masker = _NOOP_MASKER
 
-    logger.log(common.LOGLEVEL_FINE, 'Receive payload data')
-    if logger.isEnabledFor(common.LOGLEVEL_FINE):
+    if log_fine:
+        logger.log(common.LOGLEVEL_FINE, 'Receive payload data')
         receive_start = time.time()
 
     raw_payload_bytes = receive_bytes(payload_length)
 
-    if logger.isEnabledFor(common.LOGLEVEL_FINE):
+    if log_fine:
         logger.log(
             common.LOGLEVEL_FINE,
             'Done receiving payload data at %s MB/s',
             payload_length / (time.time() - receive_start) / 1000 / 1000)
-    logger.log(common.LOGLEVEL_FINE, 'Unmask payload data')
-
-    if logger.isEnabledFor(common.LOGLEVEL_FINE):
+        logger.log(common.LOGLEVEL_FINE, 'Unmask payload data')
         unmask_start = time.time()
 
     unmasked_bytes = masker.mask(raw_payload_bytes)
 
-    if logger.isEnabledFor(common.LOGLEVEL_FINE):
+    if log_fine:
         logger.log(
             common.LOGLEVEL_FINE,
             'Done unmasking payload data at %s MB/s',
             payload_length / (time.time() - unmask_start) / 1000 / 1000)
 
-    return opcode, unmasked_bytes, fin, rsv1, rsv2, rsv3
+    return Frame((first_byte >> 7) & 1, (first_byte >> 6) & 1,
+                 (first_byte >> 5) & 1, (first_byte >> 4) & 1,
+                 first_byte & 0xf, unmasked_bytes)
+
+
+class FrameParser(object):
+    """A parser of frames which doesn't do any I/O by itself. Bytes received
+    from the connection are given by feed() in pieces of any size, and
+    parsed frames are taken out by next_frame().
+    """
+
+    def __init__(self, logger=None, ws_version=common.VERSION_HYBI_LATEST,
+                 unmask_receive=True, max_payload_size=None):
+        """Constructs an instance. See parse_frame for the arguments."""
+
+        if not logger:
+            logger = logging.getLogger()
+        self._logger = logger
+        self._ws_version = ws_version
+        self._unmask_receive = unmask_receive
+        self._max_payload_size = max_payload_size
+
+        # Unconsumed bytes start at _position of _buffer and continue in
+        # _pending_chunks, which are joined into _buffer when bytes across
+        # them are needed. _size is the number of unconsumed bytes.
+        self._buffer = ''
+        self._position = 0
+        self._pending_chunks = []
+        self._size = 0
+
+        # (first byte, header length, payload length, masking nonce) of the
+        # frame whose payload hasn't arrived yet.
+        self._header = None
+
+    def feed(self, data):
+        """Gives bytes received from the connection."""
+
+        if not data:
+            return
+        if not self._size:
+            self._buffer = data
+            self._position = 0
+        else:
+            self._pending_chunks.append(data)
+        self._size += len(data)
+
+    def bytes_needed(self):
+        """Returns the number of bytes to be fed at least for next_frame()
+        to make progress. Blocking readers can read exactly this number of
+        bytes without reading beyond the current frame.
+        """
+
+        if self._header is not None:
+            return self._header[1] + self._header[2] - self._size
+        if self._size < 2:
+            return 2 - self._size
+        self._make_contiguous(2)
+        return max(1, _get_header_length(
+            ord(self._buffer[self._position + 1])) - self._size)
+
+    def next_frame(self):
+        """Returns the next frame, or None if it hasn't arrived completely.
+
+        Raises:
+            InvalidFrameException: when the frame contains invalid data.
+            MessageTooBigException: when the payload length exceeds
+                max_payload_size. This is raised as soon as the header has
+                arrived.
+        """
+
+        header = self._header
+        if header is None:
+            header = self._parse_header()
+            if header is None:
+                return None
+        first_byte, header_length, payload_length, masking_nonce = header
+
+        frame_length = header_length + payload_length
+        if self._size < frame_length:
+            self._header = header
+            return None
+        self._header = None
+
+        self._make_contiguous(frame_length)
+        position = self._position
+        payload = self._buffer[position + header_length:
+                               position + frame_length]
+        self._position = position + frame_length
+        self._size -= frame_length
+
+        if masking_nonce is not None:
+            payload = util.RepeatedXorMasker(masking_nonce).mask(payload)
+
+        return Frame((first_byte >> 7) & 1, (first_byte >> 6) & 1,
+                     (first_byte >> 5) & 1, (first_byte >> 4) & 1,
+                     first_byte & 0xf, payload)
+
+    def _make_contiguous(self, length):
+        """Makes the first length unconsumed bytes available in _buffer."""
+
+        if len(self._buffer) - self._position < length:
+            self._buffer = ''.join(
+                [self._buffer[self._position:]] + self._pending_chunks)
+            self._position = 0
+            self._pending_chunks = []
+
+    def _parse_header(self):
+        if self._size < 2:
+            return None
+        self._make_contiguous(2)
+        position = self._position
+        first_byte = ord(self._buffer[position])
+        second_byte = ord(self._buffer[position + 1])
+        mask = second_byte >> 7
+
+        if (mask == 1) != self._unmask_receive:
+            raise InvalidFrameException(
+                'Mask bit on the received frame did\'nt match masking '
+                'configuration for received frames')
+
+        header_length = _get_header_length(second_byte)
+        if self._size < header_length:
+            return None
+        self._make_contiguous(header_length)
+        position = self._position
+
+        # The HyBi and later specs disallow putting a value in 0x0-0xFFFF
+        # into the 8-octet extended payload length field (or 0x0-0xFD in
+        # 2-octet field).
+        payload_length = second_byte & 0x7f
+        if payload_length == 127:
+            payload_length = _HEADER_WITH_64BIT_LENGTH_STRUCT.unpack_from(
+                self._buffer, position)[2]
+            if payload_length > 0x7FFFFFFFFFFFFFFF:
+                raise InvalidFrameException(
+                    'Extended payload length >= 2^63')
+            if self._ws_version >= 13 and payload_length < 0x10000:
+                self._warn_length_encoding(payload_length, 8)
+        elif payload_length == 126:
+            payload_length = _HEADER_WITH_16BIT_LENGTH_STRUCT.unpack_from(
+                self._buffer, position)[2]
+            if self._ws_version >= 13 and payload_length < 126:
+                self._warn_length_encoding(payload_length, 2)
+
+        if self._logger.isEnabledFor(common.LOGLEVEL_FINE):
+            self._logger.log(
+                common.LOGLEVEL_FINE,
+                'FIN=%s, RSV1=%s, RSV2=%s, RSV3=%s, opcode=%s, '
+                'Mask=%s, Payload_length=%s',
+                (first_byte >> 7) & 1, (first_byte >> 6) & 1,
+                (first_byte >> 5) & 1, (first_byte >> 4) & 1,
+                first_byte & 0xf, mask, payload_length)
+
+        if (self._max_payload_size is not None and
+            payload_length > self._max_payload_size):
+            raise MessageTooBigException(
+                'Payload length %d exceeds the limit %d' %
+                (payload_length, self._max_payload_size))
+
+        if mask:
+            masking_nonce = self._buffer[
+                position + header_length - 4:position + header_length]
+        else:
+            masking_nonce = None
+        return first_byte, header_length, payload_length, masking_nonce
+
+    def _warn_length_encoding(self, payload_length, length_encoding_bytes):
+        self._logger.warning(
+            'Payload length is not encoded using the minimal number of '
+            'bytes (%d is encoded using %d bytes)',
+            payload_length,
+            length_encoding_bytes)
+
+
+def _get_header_length(second_byte):
+    """Returns the length of the frame header, including the extended
+    payload length and the masking key, from the second byte of the frame.
+    """
+
+    length = 2
+    if second_byte & 0x80:
+        length += 4
+    payload_length = second_byte & 0x7f
+    if payload_length == 127:
+        length += 8
+    elif payload_length == 126:
+        length += 2
+    return length
+
+
+class _TextMessageDecoder(object):
+    """A stateful class to decode a text message given as fragments.
+
+    Each fragment is validated as soon as it is given, so that the
+    connection can be failed without waiting for the rest of the message
+    (RFC 6455 section 8.1). A UTF-8 sequence may be split across fragments.
+    """
+
+    __slots__ = ('_decoder',)
+
+    def __init__(self):
+        self._decoder = None
+
+    def decode(self, fragment, final):
+        """Decodes fragment into unicode.
+
+        Raises:
+            InvalidUTF8Exception: when fragment contains invalid UTF-8, or
+                final is True and the message ends in the middle of a UTF-8
+                sequence.
+        """
+
+        if self._decoder is None:
+            # Fast path for ASCII. No character can be split across
+            # fragments until we see a non-ASCII byte.
+            try:
+                return fragment.decode('ascii')
+            except UnicodeDecodeError:
+                self._decoder = codecs.getincrementaldecoder('utf-8')()
+
+        try:
+            return self._decoder.decode(fragment, final)
+        except UnicodeDecodeError, e:
+            raise InvalidUTF8Exception(e)
 
 
 class FragmentedFrameBuilder(object):
@@ -298,7 +718,7 @@ class FragmentedFrameBuilder(object):
         """Constructs an instance."""
 
         self._mask = mask
-        self._frame_filters = frame_filters
+        self._frame_filter = _compile_frame_filters(frame_filters)
         # This is for skipping UTF-8 encoding when building text type frames
         # from compressed data.
         self._encode_utf8 = encode_utf8
@@ -310,6 +730,14 @@ class FragmentedFrameBuilder(object):
         self._opcode = common.OPCODE_TEXT
 
     def build(self, payload_data, end, binary):
+        return ''.join(self.build_as_buffers(payload_data, end, binary))
+
+    def build_as_buffers(self, payload_data, end, binary):
+        """Builds a frame as a list of buffers. payload_data can be a list of
+        str (or unicode for text frames) which is put into the frame without
+        being concatenated.
+        """
+
         if binary:
             frame_type = common.OPCODE_BINARY
         else:
@@ -330,12 +758,18 @@ class FragmentedFrameBuilder(object):
             self._started = True
             fin = 0
 
-        if binary or not self._encode_utf8:
-            return create_binary_frame(
-                payload_data, opcode, fin, self._mask, self._frame_filters)
-        else:
-            return create_text_frame(
-                payload_data, opcode, fin, self._mask, self._frame_filters)
+        if not binary and self._encode_utf8:
+            if isinstance(payload_data, buffer):
+                # Slices of a message are made after encoding the message.
+                pass
+            elif isinstance(payload_data, list):
+                payload_data = [_encode_text(part) for part in payload_data]
+            else:
+                payload_data = _encode_text(payload_data)
+
+        frame = Frame(fin, 0, 0, 0, opcode, payload_data)
+        return _filter_and_format_frame_object_as_buffers(
+            frame, self._mask, self._frame_filter)
 
 
 def _create_control_frame(opcode, body, mask, frame_filters):
@@ -383,6 +817,31 @@ def create_closing_handshake_body(code, reason):
     return body
 
 
+def _parse_closing_handshake_body(body):
+    """Parses the body of a close frame. Returns a tuple of the status code
+    and the reason. The reason is None when the body is empty, and the code
+    is STATUS_NO_STATUS_RECEIVED then.
+
+    Raises:
+        InvalidFrameException: when the body is invalid.
+    """
+
+    # Status code is optional. We can have status reason only if we
+    # have status code. Status reason can be empty string. So,
+    # allowed cases are
+    # - no application data: no code no reason
+    # - 2 octet of application data: has code but no reason
+    # - 3 or more octet of application data: both code and reason
+    if len(body) == 0:
+        return common.STATUS_NO_STATUS_RECEIVED, None
+    if len(body) == 1:
+        raise InvalidFrameException(
+            'If a close frame has status code, the length of '
+            'status code must be 2 octet')
+    return (struct.unpack('!H', body[0:2])[0],
+            body[2:].decode('utf-8', 'replace'))
+
+
 class StreamOptions(object):
     """Holds option values to configure Stream objects."""
 
@@ -401,136 +860,314 @@ class StreamOptions(object):
         self.mask_send = False
         self.unmask_receive = True
 
-
-class Stream(StreamBase):
-    """A class for parsing/building frames of the WebSocket protocol
-    (RFC 6455).
+        # Maximum size of payload data of each frame to send. Messages larger
+        # than it are fragmented. None or a non-positive integer means no
+        # limit.
+        self.outgoing_max_frame_payload_size = None
+
+        # Limits on incoming data. Exceeding any of them raises
+        # MessageTooBigException. None means no limit.
+        # - incoming_max_frame_payload_size: payload length of each frame,
+        #   checked against the length header before reading the payload.
+        # - incoming_max_message_size: total payload length of a message,
+        #   checked as fragments arrive.
+        # - incoming_max_decompressed_size: size of each message (or frame
+        #   for deflate-frame) after decompression, checked while inflating.
+        self.incoming_max_frame_payload_size = None
+        self.incoming_max_message_size = None
+        self.incoming_max_decompressed_size = None
+
+        # Cork mode. When cork_flush_delay is not None, outgoing frames are
+        # buffered and written together when the buffer reaches
+        # cork_flush_threshold bytes, when cork_flush_delay seconds pass, or
+        # when Stream.flush() is called. See StreamBase.enable_cork().
+        self.cork_flush_delay = None
+        self.cork_flush_threshold = 16 * 1024
+
+        # Keepalive. When keepalive_interval is not None, a ping is sent
+        # when nothing has been received for keepalive_interval seconds, and
+        # the connection is failed when no pong arrives for keepalive_timeout
+        # seconds after a ping. Pongs are read by the handler thread, so
+        # pings are sent and timed out only while the handler is waiting for
+        # frames (e.g. blocked in receive_message).
+        self.keepalive_interval = None
+        self.keepalive_timeout = 30
+
+
+class _KeepaliveScheduler(threading.Thread):
+    """A thread which runs the keepalive timers of streams. One instance is
+    shared by all streams.
+
+    Timers are kept in a hashed timer wheel, so scheduling and expiring a
+    timer take constant time regardless of the number of connections. Timers
+    fire up to one tick late.
     """
 
-    def __init__(self, request, options):
-        """Constructs an instance.
-
-        Args:
-            request: mod_python request.
-        """
+    daemon = True
 
-        StreamBase.__init__(self, request)
+    def __init__(self, tick=_KEEPALIVE_TICK, wheel_size=_KEEPALIVE_WHEEL_SIZE):
+        threading.Thread.__init__(self, name='KeepaliveScheduler')
 
         self._logger = util.get_class_logger(self)
 
-        self._options = options
+        self._tick = tick
+        # Each slot holds (tick, stream) pairs of the timers expiring at the
+        # ticks congruent to the index of the slot.
+        self._wheel = [[] for unused in xrange(wheel_size)]
+        self._num_timers = 0
+        # The last tick whose timers have been expired.
+        self._current_tick = int(time.time() / tick)
+        self._condition = threading.Condition()
+
+    def schedule(self, deadline, stream):
+        """Makes stream._on_keepalive_timer called at deadline (in
+        time.time() seconds).
+        """
 
-        self._request.client_terminated = False
-        self._request.server_terminated = False
+        tick = int(deadline / self._tick) + 1
 
-        # Holds body of received fragments.
-        self._received_fragments = []
-        # Holds the opcode of the first fragment.
-        self._original_opcode = None
+        self._condition.acquire()
+        try:
+            tick = max(tick, self._current_tick + 1)
+            self._wheel[tick % len(self._wheel)].append((tick, stream))
+            self._num_timers += 1
+            if self._num_timers == 1:
+                self._condition.notify()
+        finally:
+            self._condition.release()
+
+    def _expire(self, now_tick):
+        """Removes the timers expiring at or before now_tick from the wheel
+        and returns their streams.
+        """
 
-        self._writer = FragmentedFrameBuilder(
-            self._options.mask_send, self._options.outgoing_frame_filters,
-            self._options.encode_text_message_to_utf8)
+        self._condition.acquire()
+        try:
+            wheel_size = len(self._wheel)
+            start_tick = max(self._current_tick + 1, now_tick - wheel_size + 1)
+            expired = []
+            for tick in xrange(start_tick, now_tick + 1):
+                slot = self._wheel[tick % wheel_size]
+                if not slot:
+                    continue
+                remaining = []
+                for timer in slot:
+                    if timer[0] <= now_tick:
+                        expired.append(timer[1])
+                    else:
+                        remaining.append(timer)
+                self._wheel[tick % wheel_size] = remaining
+            self._num_timers -= len(expired)
+            self._current_tick = max(self._current_tick, now_tick)
+            return expired
+        finally:
+            self._condition.release()
+
+    def run(self):
+        while True:
+            self._condition.acquire()
+            try:
+                while not self._num_timers:
+                    self._condition.wait()
+            finally:
+                self._condition.release()
 
-        self._ping_queue = deque()
+            time.sleep(self._tick)
 
-    def _receive_frame(self):
-        """Receives a frame and return data in the frame as a tuple containing
-        each header field and payload separately.
+            now = time.time()
+            for stream in self._expire(int(now / self._tick)):
+                try:
+                    deadline = stream._on_keepalive_timer(now)
+                except Exception, e:
+                    # The handler thread will notice the broken connection on
+                    # its next read or write.
+                    self._logger.debug('Keepalive timer failed: %s', e)
+                    continue
+                if deadline is not None:
+                    self.schedule(deadline, stream)
 
-        Raises:
-            ConnectionTerminatedException: when read returns empty
-                string.
-            InvalidFrameException: when the frame contains invalid data.
-        """
 
-        def _receive_bytes(length):
-            return self.receive_bytes(length)
+_keepalive_scheduler = None
+_keepalive_scheduler_lock = threading.Lock()
 
-        return parse_frame(receive_bytes=_receive_bytes,
-                           logger=self._logger,
-                           ws_version=self._request.ws_version,
-                           unmask_receive=self._options.unmask_receive)
 
-    def _receive_frame_as_frame_object(self):
-        opcode, unmasked_bytes, fin, rsv1, rsv2, rsv3 = self._receive_frame()
+def _get_keepalive_scheduler():
+    """Returns the _KeepaliveScheduler instance, starting it on the first
+    call.
+    """
 
-        return Frame(fin=fin, rsv1=rsv1, rsv2=rsv2, rsv3=rsv3,
-                     opcode=opcode, payload=unmasked_bytes)
+    global _keepalive_scheduler
 
-    def receive_filtered_frame(self):
-        """Receives a frame and applies frame filters and message filters.
-        The frame to be received must satisfy following conditions:
-        - The frame is not fragmented.
-        - The opcode of the frame is TEXT or BINARY.
+    _keepalive_scheduler_lock.acquire()
+    try:
+        if _keepalive_scheduler is None:
+            _keepalive_scheduler = _KeepaliveScheduler()
+            _keepalive_scheduler.start()
+        return _keepalive_scheduler
+    finally:
+        _keepalive_scheduler_lock.release()
 
-        DO NOT USE this method except for testing purpose.
-        """
 
-        frame = self._receive_frame_as_frame_object()
-        if not frame.fin:
-            raise InvalidFrameException(
-                'Segmented frames must not be received via '
-                'receive_filtered_frame()')
-        if (frame.opcode != common.OPCODE_TEXT and
-            frame.opcode != common.OPCODE_BINARY):
-            raise InvalidFrameException(
-                'Control frames must not be received via '
-                'receive_filtered_frame()')
+class PreparedMessage(object):
+    """A message to be sent to many streams using Stream.send_prepared().
 
-        for frame_filter in self._options.incoming_frame_filters:
-            frame_filter.filter(frame)
-        for message_filter in self._options.incoming_message_filters:
-            frame.payload = message_filter.filter(frame.payload)
-        return frame
+    The frames built for the message are cached for each distinct
+    configuration of the streams (extensions and their parameters, the
+    maximum frame payload size, etc.), so encoding, compression and framing
+    run once per configuration rather than once per stream.
 
-    def send_message(self, message, end=True, binary=False):
-        """Send message.
+    Outgoing filters take part in the sharing only when they implement
+    get_prepared_message_key(), which returns a hashable value determining
+    their output for a complete message, or None when the output depends on
+    previously sent messages (e.g. DEFLATE with context takeover). Streams
+    using other filters, and streams masking frames, which need a new masking
+    key for each frame, send the message as send_message() does.
+    """
+
+    def __init__(self, message, binary=False):
+        """Constructs an instance.
 
         Args:
-            message: text in unicode or binary in str to send.
-            binary: send message as binary frame.
+            message: text in unicode or binary in str.
+            binary: send the message as binary frames.
 
         Raises:
-            BadOperationException: when called on a server-terminated
-                connection or called with inconsistent message type or
-                binary parameter.
+            BadOperationException: when message is unicode and binary is
+                True.
         """
 
-        if self._request.server_terminated:
-            raise BadOperationException(
-                'Requested send_message after sending out a closing handshake')
-
         if binary and isinstance(message, unicode):
             raise BadOperationException(
                 'Message for binary frame must be instance of str')
 
-        for message_filter in self._options.outgoing_message_filters:
-            message = message_filter.filter(message, end, binary)
+        self.message = message
+        self.binary = binary
 
-        try:
-            # Set this to any positive integer to limit maximum size of data in
-            # payload data of each frame.
-            MAX_PAYLOAD_DATA_SIZE = -1
+        # Map from the key given by Stream._get_prepared_message_key() to the
+        # frames of the message.
+        self._frames = {}
 
-            if MAX_PAYLOAD_DATA_SIZE <= 0:
-                self._write(self._writer.build(message, end, binary))
-                return
 
+class _MessageCodec(object):
+    """The part of the WebSocket protocol which doesn't do any I/O:
+    processing received frames into messages and building frames for
+    messages to send. Stream adds blocking I/O to it, and ProtocolCore adds
+    buffers for use with non-blocking I/O.
+    """
+
+    def __init__(self, options, ws_version=common.VERSION_HYBI_LATEST):
+        """Constructs an instance.
+
+        Args:
+            options: StreamOptions.
+            ws_version: the version of WebSocket protocol.
+        """
+
+        self._options = options
+
+        # Holds body of received fragments.
+        self._received_fragments = []
+        # Holds the total size of received fragments.
+        self._received_fragments_size = 0
+        # Holds the opcode of the first fragment.
+        self._original_opcode = None
+        # Decodes fragments of the text message being received.
+        self._text_message_decoder = None
+
+        self._frame_parser = FrameParser(
+            self._logger, ws_version, self._options.unmask_receive,
+            self._options.incoming_max_frame_payload_size)
+
+        self._writer = FragmentedFrameBuilder(
+            self._options.mask_send, self._options.outgoing_frame_filters,
+            self._options.encode_text_message_to_utf8)
+
+        # The filters configured by extensions, compiled into one function
+        # for each kind. None when there are no filters of the kind.
+        self._filter_outgoing_message = _compile_message_filters(
+            self._options.outgoing_message_filters)
+        self._filter_outgoing_frame = _compile_frame_filters(
+            self._options.outgoing_frame_filters)
+        self._filter_incoming_message = _compile_message_filters(
+            self._options.incoming_message_filters)
+        self._filter_incoming_frame = _compile_frame_filters(
+            self._options.incoming_frame_filters)
+
+    def _check_message_type(self, message, binary):
+        """Raises BadOperationException if message is unicode (or a list
+        containing unicode) and binary is True.
+        """
+
+        if not binary:
+            return
+        if isinstance(message, list):
+            parts = message
+        else:
+            parts = [message]
+        for part in parts:
+            if isinstance(part, unicode):
+                raise BadOperationException(
+                    'Message for binary frame must be instance of str')
+
+    def _check_message_types(self, messages, binary):
+        """Checks all of messages by _check_message_type before frames are
+        built for any of them. Extensions update their compression context
+        while frames are built, so frames of a batch must be either all
+        sent or not built at all. Returns messages as a list.
+        """
+
+        messages = list(messages)
+        for message in messages:
+            self._check_message_type(message, binary)
+        return messages
+
+    def _build_message_buffers(self, message, end, binary):
+        """Applies the outgoing message filters to message and builds frames
+        for it. Returns a list of buffers to write.
+        """
+
+        self._check_message_type(message, binary)
+
+        if isinstance(message, list) and (
+            self._filter_outgoing_message is not None or
+            self._filter_outgoing_frame is not None):
+            # Extensions transform the whole message.
+            if not binary:
+                message = [_encode_text(part) for part in message]
+            message = ''.join(message)
+
+        if self._filter_outgoing_message is not None:
+            message = self._filter_outgoing_message(message, end, binary)
+
+        try:
+            max_payload_size = self._options.outgoing_max_frame_payload_size
+            if max_payload_size is None or max_payload_size <= 0:
+                return self._writer.build_as_buffers(message, end, binary)
+
+            if not binary and self._options.encode_text_message_to_utf8:
+                # Fragment the encoded message so that frames are sliced out
+                # of one str without copying.
+                if isinstance(message, list):
+                    message = ''.join(
+                        [_encode_text(part) for part in message])
+                else:
+                    message = _encode_text(message)
+            elif isinstance(message, list):
+                message = ''.join(message)
+
+            buffers = []
             bytes_written = 0
             while True:
                 end_for_this_frame = end
                 bytes_to_write = len(message) - bytes_written
-                if (MAX_PAYLOAD_DATA_SIZE > 0 and
-                    bytes_to_write > MAX_PAYLOAD_DATA_SIZE):
+                if bytes_to_write > max_payload_size:
                     end_for_this_frame = False
-                    bytes_to_write = MAX_PAYLOAD_DATA_SIZE
+                    bytes_to_write = max_payload_size
 
-                frame = self._writer.build(
-                    message[bytes_written:bytes_written + bytes_to_write],
+                buffers.extend(self._writer.build_as_buffers(
+                    buffer(message, bytes_written, bytes_to_write),
                     end_for_this_frame,
-                    binary)
-                self._write(frame)
+                    binary))
 
                 bytes_written += bytes_to_write
 
@@ -538,6 +1175,7 @@ class Stream(StreamBase):
                 # at least one frame is sent.
                 if len(message) <= bytes_written:
                     break
+            return buffers
         except ValueError, e:
             raise BadOperationException(e)
 
@@ -563,15 +1201,20 @@ class Stream(StreamBase):
                         'Received an intermediate frame but '
                         'fragmentation not started')
 
+            self._received_fragments_size = self._check_message_size(
+                self._received_fragments_size, frame)
+
+            self._received_fragments.append(
+                self._process_message_fragment(frame.payload, frame.fin))
+
             if frame.fin:
                 # End of fragmentation frame
-                self._received_fragments.append(frame.payload)
                 message = ''.join(self._received_fragments)
                 self._received_fragments = []
+                self._received_fragments_size = 0
                 return message
             else:
                 # Intermediate frame
-                self._received_fragments.append(frame.payload)
                 return None
         else:
             if self._received_fragments:
@@ -588,7 +1231,12 @@ class Stream(StreamBase):
                 # Unfragmented frame
 
                 self._original_opcode = frame.opcode
-                return frame.payload
+                if common.is_control_opcode(frame.opcode):
+                    return frame.payload
+
+                self._check_message_size(0, frame)
+                self._start_message(frame.opcode)
+                return self._process_message_fragment(frame.payload, True)
             else:
                 # Start of fragmentation frame
 
@@ -596,54 +1244,597 @@ class Stream(StreamBase):
                     raise InvalidFrameException(
                         'Control frames must not be fragmented')
 
+                self._received_fragments_size = self._check_message_size(
+                    0, frame)
                 self._original_opcode = frame.opcode
-                self._received_fragments.append(frame.payload)
+                self._start_message(frame.opcode)
+                self._received_fragments.append(
+                    self._process_message_fragment(frame.payload, False))
                 return None
 
-    def _process_close_message(self, message):
-        """Processes close message.
+    def _start_message(self, opcode):
+        """Prepares for processing fragments of a data message."""
 
-        Args:
-            message: close message.
+        if opcode == common.OPCODE_TEXT:
+            self._text_message_decoder = _TextMessageDecoder()
+        else:
+            self._text_message_decoder = None
+
+    def _process_message_fragment(self, payload, end):
+        """Applies the incoming message filters to a fragment of the data
+        message started by _start_message() and decodes it if the message
+        is text.
 
         Raises:
-            InvalidFrameException: when the message is invalid.
+            InvalidUTF8Exception: when the text message turns out to be
+                invalid UTF-8.
         """
 
-        self._request.client_terminated = True
-
-        # Status code is optional. We can have status reason only if we
-        # have status code. Status reason can be empty string. So,
-        # allowed cases are
-        # - no application data: no code no reason
-        # - 2 octet of application data: has code but no reason
-        # - 3 or more octet of application data: both code and reason
-        if len(message) == 0:
-            self._logger.debug('Received close frame (empty body)')
-            self._request.ws_close_code = (
-                common.STATUS_NO_STATUS_RECEIVED)
-        elif len(message) == 1:
-            raise InvalidFrameException(
-                'If a close frame has status code, the length of '
-                'status code must be 2 octet')
-        elif len(message) >= 2:
-            self._request.ws_close_code = struct.unpack(
-                '!H', message[0:2])[0]
-            self._request.ws_close_reason = message[2:].decode(
-                'utf-8', 'replace')
-            self._logger.debug(
-                'Received close frame (code=%d, reason=%r)',
-                self._request.ws_close_code,
-                self._request.ws_close_reason)
+        if self._filter_incoming_message is not None:
+            payload = self._filter_incoming_message(payload, end)
 
-        # As we've received a close frame, no more data is coming over the
-        # socket. We can now safely close the socket without worrying about
-        # RST sending.
+        if self._text_message_decoder is not None:
+            payload = self._text_message_decoder.decode(payload, end)
+        return payload
 
-        if self._request.server_terminated:
-            self._logger.debug(
-                'Received ack for server-initiated closing handshake')
-            return
+    def _check_message_size(self, received_size, frame):
+        """Adds the payload length of frame to received_size and returns the
+        sum.
+
+        Raises:
+            MessageTooBigException: when the sum exceeds
+                incoming_max_message_size.
+        """
+
+        received_size += len(frame.payload)
+        max_size = self._options.incoming_max_message_size
+        if max_size is not None and received_size > max_size:
+            raise MessageTooBigException(
+                'Message size %d exceeds the limit %d' %
+                (received_size, max_size))
+        return received_size
+
+    def _filter_received_frame(self, frame):
+        """Checks a received frame and applies the incoming frame filters to
+        it.
+
+        Raises:
+            InvalidFrameException: when the frame contains invalid data.
+            UnsupportedFrameException: when the frame has reserved bits set
+                after applying the incoming frame filters.
+        """
+
+        # Check the constraint on the payload size for control frames
+        # before extension processes the frame.
+        # See also http://tools.ietf.org/html/rfc6455#section-5.5
+        if (common.is_control_opcode(frame.opcode) and
+            len(frame.payload) > 125):
+            raise InvalidFrameException(
+                'Payload data size of control frames must be 125 bytes or '
+                'less')
+
+        if self._filter_incoming_frame is not None:
+            self._filter_incoming_frame(frame)
+
+        if frame.rsv1 or frame.rsv2 or frame.rsv3:
+            raise UnsupportedFrameException(
+                'Unsupported flag is set (rsv = %d%d%d)' %
+                (frame.rsv1, frame.rsv2, frame.rsv3))
+
+
+# Types of the events returned by ProtocolCore.feed().
+EVENT_MESSAGE = 'message'
+EVENT_FRAGMENT = 'fragment'
+EVENT_PING = 'ping'
+EVENT_PONG = 'pong'
+EVENT_CLOSE = 'close'
+
+
+class ProtocolEvent(object):
+    """An event returned by ProtocolCore.feed().
+
+    Attributes:
+        type: one of the EVENT_* constants.
+        data: the message (unicode for text, str for binary) for
+            EVENT_MESSAGE, a part of it for EVENT_FRAGMENT, and the
+            application data for EVENT_PING and EVENT_PONG.
+        binary: whether the message is binary, for EVENT_MESSAGE and
+            EVENT_FRAGMENT.
+        end: whether the part is the last one of the message, for
+            EVENT_FRAGMENT.
+        code: the status code for EVENT_CLOSE.
+        reason: the reason for EVENT_CLOSE, or None if the close frame had
+            no body.
+    """
+
+    __slots__ = ('type', 'data', 'binary', 'end', 'code', 'reason')
+
+    def __init__(self, type, data=None, binary=False, end=True, code=None,
+                 reason=None):
+        self.type = type
+        self.data = data
+        self.binary = binary
+        self.end = end
+        self.code = code
+        self.reason = reason
+
+
+class ProtocolCore(_MessageCodec):
+    """A WebSocket protocol (RFC 6455) state machine which doesn't do any
+    I/O by itself, so that it can run on event loops and non-blocking
+    servers without a thread for each connection.
+
+    Bytes received from the connection are given to feed(), which returns
+    events for them. Messages and control frames are sent by the send_*
+    methods, and data_to_send() returns the bytes to write to the
+    connection. Pings are answered and closing handshakes started by the
+    peer are acknowledged by queuing the frames to send.
+    """
+
+    def __init__(self, options=None, ws_version=common.VERSION_HYBI_LATEST,
+                 receive_fragments=False, echo_close=True):
+        """Constructs an instance.
+
+        Args:
+            options: StreamOptions. The default is for servers, i.e.
+                received frames must be masked and sent frames are not.
+            ws_version: the version of WebSocket protocol.
+            receive_fragments: return EVENT_FRAGMENT events for each frame
+                of data messages instead of EVENT_MESSAGE events for whole
+                messages.
+            echo_close: acknowledge closing handshakes started by the peer
+                by echoing the status code. When False, the caller must
+                answer EVENT_CLOSE by send_close().
+        """
+
+        self._logger = util.get_class_logger(self)
+
+        if options is None:
+            options = StreamOptions()
+        _MessageCodec.__init__(self, options, ws_version)
+
+        self._receive_fragments = receive_fragments
+        self._echo_close = echo_close
+        # The opcode of the data message being received as fragments.
+        self._fragment_opcode = None
+
+        self._outgoing_buffers = []
+
+        self.close_sent = False
+        self.close_received = False
+
+    def feed(self, data):
+        """Gives bytes received from the connection and returns a list of
+        ProtocolEvent for the frames completed by them. Bytes following a
+        close frame are ignored.
+
+        Raises:
+            InvalidFrameException: when a frame contains invalid data.
+            InvalidUTF8Exception: when a text message is invalid UTF-8.
+            MessageTooBigException: when a frame or message exceeds the
+                limits in the options.
+            UnsupportedFrameException: when a frame has reserved bits or an
+                opcode we cannot handle.
+            The connection should be failed when any of them is raised.
+        """
+
+        if self.close_received:
+            return []
+
+        parser = self._frame_parser
+        parser.feed(data)
+        events = []
+        while not self.close_received:
+            frame = parser.next_frame()
+            if frame is None:
+                break
+            self._filter_received_frame(frame)
+            event = self._get_event_from_frame(frame)
+            if event is not None:
+                events.append(event)
+        return events
+
+    def _get_event_from_frame(self, frame):
+        opcode = frame.opcode
+        if common.is_control_opcode(opcode):
+            if not frame.fin:
+                raise InvalidFrameException(
+                    'Control frames must not be fragmented')
+            return self._get_event_from_control_frame(frame)
+
+        if (opcode != common.OPCODE_CONTINUATION and
+            opcode != common.OPCODE_TEXT and
+            opcode != common.OPCODE_BINARY):
+            raise UnsupportedFrameException(
+                'Opcode %d is not supported' % opcode)
+
+        if self._receive_fragments:
+            return self._get_fragment_event_from_frame(frame)
+
+        message = self._get_message_from_frame(frame)
+        if message is None:
+            return None
+        return ProtocolEvent(
+            EVENT_MESSAGE, message,
+            binary=self._original_opcode == common.OPCODE_BINARY)
+
+    def _get_fragment_event_from_frame(self, frame):
+        if frame.opcode == common.OPCODE_CONTINUATION:
+            if self._fragment_opcode is None:
+                raise InvalidFrameException(
+                    'Received a continuation frame but fragmentation not '
+                    'started')
+            received_size = self._check_message_size(
+                self._received_fragments_size, frame)
+        else:
+            if self._fragment_opcode is not None:
+                raise InvalidFrameException(
+                    'New fragmentation started without terminating '
+                    'existing fragmentation')
+            self._fragment_opcode = frame.opcode
+            self._start_message(frame.opcode)
+            received_size = self._check_message_size(0, frame)
+
+        binary = self._fragment_opcode == common.OPCODE_BINARY
+        if frame.fin:
+            self._fragment_opcode = None
+            self._received_fragments_size = 0
+        else:
+            self._received_fragments_size = received_size
+
+        return ProtocolEvent(
+            EVENT_FRAGMENT,
+            self._process_message_fragment(frame.payload, frame.fin),
+            binary=binary, end=bool(frame.fin))
+
+    def _get_event_from_control_frame(self, frame):
+        opcode = frame.opcode
+        if opcode == common.OPCODE_PING:
+            self.send_pong(frame.payload)
+            return ProtocolEvent(EVENT_PING, frame.payload)
+        elif opcode == common.OPCODE_PONG:
+            return ProtocolEvent(EVENT_PONG, frame.payload)
+        elif opcode == common.OPCODE_CLOSE:
+            code, reason = _parse_closing_handshake_body(frame.payload)
+            self.close_received = True
+            if self._echo_close and not self.close_sent:
+                # Echo the status code as RFC 6455 section 5.5.1 suggests.
+                if code == common.STATUS_NO_STATUS_RECEIVED:
+                    self.send_close(None)
+                else:
+                    self.send_close(code)
+            return ProtocolEvent(EVENT_CLOSE, code=code, reason=reason)
+        raise UnsupportedFrameException(
+            'Opcode %d is not supported' % opcode)
+
+    def send_message(self, message, end=True, binary=False):
+        """Queues frames of a message to send. See Stream.send_message for
+        the arguments.
+
+        Raises:
+            BadOperationException: when called after sending a close frame
+                or called with inconsistent message type or binary
+                parameter.
+        """
+
+        if self.close_sent:
+            raise BadOperationException(
+                'Requested send_message after sending out a closing '
+                'handshake')
+
+        self._outgoing_buffers.extend(
+            self._build_message_buffers(message, end, binary))
+
+    def send_messages(self, messages, binary=False):
+        """Queues frames of messages to send. See Stream.send_messages for
+        the arguments.
+
+        Raises:
+            BadOperationException: when called after sending a close frame
+                or called with inconsistent message type or binary
+                parameter. No message is queued then.
+        """
+
+        if self.close_sent:
+            raise BadOperationException(
+                'Requested send_messages after sending out a closing '
+                'handshake')
+
+        for message in self._check_message_types(messages, binary):
+            self._outgoing_buffers.extend(
+                self._build_message_buffers(message, True, binary))
+
+    def send_ping(self, body=''):
+        """Queues a ping frame to send."""
+
+        self._outgoing_buffers.append(create_ping_frame(
+            body, self._options.mask_send,
+            self._options.outgoing_frame_filters))
+
+    def send_pong(self, body=''):
+        """Queues a pong frame to send."""
+
+        self._outgoing_buffers.append(create_pong_frame(
+            body, self._options.mask_send,
+            self._options.outgoing_frame_filters))
+
+    def send_close(self, code=common.STATUS_NORMAL_CLOSURE, reason=''):
+        """Queues a close frame to send. Nothing can be sent after it. The
+        connection can be closed when the close frame is written and
+        close_received is True.
+
+        Raises:
+            BadOperationException: when called after sending a close frame
+                or with an invalid code.
+        """
+
+        if self.close_sent:
+            raise BadOperationException('Closing handshake already sent')
+
+        body = create_closing_handshake_body(code, reason)
+        self._outgoing_buffers.append(create_close_frame(
+            body, self._options.mask_send,
+            self._options.outgoing_frame_filters))
+        self.close_sent = True
+
+    def data_to_send(self):
+        """Returns the bytes queued to send, and clears the queue."""
+
+        buffers = self._outgoing_buffers
+        if not buffers:
+            return ''
+        self._outgoing_buffers = []
+        return ''.join([str(buffer_) for buffer_ in buffers])
+
+
+class Stream(StreamBase, _MessageCodec):
+    """A class for parsing/building frames of the WebSocket protocol
+    (RFC 6455).
+    """
+
+    def __init__(self, request, options):
+        """Constructs an instance.
+
+        Args:
+            request: mod_python request.
+        """
+
+        StreamBase.__init__(self, request)
+
+        self._logger = util.get_class_logger(self)
+
+        _MessageCodec.__init__(self, options, request.ws_version)
+
+        self._request.client_terminated = False
+        self._request.server_terminated = False
+
+        # Holds (body, time sent) of pings waiting for a pong.
+        self._ping_queue = deque()
+        # Protects _ping_queue, which the keepalive scheduler also uses.
+        self._ping_queue_lock = threading.Lock()
+        self._last_receive_time = time.time()
+        # The time when the handler thread started waiting for frames from
+        # the connection, or None when it is not waiting. Only while it is
+        # waiting, pongs to keepalive pings are read.
+        self._receive_start_time = None
+        self._keepalive_ping_count = 0
+        # Set when the connection is no longer used. Stops the keepalive
+        # timer so that the scheduler releases the stream.
+        self._keepalive_stopped = False
+
+        # Smoothed round-trip time in seconds measured by ping and pong.
+        self._request.ws_rtt = None
+
+        if self._options.cork_flush_delay is not None:
+            self.enable_cork(self._options.cork_flush_threshold,
+                             self._options.cork_flush_delay)
+
+        if self._options.keepalive_interval is not None:
+            # Pings are written by the keepalive scheduler thread. The cork
+            # lock or the write lock serializes them with the writes of the
+            # handler thread.
+            if self._cork_lock is None:
+                self._write_lock = threading.Lock()
+            _get_keepalive_scheduler().schedule(
+                self._last_receive_time + self._options.keepalive_interval,
+                self)
+
+    def _receive_frame_as_frame_object(self):
+        """Receives a frame and returns it as a Frame object.
+
+        Raises:
+            ConnectionTerminatedException: when read returns empty
+                string.
+            InvalidFrameException: when the frame contains invalid data.
+        """
+
+        parser = self._frame_parser
+        frame = parser.next_frame()
+        if frame is not None:
+            return frame
+
+        self._receive_start_time = time.time()
+        try:
+            while frame is None:
+                parser.feed(self._receive_some(parser.bytes_needed()))
+                frame = parser.next_frame()
+        except ConnectionTerminatedException:
+            # The connection is broken, possibly without a closing
+            # handshake. Don't ping it any more.
+            self.stop_keepalive()
+            raise
+        finally:
+            self._receive_start_time = None
+        return frame
+
+    def receive_filtered_frame(self):
+        """Receives a frame and applies frame filters and message filters.
+        The frame to be received must satisfy following conditions:
+        - The frame is not fragmented.
+        - The opcode of the frame is TEXT or BINARY.
+
+        DO NOT USE this method except for testing purpose.
+        """
+
+        frame = self._receive_frame_as_frame_object()
+        if not frame.fin:
+            raise InvalidFrameException(
+                'Segmented frames must not be received via '
+                'receive_filtered_frame()')
+        if (frame.opcode != common.OPCODE_TEXT and
+            frame.opcode != common.OPCODE_BINARY):
+            raise InvalidFrameException(
+                'Control frames must not be received via '
+                'receive_filtered_frame()')
+
+        if self._filter_incoming_frame is not None:
+            self._filter_incoming_frame(frame)
+        if self._filter_incoming_message is not None:
+            frame.payload = self._filter_incoming_message(frame.payload)
+        return frame
+
+    def send_message(self, message, end=True, binary=False):
+        """Send message.
+
+        Args:
+            message: text in unicode or binary in str to send. A list of them
+                can also be given to send them as one frame without
+                concatenating them. Text in str is taken as encoded in
+                UTF-8.
+            binary: send message as binary frame.
+
+        Raises:
+            BadOperationException: when called on a server-terminated
+                connection or called with inconsistent message type or
+                binary parameter.
+        """
+
+        if self._request.server_terminated:
+            raise BadOperationException(
+                'Requested send_message after sending out a closing handshake')
+
+        self._write_buffers(self._build_message_buffers(message, end, binary))
+
+    def send_messages(self, messages, binary=False):
+        """Send messages at once. Frames for all of the messages are built
+        first and then written to the connection by one write call. This is
+        useful for sending many small messages.
+
+        Args:
+            messages: an iterable of messages. Each of them is sent as a
+                complete message in the same way as send_message() with
+                end=True.
+            binary: send messages as binary frames.
+
+        Raises:
+            BadOperationException: when called on a server-terminated
+                connection or called with inconsistent message type or
+                binary parameter. No message is sent then.
+        """
+
+        if self._request.server_terminated:
+            raise BadOperationException(
+                'Requested send_messages after sending out a closing '
+                'handshake')
+
+        buffers = []
+        for message in self._check_message_types(messages, binary):
+            buffers.extend(self._build_message_buffers(message, True, binary))
+        if buffers:
+            self._write(''.join([str(buffer_) for buffer_ in buffers]))
+
+    def send_prepared(self, prepared_message):
+        """Send a PreparedMessage. The frames are built only if no stream
+        with the same configuration has sent the message before.
+
+        Raises:
+            BadOperationException: when called on a server-terminated
+                connection or called while sending a fragmented message.
+        """
+
+        if self._request.server_terminated:
+            raise BadOperationException(
+                'Requested send_prepared after sending out a closing '
+                'handshake')
+
+        key = self._get_prepared_message_key()
+        if key is None:
+            self.send_message(
+                prepared_message.message, binary=prepared_message.binary)
+            return
+
+        frames = prepared_message._frames.get(key)
+        if frames is None:
+            frames = ''.join([
+                str(buffer_) for buffer_ in self._build_message_buffers(
+                    prepared_message.message, True, prepared_message.binary)])
+            prepared_message._frames[key] = frames
+        self._write(frames)
+
+    def _get_prepared_message_key(self):
+        """Returns a hashable value which determines the frames built by this
+        stream for a complete message, or None if they may differ from ones
+        built by other streams with the same value.
+        """
+
+        if self._options.mask_send or self._writer._started:
+            return None
+
+        key = [self._options.encode_text_message_to_utf8]
+        max_payload_size = self._options.outgoing_max_frame_payload_size
+        if max_payload_size is not None and max_payload_size > 0:
+            key.append(max_payload_size)
+        else:
+            key.append(None)
+
+        for filter_ in (self._options.outgoing_message_filters +
+                        self._options.outgoing_frame_filters):
+            get_key = getattr(filter_, 'get_prepared_message_key', None)
+            if get_key is None:
+                return None
+            filter_key = get_key()
+            if filter_key is None:
+                return None
+            key.append(filter_key)
+        return tuple(key)
+
+    def set_outgoing_max_frame_payload_size(self, size):
+        """Sets the maximum size of payload data of each frame sent on this
+        connection. Messages larger than it are fragmented. None or a
+        non-positive integer means no limit.
+        """
+
+        self._options.outgoing_max_frame_payload_size = size
+
+    def _process_close_message(self, message):
+        """Processes close message.
+
+        Args:
+            message: close message.
+
+        Raises:
+            InvalidFrameException: when the message is invalid.
+        """
+
+        self._request.client_terminated = True
+
+        code, reason = _parse_closing_handshake_body(message)
+        self._request.ws_close_code = code
+        if reason is None:
+            self._logger.debug('Received close frame (empty body)')
+        else:
+            self._request.ws_close_reason = reason
+            self._logger.debug(
+                'Received close frame (code=%d, reason=%r)', code, reason)
+
+        # As we've received a close frame, no more data is coming over the
+        # socket. We can now safely close the socket without worrying about
+        # RST sending.
+
+        if self._request.server_terminated:
+            self._logger.debug(
+                'Received ack for server-initiated closing handshake')
+            return
 
         self._logger.debug(
             'Received client-initiated closing handshake')
@@ -688,28 +1879,31 @@ class Stream(StreamBase):
             message: pong message.
         """
 
-        # TODO(tyoshino): Add ping timeout handling.
-
         inflight_pings = deque()
 
-        while True:
-            try:
-                expected_body = self._ping_queue.popleft()
-                if expected_body == message:
-                    # inflight_pings contains pings ignored by the
-                    # other peer. Just forget them.
-                    self._logger.debug(
-                        'Ping %r is acked (%d pings were ignored)',
-                        expected_body, len(inflight_pings))
+        self._ping_queue_lock.acquire()
+        try:
+            while True:
+                try:
+                    expected_body, sent_time = self._ping_queue.popleft()
+                    if expected_body == message:
+                        # inflight_pings contains pings ignored by the
+                        # other peer. Just forget them.
+                        self._logger.debug(
+                            'Ping %r is acked (%d pings were ignored)',
+                            expected_body, len(inflight_pings))
+                        self._update_rtt(time.time() - sent_time)
+                        break
+                    else:
+                        inflight_pings.append((expected_body, sent_time))
+                except IndexError, e:
+                    # The received pong was unsolicited pong. Keep the
+                    # ping queue as is.
+                    self._ping_queue = inflight_pings
+                    self._logger.debug('Received a unsolicited pong')
                     break
-                else:
-                    inflight_pings.append(expected_body)
-            except IndexError, e:
-                # The received pong was unsolicited pong. Keep the
-                # ping queue as is.
-                self._ping_queue = inflight_pings
-                self._logger.debug('Received a unsolicited pong')
-                break
+        finally:
+            self._ping_queue_lock.release()
 
         try:
             handler = self._request.on_pong_handler
@@ -718,6 +1912,44 @@ class Stream(StreamBase):
         except AttributeError, e:
             pass
 
+    def _receive_and_filter_frame(self):
+        """Receives a frame, checks it and applies the incoming frame filters
+        to it.
+
+        Raises:
+            InvalidFrameException: when the frame contains invalid data.
+            UnsupportedFrameException: when the frame has reserved bits set
+                after applying the incoming frame filters.
+        """
+
+        frame = self._receive_frame_as_frame_object()
+        self._last_receive_time = time.time()
+        self._filter_received_frame(frame)
+        return frame
+
+    def _process_control_frame(self, frame):
+        """Processes a control frame received by receive_message_stream().
+
+        Returns:
+            True iff the frame was a closing handshake.
+        """
+
+        if not frame.fin:
+            raise InvalidFrameException(
+                'Control frames must not be fragmented')
+
+        if frame.opcode == common.OPCODE_CLOSE:
+            self._process_close_message(frame.payload)
+            return True
+        elif frame.opcode == common.OPCODE_PING:
+            self._process_ping_message(frame.payload)
+        elif frame.opcode == common.OPCODE_PONG:
+            self._process_pong_message(frame.payload)
+        else:
+            raise UnsupportedFrameException(
+                'Opcode %d is not supported' % frame.opcode)
+        return False
+
     def receive_message(self):
         """Receive a WebSocket frame and return its payload as a text in
         unicode or a binary in str.
@@ -748,41 +1980,15 @@ class Stream(StreamBase):
             # mp_conn.read will block if no bytes are available.
             # Timeout is controlled by TimeOut directive of Apache.
 
-            frame = self._receive_frame_as_frame_object()
-
-            # Check the constraint on the payload size for control frames
-            # before extension processes the frame.
-            # See also http://tools.ietf.org/html/rfc6455#section-5.5
-            if (common.is_control_opcode(frame.opcode) and
-                len(frame.payload) > 125):
-                raise InvalidFrameException(
-                    'Payload data size of control frames must be 125 bytes or '
-                    'less')
-
-            for frame_filter in self._options.incoming_frame_filters:
-                frame_filter.filter(frame)
-
-            if frame.rsv1 or frame.rsv2 or frame.rsv3:
-                raise UnsupportedFrameException(
-                    'Unsupported flag is set (rsv = %d%d%d)' %
-                    (frame.rsv1, frame.rsv2, frame.rsv3))
+            frame = self._receive_and_filter_frame()
 
+            # Data messages are filtered and decoded fragment by fragment.
             message = self._get_message_from_frame(frame)
             if message is None:
                 continue
 
-            for message_filter in self._options.incoming_message_filters:
-                message = message_filter.filter(message)
-
-            if self._original_opcode == common.OPCODE_TEXT:
-                # The WebSocket protocol section 4.4 specifies that invalid
-                # characters must be replaced with U+fffd REPLACEMENT
-                # CHARACTER.
-                try:
-                    return message.decode('utf-8')
-                except UnicodeDecodeError, e:
-                    raise InvalidUTF8Exception(e)
-            elif self._original_opcode == common.OPCODE_BINARY:
+            if (self._original_opcode == common.OPCODE_TEXT or
+                self._original_opcode == common.OPCODE_BINARY):
                 return message
             elif self._original_opcode == common.OPCODE_CLOSE:
                 self._process_close_message(message)
@@ -795,6 +2001,89 @@ class Stream(StreamBase):
                 raise UnsupportedFrameException(
                     'Opcode %d is not supported' % self._original_opcode)
 
+    def receive_message_stream(self):
+        """Receive a WebSocket message and return an iterator over its
+        payload instead of the whole payload.
+
+        Each chunk is yielded as soon as the frame carrying it arrives, so
+        a message fragmented into many frames is never reassembled in
+        memory. Incoming message filters (e.g. permessage-deflate) are
+        applied incrementally. Control frames interleaved with the
+        fragments are processed as receive_message() does.
+
+        The returned iterator must be exhausted before calling
+        receive_message() or receive_message_stream() again.
+
+        Returns:
+            an iterator yielding
+            - unicode instances if receiving a text message
+            - str instances if receiving a binary message
+            or None iff received closing handshake.
+        Raises:
+            Same as receive_message(). Errors found in the second or later
+            frames of the message are raised from the iterator. If a closing
+            handshake is received in the middle of the message, the iterator
+            raises ConnectionTerminatedException.
+        """
+
+        if self._request.client_terminated:
+            raise BadOperationException(
+                'Requested receive_message_stream after receiving a closing '
+                'handshake')
+
+        while True:
+            frame = self._receive_and_filter_frame()
+
+            if common.is_control_opcode(frame.opcode):
+                self._original_opcode = frame.opcode
+                if self._process_control_frame(frame):
+                    return None
+                continue
+
+            if frame.opcode == common.OPCODE_CONTINUATION:
+                raise InvalidFrameException(
+                    'Received a continuation frame but fragmentation not '
+                    'started')
+            if (frame.opcode != common.OPCODE_TEXT and
+                frame.opcode != common.OPCODE_BINARY):
+                raise UnsupportedFrameException(
+                    'Opcode %d is not supported' % frame.opcode)
+
+            self._original_opcode = frame.opcode
+            return self._iterate_message_payload(frame)
+
+    def _iterate_message_payload(self, frame):
+        """Yields the payload of the message starting with the given frame
+        and reads the following fragments until the last one.
+        """
+
+        self._start_message(frame.opcode)
+
+        received_size = 0
+        while True:
+            received_size = self._check_message_size(received_size, frame)
+
+            payload = self._process_message_fragment(frame.payload, frame.fin)
+            if payload:
+                yield payload
+
+            if frame.fin:
+                return
+
+            while True:
+                frame = self._receive_and_filter_frame()
+                if not common.is_control_opcode(frame.opcode):
+                    break
+                if self._process_control_frame(frame):
+                    raise ConnectionTerminatedException(
+                        'Received a closing handshake in the middle of a '
+                        'fragmented message')
+
+            if frame.opcode != common.OPCODE_CONTINUATION:
+                raise InvalidFrameException(
+                    'New fragmentation started without terminating existing '
+                    'fragmentation')
+
     def _send_closing_handshake(self, code, reason):
         body = create_closing_handshake_body(code, reason)
         frame = create_close_frame(
@@ -804,6 +2093,8 @@ class Stream(StreamBase):
         self._request.server_terminated = True
 
         self._write(frame)
+        # Nothing is sent after a close frame. Don't keep it in the buffer.
+        self.flush()
 
     def close_connection(self, code=common.STATUS_NORMAL_CLOSURE, reason='',
                          wait_response=True):
@@ -847,11 +2138,13 @@ class Stream(StreamBase):
             code, reason)
 
         if (code == common.STATUS_GOING_AWAY or
-            code == common.STATUS_PROTOCOL_ERROR) or not wait_response:
+            code == common.STATUS_PROTOCOL_ERROR or
+            code == common.STATUS_MESSAGE_TOO_BIG) or not wait_response:
             # It doesn't make sense to wait for a close frame if the reason is
-            # protocol error or that the server is going away. For some of
-            # other reasons, it might not make sense to wait for a close frame,
-            # but it's not clear, yet.
+            # protocol error or that the server is going away. A too big
+            # message is left unread, so we cannot find the close frame. For
+            # some of other reasons, it might not make sense to wait for a
+            # close frame, but it's not clear, yet.
             return
 
         # TODO(ukai): 2. wait until the /client terminated/ flag has been set,
@@ -873,7 +2166,11 @@ class Stream(StreamBase):
             self._options.outgoing_frame_filters)
         self._write(frame)
 
-        self._ping_queue.append(body)
+        self._ping_queue_lock.acquire()
+        try:
+            self._ping_queue.append((body, time.time()))
+        finally:
+            self._ping_queue_lock.release()
 
     def _send_pong(self, body):
         frame = create_pong_frame(
@@ -882,6 +2179,114 @@ class Stream(StreamBase):
             self._options.outgoing_frame_filters)
         self._write(frame)
 
+    def _update_rtt(self, sample):
+        """Updates the smoothed round-trip time with a new sample."""
+
+        rtt = self._request.ws_rtt
+        if rtt is None:
+            self._request.ws_rtt = sample
+        else:
+            self._request.ws_rtt = rtt + _RTT_ALPHA * (sample - rtt)
+
+    def _on_keepalive_timer(self, now):
+        """Called by _KeepaliveScheduler. Fails the connection if a ping has
+        not been acknowledged in time, and sends a ping if nothing has been
+        received for the keepalive interval.
+
+        Time passes for both only while the handler thread is waiting for
+        frames, since pongs can't be read otherwise. Send-only handlers and
+        handlers busy with other work are never failed by keepalive.
+
+        The ping is written under the lock serializing writes, and is
+        skipped while the handler thread holds it. So it never interleaves
+        with frames written by the handler. The handler thread may be
+        reading the connection meanwhile. This is the use of one reading and
+        one writing thread which msgutil.MessageReceiver also makes. It is
+        safe for TLS connections of the ssl module. pyOpenSSL doesn't allow
+        it, so the standalone server doesn't enable keepalive with it.
+
+        Returns:
+            The time to call this method next, or None to stop.
+        """
+
+        if (self._keepalive_stopped or
+            self._request.server_terminated or
+            self._request.client_terminated):
+            return None
+
+        receive_start_time = self._receive_start_time
+        if receive_start_time is None:
+            return now + self._options.keepalive_interval
+
+        self._ping_queue_lock.acquire()
+        try:
+            if self._ping_queue:
+                oldest_ping_time = self._ping_queue[0][1]
+            else:
+                oldest_ping_time = None
+        finally:
+            self._ping_queue_lock.release()
+
+        if oldest_ping_time is not None:
+            deadline = (max(oldest_ping_time, receive_start_time) +
+                        self._options.keepalive_timeout)
+            if deadline > now:
+                return deadline
+            self._fail_on_ping_timeout()
+            return None
+
+        deadline = (max(self._last_receive_time, receive_start_time) +
+                    self._options.keepalive_interval)
+        if deadline > now:
+            return deadline
+
+        body = 'keepalive %d' % self._keepalive_ping_count
+        frame = create_ping_frame(
+            body,
+            self._options.mask_send,
+            self._options.outgoing_frame_filters)
+        # Register the ping first so that a quick pong finds it.
+        self._ping_queue_lock.acquire()
+        try:
+            self._ping_queue.append((body, now))
+        finally:
+            self._ping_queue_lock.release()
+        if not self._try_write_now(frame):
+            # The handler is writing. Retry after the interval.
+            self._ping_queue_lock.acquire()
+            try:
+                self._ping_queue.pop()
+            finally:
+                self._ping_queue_lock.release()
+            return now + self._options.keepalive_interval
+        self._keepalive_ping_count += 1
+        return now + self._options.keepalive_timeout
+
+    def stop_keepalive(self):
+        """Overrides StreamBase.stop_keepalive. The keepalive scheduler drops
+        the stream when its timer fires next.
+        """
+
+        self._keepalive_stopped = True
+
+    def _fail_on_ping_timeout(self):
+        """Fails the connection as no pong came back. Shutting down the
+        connection makes the handler thread's read and write fail.
+        """
+
+        self._logger.info(
+            'No pong from %r in %r seconds. Failing the connection',
+            self._request.connection.remote_addr,
+            self._options.keepalive_timeout)
+
+        shutdown = getattr(self._request.connection, 'shutdown', None)
+        if shutdown is None:
+            self._logger.warning(
+                'The connection cannot be shut down. Keepalive timeout is '
+                'ignored')
+            return
+        shutdown()
+
     def get_last_received_opcode(self):
         """Returns the opcode of the WebSocket message which the last received
         frame belongs to. The return value is valid iff immediately after
@@ -33,6 +33,7 @@
 
 
 from mod_pywebsocket import http_header_util
+from mod_pywebsocket import util
 
 
 # Additional log level definitions.
@@ -144,6 +145,7 @@ STATUS_MANDATORY_EXT = STATUS_MANDATORY_EXTENSION
 HTTP_STATUS_BAD_REQUEST = 400
 HTTP_STATUS_FORBIDDEN = 403
 HTTP_STATUS_NOT_FOUND = 404
+HTTP_STATUS_SERVICE_UNAVAILABLE = 503
 
 
 def is_control_opcode(opcode):
@@ -249,12 +251,51 @@ def _parse_extension(state):
     return extension
 
 
+# Maximum number of distinct Sec-WebSocket-Extensions header values whose
+# parse results parse_extensions keeps.
+_EXTENSIONS_CACHE_SIZE = 128
+
+# Maps a header value to a tuple of (extension name, parameter tuple) pairs,
+# or to the message of the ExtensionParsingException it raised.
+_extensions_cache = util.LRUCache(_EXTENSIONS_CACHE_SIZE)
+
+
 def parse_extensions(data):
     """Parse Sec-WebSocket-Extensions header value.
 
     Returns a list of ExtensionParameter objects.
     Leading LWSes must be trimmed.
+
+    Results are memoized per header value since clients of the same kind
+    send the same header. New ExtensionParameter objects are returned on
+    every call so that callers may modify them.
     """
+
+    cached = _extensions_cache.get(data)
+    if cached is None:
+        try:
+            extension_list = _parse_extensions(data)
+        except ExtensionParsingException, e:
+            _extensions_cache.put(data, str(e))
+            raise
+        _extensions_cache.put(
+            data,
+            tuple([(extension.name(), tuple(extension.get_parameters()))
+                   for extension in extension_list]))
+        return extension_list
+
+    if isinstance(cached, str):
+        raise ExtensionParsingException(cached)
+
+    extension_list = []
+    for name, parameters in cached:
+        extension = ExtensionParameter(name)
+        extension._parameters = list(parameters)
+        extension_list.append(extension)
+    return extension_list
+
+
+def _parse_extensions(data):
     state = http_header_util.ParsingState(data)
 
     extension_list = []
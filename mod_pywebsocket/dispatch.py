@@ -50,6 +50,9 @@ _DO_EXTRA_HANDSHAKE_HANDLER_NAME = 'web_socket_do_extra_handshake'
 _TRANSFER_DATA_HANDLER_NAME = 'web_socket_transfer_data'
 _PASSIVE_CLOSING_HANDSHAKE_HANDLER_NAME = (
     'web_socket_passive_closing_handshake')
+_ON_OPEN_HANDLER_NAME = 'web_socket_on_open'
+_ON_MESSAGE_HANDLER_NAME = 'web_socket_on_message'
+_ON_CLOSE_HANDLER_NAME = 'web_socket_on_close'
 
 
 class DispatchException(Exception):
@@ -66,6 +69,28 @@ def _default_passive_closing_handshake_handler(request):
     return common.STATUS_NORMAL_CLOSURE, ''
 
 
+def _create_transfer_data_handler(on_open, on_message, on_close):
+    """Creates a web_socket_transfer_data handler which receives messages
+    and calls the given web_socket_on_* handlers, so that handlers written
+    for the event loop server mode also run on threads.
+    """
+
+    def transfer_data(request):
+        if on_open is not None:
+            on_open(request)
+        try:
+            while True:
+                message = request.ws_stream.receive_message()
+                if message is None:
+                    return
+                on_message(request, message)
+        finally:
+            if on_close is not None:
+                on_close(request)
+
+    return transfer_data
+
+
 def _normalize_path(path):
     """Normalize path.
 
@@ -127,10 +152,16 @@ class _HandlerSuite(object):
     """A handler suite holder class."""
 
     def __init__(self, do_extra_handshake, transfer_data,
-                 passive_closing_handshake):
+                 passive_closing_handshake, on_open=None, on_message=None,
+                 on_close=None):
         self.do_extra_handshake = do_extra_handshake
         self.transfer_data = transfer_data
         self.passive_closing_handshake = passive_closing_handshake
+        # Handlers called by the event loop server mode. on_message is None
+        # if the handler doesn't support the mode.
+        self.on_open = on_open
+        self.on_message = on_message
+        self.on_close = on_close
 
 
 def _source_handler_file(handler_definition):
@@ -154,10 +185,28 @@ def _source_handler_file(handler_definition):
     except Exception:
         passive_closing_handshake_handler = (
             _default_passive_closing_handshake_handler)
+    do_extra_handshake_handler = _extract_handler(
+        global_dic, _DO_EXTRA_HANDSHAKE_HANDLER_NAME)
+    on_open_handler = _extract_optional_handler(
+        global_dic, _ON_OPEN_HANDLER_NAME)
+    on_message_handler = _extract_optional_handler(
+        global_dic, _ON_MESSAGE_HANDLER_NAME)
+    on_close_handler = _extract_optional_handler(
+        global_dic, _ON_CLOSE_HANDLER_NAME)
+    if (on_message_handler is not None and
+        _TRANSFER_DATA_HANDLER_NAME not in global_dic):
+        transfer_data_handler = _create_transfer_data_handler(
+            on_open_handler, on_message_handler, on_close_handler)
+    else:
+        transfer_data_handler = _extract_handler(
+            global_dic, _TRANSFER_DATA_HANDLER_NAME)
     return _HandlerSuite(
-        _extract_handler(global_dic, _DO_EXTRA_HANDSHAKE_HANDLER_NAME),
-        _extract_handler(global_dic, _TRANSFER_DATA_HANDLER_NAME),
-        passive_closing_handshake_handler)
+        do_extra_handshake_handler,
+        transfer_data_handler,
+        passive_closing_handshake_handler,
+        on_open_handler,
+        on_message_handler,
+        on_close_handler)
 
 
 def _extract_handler(dic, name):
@@ -173,6 +222,16 @@ def _extract_handler(dic, name):
     return handler
 
 
+def _extract_optional_handler(dic, name):
+    """Same as _extract_handler but returns None if dic doesn't have the
+    specified name.
+    """
+
+    if name not in dic:
+        return None
+    return _extract_handler(dic, name)
+
+
 class Dispatcher(object):
     """Dispatches WebSocket requests.
 
@@ -315,6 +374,10 @@ class Dispatcher(object):
             self._logger.debug('%s', e)
             request.ws_stream.close_connection(
                 common.STATUS_INVALID_FRAME_PAYLOAD_DATA)
+        except stream.MessageTooBigException, e:
+            self._logger.debug('%s', e)
+            request.ws_stream.close_connection(
+                common.STATUS_MESSAGE_TOO_BIG)
         except msgutil.ConnectionTerminatedException, e:
             self._logger.debug('%s', e)
         except Exception, e:
@@ -325,6 +388,11 @@ class Dispatcher(object):
                     _TRANSFER_DATA_HANDLER_NAME, request.ws_resource),
                 e)
             raise
+        finally:
+            # Stop keepalive pings on the connection, which is no longer
+            # used. This also covers connections dropped without a closing
+            # handshake.
+            request.ws_stream.stop_keepalive()
 
     def passive_closing_handshake(self, request):
         """Prepare code and reason for responding client initiated closing
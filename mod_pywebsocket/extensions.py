@@ -30,6 +30,7 @@
 
 from mod_pywebsocket import common
 from mod_pywebsocket import util
+from mod_pywebsocket._stream_base import MessageTooBigException
 from mod_pywebsocket.http_header_util import quote_if_necessary
 
 
@@ -37,6 +38,17 @@ from mod_pywebsocket.http_header_util import quote_if_necessary
 _available_processors = {}
 _compression_extension_names = []
 
+# Maximum number of permessage-deflate negotiation results kept by
+# PerMessageDeflateExtensionProcessor.
+_PER_MESSAGE_DEFLATE_NEGOTIATION_CACHE_SIZE = 64
+
+_per_message_deflate_negotiation_cache = util.LRUCache(
+    _PER_MESSAGE_DEFLATE_NEGOTIATION_CACHE_SIZE)
+
+# Marks a missing entry in the negotiation cache. None can't be used since it
+# is cached for rejected offers.
+_NOT_CACHED = object()
+
 
 class ExtensionProcessorInterface(object):
 
@@ -122,11 +134,36 @@ def _parse_window_bits(bits):
     return int_bits
 
 
+def _inflate_with_limit(inflater, bytes, max_size, decompressed_size=0,
+                        end=True):
+    """Decompresses bytes using inflater without producing more than
+    max_size bytes in total, counting decompressed_size bytes already
+    produced for the same message. None for max_size means no limit.
+
+    Raises:
+        MessageTooBigException: when the decompressed data exceeds max_size.
+    """
+
+    if max_size is None:
+        return inflater.filter(bytes, end=end)
+
+    # Ask for one more byte than allowed to detect overflow without
+    # inflating the whole payload.
+    data = inflater.filter(
+        bytes, end=end, size=max_size - decompressed_size + 1)
+    if decompressed_size + len(data) > max_size:
+        raise MessageTooBigException(
+            'Decompressed size exceeds the limit %d' % max_size)
+    return data
+
+
 class _AverageRatioCalculator(object):
     """Stores total bytes of original and result data, and calculates average
     result / original ratio.
     """
 
+    __slots__ = ('_total_original_bytes', '_total_result_bytes')
+
     def __init__(self):
         self._total_original_bytes = 0
         self._total_result_bytes = 0
@@ -145,6 +182,89 @@ class _AverageRatioCalculator(object):
             return float('inf')
 
 
+# Filters are defined at the module level rather than in
+# setup_stream_options so that class objects are not created for each
+# connection. They have __slots__ as instances are created for each
+# connection. Stateless filters set their filter attribute to the method of
+# the parent so that the filter pipeline compiled by the stream calls the
+# parent directly.
+
+
+class _DeflateFrameOutgoingFilter(object):
+
+    __slots__ = ('filter',)
+
+    def __init__(self, parent):
+        self.filter = parent._outgoing_filter
+
+
+class _DeflateFrameIncomingFilter(object):
+
+    __slots__ = ('filter',)
+
+    def __init__(self, parent):
+        self.filter = parent._incoming_filter
+
+
+class _PerMessageDeflateOutgoingMessageFilter(object):
+
+    __slots__ = ('_parent', 'filter')
+
+    def __init__(self, parent):
+        self._parent = parent
+        self.filter = parent._process_outgoing_message
+
+    def get_prepared_message_key(self):
+        return self._parent._get_prepared_message_key()
+
+
+class _PerMessageDeflateIncomingMessageFilter(object):
+
+    __slots__ = ('_parent', '_decompress_next_message')
+
+    def __init__(self, parent):
+        self._parent = parent
+        self._decompress_next_message = False
+
+    def decompress_next_message(self):
+        self._decompress_next_message = True
+
+    def filter(self, message, end=True):
+        message = self._parent._process_incoming_message(
+            message, self._decompress_next_message, end)
+        if end:
+            self._decompress_next_message = False
+        return message
+
+
+class _PerMessageDeflateOutgoingFrameFilter(object):
+
+    __slots__ = ('_parent', '_set_compression_bit')
+
+    def __init__(self, parent):
+        self._parent = parent
+        self._set_compression_bit = False
+
+    def set_compression_bit(self):
+        self._set_compression_bit = True
+
+    def filter(self, frame):
+        self._parent._process_outgoing_frame(
+            frame, self._set_compression_bit)
+        self._set_compression_bit = False
+
+    def get_prepared_message_key(self):
+        return self._parent._get_prepared_message_key()
+
+
+class _PerMessageDeflateIncomingFrameFilter(object):
+
+    __slots__ = ('filter',)
+
+    def __init__(self, parent):
+        self.filter = parent._process_incoming_frame
+
+
 class DeflateFrameExtensionProcessor(ExtensionProcessorInterface):
     """deflate-frame extension processor.
 
@@ -224,27 +344,12 @@ class DeflateFrameExtensionProcessor(ExtensionProcessorInterface):
         return response
 
     def _setup_stream_options_internal(self, stream_options):
-
-        class _OutgoingFilter(object):
-
-            def __init__(self, parent):
-                self._parent = parent
-
-            def filter(self, frame):
-                self._parent._outgoing_filter(frame)
-
-        class _IncomingFilter(object):
-
-            def __init__(self, parent):
-                self._parent = parent
-
-            def filter(self, frame):
-                self._parent._incoming_filter(frame)
+        self._stream_options = stream_options
 
         stream_options.outgoing_frame_filters.append(
-            _OutgoingFilter(self))
+            _DeflateFrameOutgoingFilter(self))
         stream_options.incoming_frame_filters.insert(
-            0, _IncomingFilter(self))
+            0, _DeflateFrameIncomingFilter(self))
 
     def set_response_window_bits(self, value):
         self._response_window_bits = value
@@ -304,7 +409,10 @@ class DeflateFrameExtensionProcessor(ExtensionProcessorInterface):
                     received_payload_size)
             return
 
-        frame.payload = self._rfc1979_inflater.filter(frame.payload)
+        frame.payload = _inflate_with_limit(
+            self._rfc1979_inflater,
+            frame.payload,
+            self._stream_options.incoming_max_decompressed_size)
         frame.rsv1 = 0
 
         filtered_payload_size = len(frame.payload)
@@ -354,6 +462,67 @@ class PerMessageDeflateExtensionProcessor(ExtensionProcessorInterface):
         return 'deflate'
 
     def _get_extension_response_internal(self):
+        # The negotiation result depends only on the offered parameters and
+        # the configuration of this processor, which may have been changed by
+        # do_extra_handshake, so it's memoized for that combination. The
+        # deflater, inflater and framer are per connection state and are
+        # always created here.
+        key = (self._request.name(),
+               tuple(self._request.get_parameters()),
+               self._preferred_client_max_window_bits,
+               self._client_no_context_takeover)
+        negotiation = _per_message_deflate_negotiation_cache.get(
+            key, _NOT_CACHED)
+        if negotiation is _NOT_CACHED:
+            negotiation = self._negotiate()
+            _per_message_deflate_negotiation_cache.put(key, negotiation)
+        if negotiation is None:
+            self._logger.debug('Declined %s extension', self._request.name())
+            return None
+
+        (server_max_window_bits,
+         server_no_context_takeover,
+         response_parameters) = negotiation
+
+        self._rfc1979_deflater = util._RFC1979Deflater(
+            server_max_window_bits, server_no_context_takeover)
+
+        # Note that we prepare for incoming messages compressed with window
+        # bits upto 15 regardless of the client_max_window_bits value to be
+        # sent to the client.
+        self._rfc1979_inflater = util._RFC1979Inflater()
+
+        self._framer = _PerMessageDeflateFramer(
+            server_max_window_bits, server_no_context_takeover)
+        self._framer.set_bfinal(False)
+        self._framer.set_compress_outgoing_enabled(True)
+
+        response = common.ExtensionParameter(self._request.name())
+        for name, value in response_parameters:
+            response.add_parameter(name, value)
+
+        self._logger.debug(
+            'Enable %s extension ('
+            'request: server_max_window_bits=%s; '
+            'server_no_context_takeover=%r, '
+            'response: client_max_window_bits=%s; '
+            'client_no_context_takeover=%r)' %
+            (self._request.name(),
+             server_max_window_bits,
+             server_no_context_takeover,
+             self._preferred_client_max_window_bits,
+             self._client_no_context_takeover))
+
+        return response
+
+    def _negotiate(self):
+        """Validates the offer against the configuration of this processor.
+
+        Returns None if the offer is declined. Otherwise, returns a tuple of
+        the server_max_window_bits value, the server_no_context_takeover value
+        and a tuple of (name, value) pairs of the response parameters.
+        """
+
         for name in self._request.get_parameter_names():
             if name not in [self._SERVER_MAX_WINDOW_BITS_PARAM,
                             self._SERVER_NO_CONTEXT_TAKEOVER_PARAM,
@@ -397,29 +566,16 @@ class PerMessageDeflateExtensionProcessor(ExtensionProcessorInterface):
                                client_client_max_window_bits)
             return None
 
-        self._rfc1979_deflater = util._RFC1979Deflater(
-            server_max_window_bits, server_no_context_takeover)
-
-        # Note that we prepare for incoming messages compressed with window
-        # bits upto 15 regardless of the client_max_window_bits value to be
-        # sent to the client.
-        self._rfc1979_inflater = util._RFC1979Inflater()
-
-        self._framer = _PerMessageDeflateFramer(
-            server_max_window_bits, server_no_context_takeover)
-        self._framer.set_bfinal(False)
-        self._framer.set_compress_outgoing_enabled(True)
-
-        response = common.ExtensionParameter(self._request.name())
+        response_parameters = []
 
         if server_max_window_bits is not None:
-            response.add_parameter(
-                self._SERVER_MAX_WINDOW_BITS_PARAM,
-                str(server_max_window_bits))
+            response_parameters.append(
+                (self._SERVER_MAX_WINDOW_BITS_PARAM,
+                 str(server_max_window_bits)))
 
         if server_no_context_takeover:
-            response.add_parameter(
-                self._SERVER_NO_CONTEXT_TAKEOVER_PARAM, None)
+            response_parameters.append(
+                (self._SERVER_NO_CONTEXT_TAKEOVER_PARAM, None))
 
         if self._preferred_client_max_window_bits is not None:
             if not client_client_max_window_bits:
@@ -427,27 +583,17 @@ class PerMessageDeflateExtensionProcessor(ExtensionProcessorInterface):
                                    'the client cannot accept it',
                                    self._CLIENT_MAX_WINDOW_BITS_PARAM)
                 return None
-            response.add_parameter(
-                self._CLIENT_MAX_WINDOW_BITS_PARAM,
-                str(self._preferred_client_max_window_bits))
+            response_parameters.append(
+                (self._CLIENT_MAX_WINDOW_BITS_PARAM,
+                 str(self._preferred_client_max_window_bits)))
 
         if self._client_no_context_takeover:
-            response.add_parameter(
-                self._CLIENT_NO_CONTEXT_TAKEOVER_PARAM, None)
+            response_parameters.append(
+                (self._CLIENT_NO_CONTEXT_TAKEOVER_PARAM, None))
 
-        self._logger.debug(
-            'Enable %s extension ('
-            'request: server_max_window_bits=%s; '
-            'server_no_context_takeover=%r, '
-            'response: client_max_window_bits=%s; '
-            'client_no_context_takeover=%r)' %
-            (self._request.name(),
-             server_max_window_bits,
-             server_no_context_takeover,
-             self._preferred_client_max_window_bits,
-             self._client_no_context_takeover))
-
-        return response
+        return (server_max_window_bits,
+                server_no_context_takeover,
+                tuple(response_parameters))
 
     def _setup_stream_options_internal(self, stream_options):
         self._framer.setup_stream_options(stream_options)
@@ -497,6 +643,8 @@ class _PerMessageDeflateFramer(object):
 
         self._rfc1979_deflater = util._RFC1979Deflater(
             deflate_max_window_bits, deflate_no_context_takeover)
+        self._deflate_max_window_bits = deflate_max_window_bits
+        self._deflate_no_context_takeover = deflate_no_context_takeover
 
         self._rfc1979_inflater = util._RFC1979Inflater()
 
@@ -507,6 +655,9 @@ class _PerMessageDeflateFramer(object):
         # True if a message is fragmented and compression is ongoing.
         self._compress_ongoing = False
 
+        # Total bytes decompressed for the message being received.
+        self._decompressed_size = 0
+
         # Calculates
         #     (Total outgoing bytes supplied to this filter) /
         #     (Total bytes sent to the network after applying this filter)
@@ -523,7 +674,7 @@ class _PerMessageDeflateFramer(object):
     def set_compress_outgoing_enabled(self, value):
         self._compress_outgoing_enabled = value
 
-    def _process_incoming_message(self, message, decompress):
+    def _process_incoming_message(self, message, decompress, end=True):
         if not decompress:
             return message
 
@@ -531,9 +682,18 @@ class _PerMessageDeflateFramer(object):
         self._incoming_average_ratio_calculator.add_result_bytes(
                 received_payload_size)
 
-        message = self._rfc1979_inflater.filter(message)
+        message = _inflate_with_limit(
+            self._rfc1979_inflater,
+            message,
+            self._stream_options.incoming_max_decompressed_size,
+            self._decompressed_size,
+            end)
 
         filtered_payload_size = len(message)
+        if end:
+            self._decompressed_size = 0
+        else:
+            self._decompressed_size += filtered_payload_size
         self._incoming_average_ratio_calculator.add_original_bytes(
                 filtered_payload_size)
 
@@ -546,7 +706,7 @@ class _PerMessageDeflateFramer(object):
         return message
 
     def _process_outgoing_message(self, message, end, binary):
-        if not binary:
+        if not binary and isinstance(message, unicode):
             message = message.encode('utf-8')
 
         if not self._compress_outgoing_enabled:
@@ -574,6 +734,16 @@ class _PerMessageDeflateFramer(object):
         self._compress_ongoing = not end
         return message
 
+    def _get_prepared_message_key(self):
+        if not self._compress_outgoing_enabled:
+            return (common.PERMESSAGE_DEFLATE_EXTENSION, None)
+        if not (self._deflate_no_context_takeover or self._bfinal):
+            # Compressed data depends on previously sent messages.
+            return None
+        return (common.PERMESSAGE_DEFLATE_EXTENSION,
+                self._deflate_max_window_bits,
+                self._bfinal)
+
     def _process_incoming_frame(self, frame):
         if frame.rsv1 == 1 and not common.is_control_opcode(frame.opcode):
             self._incoming_message_filter.decompress_next_message()
@@ -589,61 +759,21 @@ class _PerMessageDeflateFramer(object):
     def setup_stream_options(self, stream_options):
         """Creates filters and sets them to the StreamOptions."""
 
-        class _OutgoingMessageFilter(object):
-
-            def __init__(self, parent):
-                self._parent = parent
-
-            def filter(self, message, end=True, binary=False):
-                return self._parent._process_outgoing_message(
-                    message, end, binary)
-
-        class _IncomingMessageFilter(object):
-
-            def __init__(self, parent):
-                self._parent = parent
-                self._decompress_next_message = False
-
-            def decompress_next_message(self):
-                self._decompress_next_message = True
+        self._stream_options = stream_options
 
-            def filter(self, message):
-                message = self._parent._process_incoming_message(
-                    message, self._decompress_next_message)
-                self._decompress_next_message = False
-                return message
-
-        self._outgoing_message_filter = _OutgoingMessageFilter(self)
-        self._incoming_message_filter = _IncomingMessageFilter(self)
+        self._outgoing_message_filter = (
+            _PerMessageDeflateOutgoingMessageFilter(self))
+        self._incoming_message_filter = (
+            _PerMessageDeflateIncomingMessageFilter(self))
         stream_options.outgoing_message_filters.append(
             self._outgoing_message_filter)
         stream_options.incoming_message_filters.append(
             self._incoming_message_filter)
 
-        class _OutgoingFrameFilter(object):
-
-            def __init__(self, parent):
-                self._parent = parent
-                self._set_compression_bit = False
-
-            def set_compression_bit(self):
-                self._set_compression_bit = True
-
-            def filter(self, frame):
-                self._parent._process_outgoing_frame(
-                    frame, self._set_compression_bit)
-                self._set_compression_bit = False
-
-        class _IncomingFrameFilter(object):
-
-            def __init__(self, parent):
-                self._parent = parent
-
-            def filter(self, frame):
-                self._parent._process_incoming_frame(frame)
-
-        self._outgoing_frame_filter = _OutgoingFrameFilter(self)
-        self._incoming_frame_filter = _IncomingFrameFilter(self)
+        self._outgoing_frame_filter = _PerMessageDeflateOutgoingFrameFilter(
+            self)
+        self._incoming_frame_filter = _PerMessageDeflateIncomingFrameFilter(
+            self)
         stream_options.outgoing_frame_filters.append(
             self._outgoing_frame_filter)
         stream_options.incoming_frame_filters.append(
@@ -75,6 +75,28 @@ _SUPPORTED_VERSIONS = [
     _VERSION_LATEST,
 ]
 
+# Names of the StreamOptions attributes which servers and extra handshake
+# handlers can configure. They are exposed on the request with the ws_
+# prefix.
+_CONFIGURABLE_STREAM_OPTION_NAMES = [
+    'incoming_max_frame_payload_size',
+    'incoming_max_message_size',
+    'incoming_max_decompressed_size',
+    'cork_flush_delay',
+    'cork_flush_threshold',
+    'keepalive_interval',
+    'keepalive_timeout',
+]
+
+# The part of the handshake response preceding the value of the
+# Sec-WebSocket-Accept header, which is the same for all responses.
+_RESPONSE_PREFIX = ''.join([
+    'HTTP/1.1 101 Switching Protocols\r\n',
+    format_header(common.UPGRADE_HEADER, common.WEBSOCKET_UPGRADE_TYPE),
+    format_header(common.CONNECTION_HEADER, common.UPGRADE_CONNECTION_TYPE),
+    '%s: ' % common.SEC_WEBSOCKET_ACCEPT_HEADER,
+])
+
 
 def compute_accept(key):
     """Computes value for the Sec-WebSocket-Accept header from value of the
@@ -109,6 +131,9 @@ class Handshaker(object):
     def _validate_connection_header(self):
         connection = get_mandatory_header(
             self._request, common.CONNECTION_HEADER)
+        # Fast path for the value browsers send.
+        if connection.lower() == common.UPGRADE_CONNECTION_TYPE.lower():
+            return
 
         try:
             connection_tokens = parse_token_list(connection)
@@ -156,11 +181,12 @@ class Handshaker(object):
 
             key = self._get_key()
             (accept, accept_binary) = compute_accept(key)
-            self._logger.debug(
-                '%s: %r (%s)',
-                common.SEC_WEBSOCKET_ACCEPT_HEADER,
-                accept,
-                util.hexify(accept_binary))
+            if self._logger.isEnabledFor(logging.DEBUG):
+                self._logger.debug(
+                    '%s: %r (%s)',
+                    common.SEC_WEBSOCKET_ACCEPT_HEADER,
+                    accept,
+                    util.hexify(accept_binary))
 
             self._logger.debug('Protocol version is RFC 6455')
 
@@ -180,6 +206,17 @@ class Handshaker(object):
             # them to the WebSocket handshake.
             self._request.extra_headers = []
 
+            # Stream options such as limits on the size of incoming data. The
+            # server may set the defaults on the request before the
+            # handshake, and the extra handshake handler may change them for
+            # the resource. See StreamOptions for their meanings.
+            default_stream_options = StreamOptions()
+            for name in _CONFIGURABLE_STREAM_OPTION_NAMES:
+                attribute = 'ws_' + name
+                if not hasattr(self._request, attribute):
+                    setattr(self._request, attribute,
+                            getattr(default_stream_options, name))
+
             # Extra handshake handler may modify/remove processors.
             self._dispatcher.do_extra_handshake(self._request)
             processors = filter(lambda processor: processor is not None,
@@ -224,6 +261,9 @@ class Handshaker(object):
                                     processors)
 
             stream_options = StreamOptions()
+            for name in _CONFIGURABLE_STREAM_OPTION_NAMES:
+                setattr(stream_options, name,
+                        getattr(self._request, 'ws_' + name))
 
             for index, processor in enumerate(processors):
                 if not processor.is_active():
@@ -369,11 +409,12 @@ class Handshaker(object):
 
         decoded_key = self._validate_key(key)
 
-        self._logger.debug(
-            '%s: %r (%s)',
-            common.SEC_WEBSOCKET_KEY_HEADER,
-            key,
-            util.hexify(decoded_key))
+        if self._logger.isEnabledFor(logging.DEBUG):
+            self._logger.debug(
+                '%s: %r (%s)',
+                common.SEC_WEBSOCKET_KEY_HEADER,
+                key,
+                util.hexify(decoded_key))
 
         return key
 
@@ -381,17 +422,9 @@ class Handshaker(object):
         return Stream(self._request, stream_options)
 
     def _create_handshake_response(self, accept):
-        response = []
-
-        response.append('HTTP/1.1 101 Switching Protocols\r\n')
+        response = [_RESPONSE_PREFIX, accept, '\r\n']
 
         # WebSocket headers
-        response.append(format_header(
-            common.UPGRADE_HEADER, common.WEBSOCKET_UPGRADE_TYPE))
-        response.append(format_header(
-            common.CONNECTION_HEADER, common.UPGRADE_CONNECTION_TYPE))
-        response.append(format_header(
-            common.SEC_WEBSOCKET_ACCEPT_HEADER, accept))
         if self._request.ws_protocol is not None:
             response.append(format_header(
                 common.SEC_WEBSOCKET_PROTOCOL_HEADER,
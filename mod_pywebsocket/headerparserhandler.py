@@ -70,6 +70,15 @@ _PYOPT_ALLOW_DRAFT75 = 'mod_pywebsocket.allow_draft75'
 # Map from values to their meanings.
 _PYOPT_ALLOW_DRAFT75_DEFINITION = {'off': False, 'on': True}
 
+# PythonOptions to limit the size of incoming data in bytes. A frame whose
+# payload is larger than max_frame_size, a message larger than
+# max_message_size, or a compressed message (or frame for deflate-frame)
+# inflating to more than max_decompressed_size bytes makes the connection
+# closed with status code 1009. They are not limited by default.
+_PYOPT_MAX_FRAME_SIZE = 'mod_pywebsocket.max_frame_size'
+_PYOPT_MAX_MESSAGE_SIZE = 'mod_pywebsocket.max_message_size'
+_PYOPT_MAX_DECOMPRESSED_SIZE = 'mod_pywebsocket.max_decompressed_size'
+
 
 class ApacheLogHandler(logging.Handler):
 
@@ -148,6 +157,18 @@ def _parse_option(name, value, definition):
     return meaning
 
 
+def _parse_size_option(name, value):
+    """Return the integer value of a size option, or None if not set."""
+    if value is None:
+        return None
+
+    try:
+        return int(value)
+    except ValueError:
+        raise Exception('Invalid value for PythonOption %s: %r' %
+                        (name, value))
+
+
 def _create_dispatcher():
     """Initialize a dispatch.Dispatcher."""
     _LOGGER.info('Initializing Dispatcher')
@@ -214,6 +235,15 @@ def headerparserhandler(request):
             apache.main_server.get_options().get(_PYOPT_ALLOW_DRAFT75),
             _PYOPT_ALLOW_DRAFT75_DEFINITION)
 
+        options = apache.main_server.get_options()
+        request.ws_incoming_max_frame_payload_size = _parse_size_option(
+            _PYOPT_MAX_FRAME_SIZE, options.get(_PYOPT_MAX_FRAME_SIZE))
+        request.ws_incoming_max_message_size = _parse_size_option(
+            _PYOPT_MAX_MESSAGE_SIZE, options.get(_PYOPT_MAX_MESSAGE_SIZE))
+        request.ws_incoming_max_decompressed_size = _parse_size_option(
+            _PYOPT_MAX_DECOMPRESSED_SIZE,
+            options.get(_PYOPT_MAX_DECOMPRESSED_SIZE))
+
         try:
             handshake.do_handshake(
                 request, _dispatcher, allowDraft75=allow_draft75)
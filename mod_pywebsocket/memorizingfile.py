@@ -71,7 +71,7 @@ class MemorizingFile(object):
         """
         if name in ('_file', '_memorized_lines', '_max_memorized_lines',
                     '_buffered', '_buffered_line', 'readline',
-                    'get_memorized_lines'):
+                    'get_memorized_lines', 'detach'):
             return object.__getattribute__(self, name)
         return self._file.__getattribute__(name)
 
@@ -99,5 +99,16 @@ class MemorizingFile(object):
         """Get lines memorized so far."""
         return self._memorized_lines
 
+    def detach(self):
+        """Return the wrapped file and the rest of the line partially read
+        by readline with size, so that the caller can read the file directly.
+        This object must not be read after calling this method.
+        """
+        buffered_line = ''
+        if self._buffered:
+            buffered_line = self._buffered_line
+            self._buffered = False
+        return self._file, buffered_line
+
 
 # vi:sts=4 sw=4 et
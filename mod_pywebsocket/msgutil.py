@@ -75,6 +75,34 @@ def send_message(request, payload_data, end=True, binary=False):
     request.ws_stream.send_message(payload_data, end, binary)
 
 
+def send_messages(request, messages, binary=False):
+    """Send many messages at once. Frames for all of the messages are written
+    to the connection by one write call.
+
+    Args:
+        request: mod_python request.
+        messages: an iterable of unicode text or str binary messages to send.
+        binary: send messages as binary frames.
+    Raises:
+        BadOperationException: when server already terminated.
+    """
+    request.ws_stream.send_messages(messages, binary)
+
+
+def send_prepared(request, prepared_message):
+    """Send a message prepared as a stream.PreparedMessage. When the same
+    PreparedMessage is sent to many connections, frames built for one
+    connection are reused for others with the same configuration.
+
+    Args:
+        request: mod_python request.
+        prepared_message: stream.PreparedMessage to send.
+    Raises:
+        BadOperationException: when server already terminated.
+    """
+    request.ws_stream.send_prepared(prepared_message)
+
+
 def receive_message(request):
     """Receive a WebSocket frame and return its payload as a text in
     unicode or a binary in str.
@@ -95,6 +123,26 @@ def receive_message(request):
     return request.ws_stream.receive_message()
 
 
+def receive_message_stream(request):
+    """Receive a WebSocket message and return an iterator over its payload.
+
+    Unlike receive_message, fragments of the message are not concatenated.
+    Each chunk is yielded as soon as the frame carrying it is received, so
+    large messages can be processed with constant memory. The iterator must
+    be exhausted before receiving the next message.
+
+    Args:
+        request: mod_python request.
+    Returns:
+        an iterator yielding unicode chunks for a text message or str chunks
+        for a binary message, or None iff received closing handshake.
+    Raises:
+        Same as receive_message. Errors found in the middle of the message
+        are raised from the iterator.
+    """
+    return request.ws_stream.receive_message_stream()
+
+
 def send_ping(request, body=''):
     request.ws_stream.send_ping(body)
 
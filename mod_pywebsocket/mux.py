@@ -43,6 +43,7 @@ import logging
 import math
 import struct
 import threading
+import time
 import traceback
 
 from mod_pywebsocket import common
@@ -830,8 +831,9 @@ class _LogicalStream(Stream):
             send_quota: Initial send quota.
             receive_quota: Initial receive quota.
         """
-        # Physical stream is responsible for masking.
+        # Physical stream is responsible for masking and keepalive.
         stream_options.unmask_receive = False
+        stream_options.keepalive_interval = None
         Stream.__init__(self, request, stream_options)
 
         self._send_closed = False
@@ -852,8 +854,8 @@ class _LogicalStream(Stream):
 
     def _create_inner_frame(self, opcode, payload, end=True):
         frame = Frame(fin=end, opcode=opcode, payload=payload)
-        for frame_filter in self._options.outgoing_frame_filters:
-            frame_filter.filter(frame)
+        if self._filter_outgoing_frame is not None:
+            self._filter_outgoing_frame(frame)
 
         if len(payload) != len(frame.payload):
             raise MuxUnexpectedException(
@@ -963,6 +965,10 @@ class _LogicalStream(Stream):
 
     def send_message(self, message, end=True, binary=False):
         """Override Stream.send_message."""
+        if isinstance(message, list):
+            # Inner frames are built by concatenating payload anyway.
+            message = ''.join(message)
+
         if self._request.server_terminated:
             raise BadOperationException(
                 'Requested send_message after sending out a closing handshake')
@@ -977,8 +983,8 @@ class _LogicalStream(Stream):
             opcode = common.OPCODE_TEXT
             message = message.encode('utf-8')
 
-        for message_filter in self._options.outgoing_message_filters:
-            message = message_filter.filter(message, end, binary)
+        if self._filter_outgoing_message is not None:
+            message = self._filter_outgoing_message(message, end, binary)
 
         if self._last_message_was_fragmented:
             if opcode != self._message_opcode:
@@ -991,18 +997,35 @@ class _LogicalStream(Stream):
         self._write_inner_frame(opcode, message, end)
         self._last_message_was_fragmented = not end
 
-    def _receive_frame(self):
-        """Override Stream._receive_frame.
+    def send_prepared(self, prepared_message):
+        """Override Stream.send_prepared.
+
+        Inner frames are built for each logical channel.
+        """
+        self.send_message(
+            prepared_message.message, binary=prepared_message.binary)
+
+    def send_messages(self, messages, binary=False):
+        """Override Stream.send_messages.
+
+        Each message needs send quota of the logical channel, so they are
+        sent one by one.
+        """
+        for message in messages:
+            self.send_message(message, binary=binary)
+
+    def _receive_frame_as_frame_object(self):
+        """Override Stream._receive_frame_as_frame_object.
 
-        In addition to call Stream._receive_frame, this method adds the amount
-        of payload to receiving quota and sends FlowControl to the client.
-        We need to do it here because Stream.receive_message() handles
-        control frames internally.
+        In addition to call Stream._receive_frame_as_frame_object, this method
+        adds the amount of payload to receiving quota and sends FlowControl to
+        the client. We need to do it here because Stream.receive_message()
+        handles control frames internally.
         """
-        opcode, payload, fin, rsv1, rsv2, rsv3 = Stream._receive_frame(self)
-        amount = len(payload)
+        frame = Stream._receive_frame_as_frame_object(self)
+        amount = len(frame.payload)
         # Replenish extra one octet when receiving the first fragmented frame.
-        if opcode != common.OPCODE_CONTINUATION:
+        if frame.opcode != common.OPCODE_CONTINUATION:
             amount += 1
         self._receive_quota += amount
         frame_data = _create_flow_control(self._request.channel_id,
@@ -1010,7 +1033,7 @@ class _LogicalStream(Stream):
         self._logger.debug('Sending flow control for %d, replenished=%d' %
                            (self._request.channel_id, amount))
         self._request.connection.write_control_data(frame_data)
-        return opcode, payload, fin, rsv1, rsv2, rsv3
+        return frame
 
     def _get_message_from_frame(self, frame):
         """Override Stream._get_message_from_frame."""
@@ -1023,7 +1046,10 @@ class _LogicalStream(Stream):
         if inner_message is None:
             return None
         self._original_opcode = inner_message.opcode
-        return inner_message.payload
+        if common.is_control_opcode(inner_message.opcode):
+            return inner_message.payload
+        self._start_message(inner_message.opcode)
+        return self._process_message_fragment(inner_message.payload, True)
 
     def receive_message(self):
         """Override Stream.receive_message."""
@@ -1036,6 +1062,17 @@ class _LogicalStream(Stream):
             self._logger.debug('%s', e)
             return None
 
+    def receive_message_stream(self):
+        """Override Stream.receive_message_stream.
+
+        Fragments of a logical channel are reassembled by the inner message
+        builder, so this just wraps the result of receive_message().
+        """
+        message = self.receive_message()
+        if message is None:
+            return None
+        return iter([message])
+
     def _send_closing_handshake(self, code, reason):
         """Override Stream._send_closing_handshake."""
         body = create_closing_handshake_body(code, reason)
@@ -1051,7 +1088,11 @@ class _LogicalStream(Stream):
                            (self._request.channel_id, body))
         self._write_inner_frame(common.OPCODE_PING, body, end=True)
 
-        self._ping_queue.append(body)
+        self._ping_queue_lock.acquire()
+        try:
+            self._ping_queue.append((body, time.time()))
+        finally:
+            self._ping_queue_lock.release()
 
     def _send_pong(self, body):
         """Override Stream._send_pong."""
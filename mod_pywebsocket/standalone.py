@@ -146,6 +146,44 @@ THREADING
 This server is derived from SocketServer.ThreadingMixIn. Hence a thread is
 used for each request.
 
+Connections are accepted on the thread running the server. It waits on the
+listening sockets with epoll where available, and accepts connections until
+the backlog is drained on each wakeup. With
+--accept-monitor-interval-in-sec, the number and rate of accepted
+connections are logged periodically at info level.
+
+With --max-workers, requests are processed on a pool of at most the given
+number of threads, which are reused. When all of them are busy, requests
+wait in a queue bounded by --worker-queue-size, and for at most
+--worker-queue-timeout seconds if it is given. Requests which don't fit or
+time out are rejected with 503 Service Unavailable. A WebSocket connection
+occupies a thread until it is closed.
+
+TLS handshakes are done on the thread processing the request, not on the
+thread accepting connections, so that slow clients don't delay accepting
+others. Handshakes not completed in --tls-handshake-timeout seconds are
+aborted. With TLS, rejected requests are closed without a response.
+
+
+MULTIPLE PROCESSES
+==================
+
+Under CPython, one server process uses at most one CPU core for processing
+frames. To use more, run the server with --processes N. A supervisor
+process then forks N server processes, each of which listens on the same
+port by SO_REUSEPORT, so that the kernel distributes connections among
+them. Server processes which die are restarted. With --cpu-affinity, server
+process i is pinned to CPU i (modulo the number of CPUs) on Linux.
+
+Note that handlers run in separate processes and don't share any state.
+
+With --server-mode=eventloop, the server instead serves all WebSocket
+connections on one thread using epoll (or select), and calls the
+web_socket_on_open, web_socket_on_message and web_socket_on_close functions
+of handlers for each event. See __init__.py for how to write such handlers.
+In this mode, handlers without web_socket_on_message, HTTP requests other
+than WebSocket handshakes, TLS, cork and keepalive are not supported.
+
 
 SECURITY WARNING
 ================
@@ -160,26 +198,35 @@ import CGIHTTPServer
 import SimpleHTTPServer
 import SocketServer
 import ConfigParser
+import StringIO
 import base64
+import errno
 import httplib
 import logging
 import logging.handlers
+import mimetools
+import multiprocessing
 import optparse
 import os
 import re
 import select
+import signal
 import socket
 import sys
 import threading
 import time
 import urlparse
+from collections import deque
 
 from mod_pywebsocket import common
 from mod_pywebsocket import dispatch
 from mod_pywebsocket import handshake
 from mod_pywebsocket import http_header_util
 from mod_pywebsocket import memorizingfile
+from mod_pywebsocket import mux
+from mod_pywebsocket import stream
 from mod_pywebsocket import util
+from mod_pywebsocket.handshake import hybi
 from mod_pywebsocket.xhr_benchmark_handler import XHRBenchmarkHandler
 
 
@@ -188,13 +235,157 @@ _DEFAULT_LOG_BACKUP_COUNT = 5
 
 _DEFAULT_REQUEST_QUEUE_SIZE = 128
 
+_DEFAULT_WORKER_QUEUE_SIZE = 128
+# Seconds to keep reading requests rejected for overload before closing
+# their connections.
+_REJECTED_REQUEST_LINGER = 1
+
 # 1024 is practically large enough to contain WebSocket handshake lines.
 _MAX_MEMORIZED_LINES = 1024
 
+# Maximum number of bytes _PeekingSocketFile peeks at to find a line end.
+_PEEK_SIZE = 4096
+
+# Limits httplib applies to request headers. Requests exceeding them are
+# left to httplib so that they fail the same way.
+_MAX_HEADER_LINE_SIZE = 65536
+_MAX_HEADERS = 100
+
+# socket.MSG_MORE is not exposed by Python 2. This is the value defined by
+# Linux, the only platform on which we use the flag.
+if sys.platform.startswith('linux'):
+    _MSG_MORE = getattr(socket, 'MSG_MORE', 0x8000)
+else:
+    _MSG_MORE = 0
+
+# SO_REUSEPORT is not exposed by some builds of Python 2. This is the value
+# defined by Linux.
+if sys.platform.startswith('linux'):
+    _SO_REUSEPORT = getattr(socket, 'SO_REUSEPORT', 15)
+else:
+    _SO_REUSEPORT = getattr(socket, 'SO_REUSEPORT', None)
+# prctl option to get a signal when the parent process dies. Linux only.
+_PR_SET_PDEATHSIG = 1
+# Server processes dying in this many seconds are restarted after as many
+# seconds.
+_PROCESS_RESTART_DELAY = 1
+
 # Constants for the --tls_module flag.
 _TLS_BY_STANDARD_MODULE = 'ssl'
 _TLS_BY_PYOPENSSL = 'pyopenssl'
 
+_DEFAULT_TLS_HANDSHAKE_TIMEOUT = 10
+
+# Constants for the --server-mode flag.
+_SERVER_MODE_THREAD = 'thread'
+_SERVER_MODE_EVENTLOOP = 'eventloop'
+
+# Parameters of the event loop server mode.
+_EVENT_LOOP_RECEIVE_SIZE = 64 * 1024
+# Requests whose headers don't end in this many bytes are rejected.
+_MAX_HANDSHAKE_REQUEST_SIZE = 64 * 1024
+# Seconds to wait for the peer's close frame after sending one.
+_CLOSING_TIMEOUT = 10
+
+_WOULD_BLOCK_ERRORS = (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR)
+
+
+class _PeekingSocketFile(socket._fileobject):
+    """Unbuffered socket file object for reading requests.
+
+    The request handler reads requests through an unbuffered file object so
+    that data following the request headers is left on the socket for CGI
+    scripts. Its readline receives one byte per system call. This class
+    peeks at the received data to find the end of the line, and then
+    receives the whole line at once. It still doesn't receive any byte
+    beyond the line.
+    """
+
+    def __init__(self, sock):
+        socket._fileobject.__init__(self, sock, 'rb', 0)
+
+    def readline(self, size=-1):
+        buffered = self._rbuf
+        buffered.seek(0, 2)
+        if buffered.tell() > 0:
+            return socket._fileobject.readline(self, size)
+
+        chunks = []
+        while size != 0:
+            peek_size = _PEEK_SIZE
+            if size > 0:
+                peek_size = min(size, _PEEK_SIZE)
+            try:
+                data = self._sock.recv(peek_size, socket.MSG_PEEK)
+            except socket.error, e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            if not data:
+                break
+            line_end = data.find('\n') + 1
+            if line_end == 0:
+                line_end = len(data)
+            # The peeked bytes are available. This doesn't block.
+            data = self._sock.recv(line_end)
+            chunks.append(data)
+            if data.endswith('\n'):
+                break
+            if size > 0:
+                size -= len(data)
+        return ''.join(chunks)
+
+
+class _SocketReader(object):
+    """Reads from a socket directly, starting with data buffered by the
+    file object used for reading the opening handshake.
+    """
+
+    def __init__(self, socket_, buffered_data):
+        self._socket = socket_
+        self._buffered_data = buffered_data
+
+    def _read_buffered_data(self, length):
+        data = self._buffered_data[:length]
+        self._buffered_data = self._buffered_data[length:]
+        return data
+
+    def _recv(self, length):
+        while True:
+            try:
+                return self._socket.recv(length)
+            except socket.error, e:
+                if e.args[0] != errno.EINTR:
+                    raise
+
+    def read(self, length):
+        """Reads length bytes. Returns fewer bytes only when the connection
+        is closed.
+        """
+
+        chunks = []
+        if self._buffered_data:
+            chunks.append(self._read_buffered_data(length))
+            length -= len(chunks[0])
+        while length > 0:
+            data = self._recv(length)
+            if not data:
+                break
+            if not chunks and len(data) == length:
+                return data
+            chunks.append(data)
+            length -= len(data)
+        return ''.join(chunks)
+
+    def read_available(self, length):
+        """Reads at most length bytes, returning as soon as any data is
+        available.
+        """
+
+        if self._buffered_data:
+            return self._read_buffered_data(length)
+        return self._recv(length)
+
 
 class _StandaloneConnection(object):
     """Mimic mod_python mp_conn."""
@@ -229,16 +420,78 @@ class _StandaloneConnection(object):
 
         return self._request_handler.wfile.write(data)
 
+    def write_buffers(self, buffers):
+        """Writes the given buffers in order without concatenating them.
+
+        On Linux, all buffers but the last one are sent with MSG_MORE so that
+        the kernel coalesces them into full segments instead of sending the
+        frame header in a segment of its own.
+        """
+
+        socket_ = self._request_handler.connection
+        if (_MSG_MORE and
+            not self._request_handler.server.websocket_server_options.use_tls):
+            for buffer_ in buffers[:-1]:
+                socket_.sendall(buffer_, _MSG_MORE)
+        else:
+            for buffer_ in buffers[:-1]:
+                socket_.sendall(buffer_)
+        socket_.sendall(buffers[-1])
+
+    def shutdown(self):
+        """Shuts down the socket so that threads reading from or writing to
+        it fail.
+        """
+
+        connection = self._request_handler.connection
+        # shutdown of pyOpenSSL only sends close_notify, which doesn't wake up
+        # a thread blocked in recv. Shut down the underlying socket instead.
+        shutdown = getattr(connection, 'sock_shutdown', connection.shutdown)
+        try:
+            shutdown(socket.SHUT_RDWR)
+        except socket.error, e:
+            # The socket is already closed.
+            pass
+
     def read(self, length):
         """Mimic mp_conn.read()."""
 
         return self._request_handler.rfile.read(length)
 
+    def read_available(self, length):
+        """Reads at most length bytes. Unlike read(), this method returns as
+        soon as any data is available so that the stream can read ahead.
+        """
+
+        rfile = self._request_handler.rfile
+        # Bytes buffered by rfile while reading the opening handshake must be
+        # consumed before receiving from the socket directly.
+        buffered = rfile._rbuf
+        buffered.seek(0, 2)
+        if buffered.tell() > 0:
+            return rfile.read(min(length, buffered.tell()))
+        return self._request_handler.connection.recv(length)
+
     def get_memorized_lines(self):
         """Get memorized lines."""
 
         return self._request_handler.rfile.get_memorized_lines()
 
+    def use_socket_reader(self):
+        """Makes read and read_available read from the socket directly
+        instead of through rfile, which is a MemorizingFile wrapping a
+        socket file object. Called when the opening handshake is done as
+        the lines no longer need to be memorized. Data already buffered by
+        rfile is read first.
+        """
+
+        file_, buffered_line = self._request_handler.rfile.detach()
+        reader = _SocketReader(self._request_handler.connection,
+                               buffered_line + file_._rbuf.getvalue())
+        # Shadow the methods so that reads don't pay for an extra call.
+        self.read = reader.read
+        self.read_available = reader.read_available
+
 
 class _StandaloneRequest(object):
     """Mimic mod_python request."""
@@ -293,6 +546,396 @@ class _StandaloneRequest(object):
         return self._use_tls
 
 
+class _EventLoopConnection(object):
+    """Mimic mod_python mp_conn for a connection served by
+    EventLoopWebSocketServer. Written data is queued, and the event loop
+    sends it when the socket becomes writable.
+    """
+
+    def __init__(self, server, socket_, client_address):
+        """Construct an instance.
+
+        Args:
+            server: the EventLoopWebSocketServer serving the connection.
+            socket_: the accepted non-blocking socket.
+            client_address: the address of the peer.
+        """
+
+        self._server = server
+        self.socket = socket_
+        self.fileno = socket_.fileno()
+        self.remote_addr = client_address
+
+        # Bytes received before the end of the opening handshake request.
+        self.handshake_buffer = ''
+        # Set when the opening handshake completes.
+        self.request = None
+        self.handler_suite = None
+
+        self._outgoing = []
+        # Whether the event loop is watching the socket for writability.
+        self.waiting_writable = False
+        # Close the socket once all queued data is sent.
+        self.close_after_write = False
+        # Time to give up waiting for the peer's close frame.
+        self.closing_deadline = None
+
+    def get_local_addr(self):
+        """Getter to mimic mp_conn.local_addr."""
+
+        return (self._server.server_name, self._server.server_port)
+    local_addr = property(get_local_addr)
+
+    def write(self, data):
+        """Mimic mp_conn.write()."""
+
+        if data:
+            self._outgoing.append(data)
+            self._server._add_pending_connection(self)
+
+    def close_after_writing(self):
+        """Makes the event loop close the socket once all queued data is
+        sent.
+        """
+
+        self.close_after_write = True
+        self._server._add_pending_connection(self)
+
+    def send_outgoing_data(self):
+        """Sends queued data as much as the socket accepts without blocking.
+        Returns True when all of it has been sent.
+        """
+
+        if not self._outgoing:
+            return True
+        if len(self._outgoing) == 1:
+            data = self._outgoing[0]
+        else:
+            data = ''.join(self._outgoing)
+        try:
+            sent = self.socket.send(data)
+        except socket.error, e:
+            if e.args[0] not in _WOULD_BLOCK_ERRORS:
+                raise
+            sent = 0
+        if sent < len(data):
+            self._outgoing = [data[sent:]]
+            return False
+        self._outgoing = []
+        return True
+
+
+class _EventLoopRequest(object):
+    """Mimic mod_python request for a connection served by
+    EventLoopWebSocketServer.
+    """
+
+    def __init__(self, connection, method, uri, protocol, headers):
+        """Construct an instance.
+
+        Args:
+            connection: an _EventLoopConnection instance.
+            method: the method in the Request-Line.
+            uri: the resource name requested.
+            protocol: the HTTP version in the Request-Line.
+            headers: a mimetools.Message holding the request headers.
+        """
+
+        self.connection = connection
+        self.method = method
+        self.uri = uri
+        self.unparsed_uri = uri
+        self.protocol = protocol
+        self.headers_in = headers
+
+    def is_https(self):
+        """Mimic request.is_https()."""
+
+        return False
+
+
+class _EventLoopStream(object):
+    """A replacement of stream.Stream for connections served by
+    EventLoopWebSocketServer. Frames are parsed and built by
+    stream.ProtocolCore, and frames to send are queued on the connection.
+    Messages are delivered to web_socket_on_message, so receive_message()
+    is not available. Cork and keepalive options are ignored.
+    """
+
+    def __init__(self, request, options):
+        """Construct an instance.
+
+        Args:
+            request: an _EventLoopRequest instance.
+            options: StreamOptions set up by the opening handshake.
+        """
+
+        self._logger = util.get_class_logger(self)
+
+        self._request = request
+        self._core = stream.ProtocolCore(
+            options, request.ws_version, echo_close=False)
+
+        self._request.client_terminated = False
+        self._request.server_terminated = False
+
+    def feed(self, data):
+        """Parses bytes received from the connection. See
+        stream.ProtocolCore.feed().
+        """
+
+        events = self._core.feed(data)
+        # Send pongs queued for received pings.
+        self.flush()
+        return events
+
+    def flush(self):
+        """Moves frames built by the protocol core to the connection."""
+
+        self._request.connection.write(self._core.data_to_send())
+
+    def send_message(self, message, end=True, binary=False):
+        """See stream.Stream.send_message()."""
+
+        self._core.send_message(message, end, binary)
+        self.flush()
+
+    def send_messages(self, messages, binary=False):
+        """See stream.Stream.send_messages()."""
+
+        self._core.send_messages(messages, binary)
+        self.flush()
+
+    def send_prepared(self, prepared_message):
+        """See stream.Stream.send_prepared()."""
+
+        self.send_message(prepared_message.message,
+                          binary=prepared_message.binary)
+
+    def send_ping(self, body=''):
+        """See stream.Stream.send_ping()."""
+
+        self._core.send_ping(body)
+        self.flush()
+
+    def receive_message(self):
+        raise stream.BadOperationException(
+            'receive_message is not available in the event loop server '
+            'mode. Define web_socket_on_message to receive messages')
+
+    def close_connection(self, code=common.STATUS_NORMAL_CLOSURE, reason='',
+                         wait_response=True):
+        """Starts the closing handshake. Unlike stream.Stream, this method
+        returns without waiting for the peer's close frame. The connection
+        is closed when it arrives, or when it doesn't arrive in
+        _CLOSING_TIMEOUT seconds.
+
+        See stream.Stream.close_connection() for the arguments.
+        """
+
+        if self._request.server_terminated:
+            self._logger.debug(
+                'Requested close_connection but server is already terminated')
+            return
+
+        if code is None:
+            if reason is not None and len(reason) > 0:
+                raise stream.BadOperationException(
+                    'close reason must not be specified if code is None')
+            reason = ''
+        else:
+            if not isinstance(reason, str) and not isinstance(reason, unicode):
+                raise stream.BadOperationException(
+                    'close reason must be an instance of str or unicode')
+
+        self._core.send_close(code, reason)
+        self._request.server_terminated = True
+        self.flush()
+        self._logger.debug('Sent close frame (code=%r, reason=%r)',
+                           code, reason)
+
+        connection = self._request.connection
+        if (self._request.client_terminated or not wait_response or
+            code == common.STATUS_GOING_AWAY or
+            code == common.STATUS_PROTOCOL_ERROR or
+            code == common.STATUS_MESSAGE_TOO_BIG):
+            # See stream.Stream.close_connection() for why we don't wait for
+            # the peer's close frame for some codes.
+            connection.close_after_writing()
+        else:
+            connection.closing_deadline = time.time() + _CLOSING_TIMEOUT
+
+
+class _EventLoopHandshaker(hybi.Handshaker):
+    """Opening handshake processor creating _EventLoopStream."""
+
+    def _create_stream(self, stream_options):
+        return _EventLoopStream(self._request, stream_options)
+
+
+class _EpollPoller(object):
+    """Waits for events on file descriptors using select.epoll."""
+
+    def __init__(self):
+        self._epoll = select.epoll()
+        self._read_mask = select.EPOLLIN | select.EPOLLERR | select.EPOLLHUP
+
+    def _get_mask(self, writable):
+        if writable:
+            return self._read_mask | select.EPOLLOUT
+        return self._read_mask
+
+    def register(self, fd, writable=False):
+        self._epoll.register(fd, self._get_mask(writable))
+
+    def modify(self, fd, writable):
+        self._epoll.modify(fd, self._get_mask(writable))
+
+    def unregister(self, fd):
+        self._epoll.unregister(fd)
+
+    def poll(self, timeout):
+        """Returns a list of (fd, readable, writable) tuples. Errors and
+        hang-ups are reported as readable.
+        """
+
+        try:
+            events = self._epoll.poll(timeout)
+        except IOError, e:
+            if e.errno == errno.EINTR:
+                return []
+            raise
+        return [(fd, bool(mask & self._read_mask),
+                 bool(mask & select.EPOLLOUT))
+                for fd, mask in events]
+
+
+class _SelectPoller(object):
+    """Waits for events on file descriptors using select.select, for
+    platforms without epoll.
+    """
+
+    def __init__(self):
+        self._readers = set()
+        self._writers = set()
+
+    def register(self, fd, writable=False):
+        self._readers.add(fd)
+        if writable:
+            self._writers.add(fd)
+
+    def modify(self, fd, writable):
+        if writable:
+            self._writers.add(fd)
+        else:
+            self._writers.discard(fd)
+
+    def unregister(self, fd):
+        self._readers.discard(fd)
+        self._writers.discard(fd)
+
+    def poll(self, timeout):
+        """Same as _EpollPoller.poll()."""
+
+        try:
+            readable, writable, unused_errors = select.select(
+                self._readers, self._writers, [], timeout)
+        except select.error, e:
+            if e.args[0] == errno.EINTR:
+                return []
+            raise
+        readable = set(readable)
+        writable = set(writable)
+        return [(fd, fd in readable, fd in writable)
+                for fd in readable | writable]
+
+
+def _create_poller():
+    if hasattr(select, 'epoll'):
+        return _EpollPoller()
+    return _SelectPoller()
+
+
+class _HandshakeHeaders(mimetools.Message):
+    """mimetools.Message holding header lines already parsed by
+    _parse_handshake_headers instead of reading them from a file.
+    """
+
+    def __init__(self, lines, headers):
+        self._parsed_headers = (lines, headers)
+        mimetools.Message.__init__(self, None, 0)
+
+    def readheaders(self):
+        """Overrides rfc822.Message.readheaders."""
+
+        self.headers, self.dict = self._parsed_headers
+        del self._parsed_headers
+        self.unixfrom = ''
+        self.status = ''
+
+
+def _parse_handshake_headers(lines):
+    """Parses header lines of a request in one pass as mimetools.Message
+    does, and returns a _HandshakeHeaders. As with mimetools.Message, the
+    last value of a repeated header wins, and continuation lines are
+    appended to the value of the header they continue.
+
+    The lines must include their line terminators but not the empty line
+    ending the headers. Returns None if the lines include any line
+    mimetools.Message handles specially, such as a line without a colon or
+    a Unix From line. The caller should fall back to mimetools.Message then.
+    """
+
+    if lines and lines[0].startswith('From '):
+        return None
+    headers = {}
+    name = None
+    for line in lines:
+        if line[0] in ' \t':
+            if name is None:
+                return None
+            headers[name] = (headers[name] + '\n ' + line.strip()).strip()
+            continue
+        colon = line.find(':')
+        if colon <= 0:
+            return None
+        name = line[:colon].lower()
+        headers[name] = line[colon + 1:].strip()
+    return _HandshakeHeaders(lines, headers)
+
+
+def _build_error_response(status, headers=[]):
+    """Builds an HTTP response for rejecting a request with the status code
+    on a connection which is closed after it.
+    """
+
+    response = ['HTTP/1.1 %d %s\r\n' % (
+        status, httplib.responses.get(status, ''))]
+    for name, value in headers:
+        response.append('%s: %s\r\n' % (name, value))
+    response.append('Content-Length: 0\r\n')
+    response.append('Connection: close\r\n')
+    response.append('\r\n')
+    return ''.join(response)
+
+
+def _set_stream_options_to_request(request, options):
+    """Sets the ws_* attributes of request from which the handshake creates
+    StreamOptions to the values given by the server options.
+    """
+
+    request.ws_incoming_max_frame_payload_size = options.max_frame_size
+    request.ws_incoming_max_message_size = options.max_message_size
+    request.ws_incoming_max_decompressed_size = options.max_decompressed_size
+    if options.cork_flush_delay_ms is not None:
+        request.ws_cork_flush_delay = options.cork_flush_delay_ms / 1000.0
+    if options.cork_flush_threshold is not None:
+        request.ws_cork_flush_threshold = options.cork_flush_threshold
+    request.ws_keepalive_interval = options.keepalive_interval
+    if options.keepalive_timeout is not None:
+        request.ws_keepalive_timeout = options.keepalive_timeout
+
+
 def _import_ssl():
     global ssl
     try:
@@ -382,6 +1025,147 @@ def _alias_handlers(dispatcher, websock_handlers_map_file):
         fp.close()
 
 
+class _WorkerPool(object):
+    """A bounded pool of threads processing requests accepted by
+    WebSocketServer.
+
+    Threads are created as needed up to max_workers and are reused for
+    later requests. When all of them are busy, up to queue_size requests
+    wait for a thread. Requests beyond that, and queued requests which have
+    waited for longer than queue_timeout seconds, are rejected.
+    """
+
+    def __init__(self, process_request, reject_request, max_workers,
+                 queue_size, queue_timeout=None):
+        """Construct an instance.
+
+        Args:
+            process_request: a function called with a request and the client
+                address on a worker thread to process the request.
+            reject_request: a function called with a request and the client
+                address to reject the request.
+            max_workers: the maximum number of threads.
+            queue_size: the maximum number of requests waiting for a thread.
+            queue_timeout: seconds a request may wait for a thread, or None
+                for no limit.
+        """
+
+        self._logger = util.get_class_logger(self)
+
+        self._process_request = process_request
+        self._reject_request = reject_request
+        self._max_workers = max_workers
+        self._queue_size = queue_size
+        self._queue_timeout = queue_timeout
+
+        # Protects the following members and is notified when a request is
+        # queued or the pool is stopped.
+        self._condition = threading.Condition()
+        # Holds (request, client address, time queued) tuples.
+        self._queue = deque()
+        self._num_workers = 0
+        self._num_idle_workers = 0
+        self._stopped = False
+
+    def submit(self, request, client_address):
+        """Queues a request to be processed by a worker thread. Returns False
+        without queuing it if the pool is saturated.
+        """
+
+        self._condition.acquire()
+        try:
+            if self._stopped:
+                return False
+            if len(self._queue) >= self._num_idle_workers:
+                if self._num_workers < self._max_workers:
+                    self._start_worker()
+                elif (len(self._queue) - self._num_idle_workers >=
+                      self._queue_size):
+                    return False
+            self._queue.append((request, client_address, time.time()))
+            self._condition.notify()
+            return True
+        finally:
+            self._condition.release()
+
+    def stop(self):
+        """Stops idle threads and the others when they finish their
+        request. Queued requests are rejected.
+        """
+
+        self._condition.acquire()
+        try:
+            self._stopped = True
+            queue = self._queue
+            self._queue = deque()
+            self._condition.notifyAll()
+        finally:
+            self._condition.release()
+        for request, client_address, unused_time in queue:
+            self._reject_request(request, client_address)
+
+    def _start_worker(self):
+        # Called with self._condition held.
+        self._num_workers += 1
+        self._num_idle_workers += 1
+        thread = threading.Thread(target=self._run)
+        thread.daemon = True
+        thread.start()
+        self._logger.debug('Started worker thread %d of %d',
+                           self._num_workers, self._max_workers)
+
+    def _run(self):
+        while True:
+            self._condition.acquire()
+            try:
+                while not self._queue and not self._stopped:
+                    self._condition.wait()
+                if self._stopped:
+                    self._num_workers -= 1
+                    self._num_idle_workers -= 1
+                    return
+                request, client_address, queued_time = (
+                    self._queue.popleft())
+                self._num_idle_workers -= 1
+            finally:
+                self._condition.release()
+
+            try:
+                if (self._queue_timeout is not None and
+                    time.time() - queued_time > self._queue_timeout):
+                    self._logger.warning(
+                        'Request from %r waited too long for a worker '
+                        'thread', client_address)
+                    self._reject_request(request, client_address)
+                else:
+                    self._process_request(request, client_address)
+            finally:
+                self._condition.acquire()
+                self._num_idle_workers += 1
+                self._condition.release()
+
+
+class _AcceptStats(object):
+    """Counters of connections accepted by a server. Updated only by the
+    thread running serve_forever.
+    """
+
+    def __init__(self):
+        self.accepted = 0
+        self.errors = 0
+        # Number of wakeups of the accept loop which accepted connections.
+        self.wakeups = 0
+        self.max_accepted_per_wakeup = 0
+
+    def record(self, accepted):
+        if accepted == 0:
+            return
+        self.accepted += accepted
+        self.wakeups += 1
+        if accepted > self.max_accepted_per_wakeup:
+            self.max_accepted_per_wakeup = accepted
+
+
 class WebSocketServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
     """HTTPServer specialized for WebSocket."""
 
@@ -416,6 +1200,21 @@ class WebSocketServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
         self.__ws_is_shut_down = threading.Event()
         self.__ws_serving = False
 
+        # Map from sockets of rejected requests to the time to close them.
+        self._rejected_requests = {}
+        self._rejected_requests_lock = threading.Lock()
+
+        self._accept_stats = _AcceptStats()
+
+        self._worker_pool = None
+        if options.max_workers is not None:
+            self._worker_pool = _WorkerPool(
+                self.process_request_thread,
+                self._reject_request,
+                options.max_workers,
+                options.worker_queue_size,
+                options.worker_queue_timeout)
+
         SocketServer.BaseServer.__init__(
             self, (options.server_host, options.port), WebSocketRequestHandler)
 
@@ -423,6 +1222,10 @@ class WebSocketServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
         # it with websocket_ prefix to avoid conflict.
         self.websocket_server_options = options
 
+        self._tls_context = None
+        if options.use_tls:
+            self._tls_context = self._create_tls_context()
+
         self._create_sockets()
         self.server_bind()
         self.server_activate()
@@ -459,7 +1262,14 @@ class WebSocketServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
             if server_options.use_tls:
                 # For the case of _HAS_OPEN_SSL, we do wrapper setup after
                 # accept.
-                if server_options.tls_module == _TLS_BY_STANDARD_MODULE:
+                if self._tls_context is not None and (
+                    server_options.tls_module == _TLS_BY_STANDARD_MODULE):
+                    # Connections accepted on the socket share the context.
+                    socket_ = self._tls_context.wrap_socket(
+                        socket_, server_side=True,
+                        do_handshake_on_connect=False)
+                elif server_options.tls_module == _TLS_BY_STANDARD_MODULE:
+                    # ssl module without SSLContext (Python before 2.7.9).
                     if server_options.tls_client_auth:
                         if server_options.tls_client_cert_optional:
                             client_cert_ = ssl.CERT_OPTIONAL
@@ -476,6 +1286,55 @@ class WebSocketServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
                         do_handshake_on_connect=False)
             self._sockets.append((socket_, addrinfo))
 
+    def _create_tls_context(self):
+        """Creates the TLS context shared by all connections, so that the
+        key and certificates are loaded once and clients can resume their
+        sessions from the session cache or session tickets of the context.
+        Returns None if the ssl module doesn't provide SSLContext.
+        """
+
+        server_options = self.websocket_server_options
+        if server_options.tls_module == _TLS_BY_STANDARD_MODULE:
+            if not hasattr(ssl, 'SSLContext'):
+                return None
+            context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+            context.load_cert_chain(server_options.certificate,
+                                    server_options.private_key)
+            if server_options.tls_client_auth:
+                if server_options.tls_client_cert_optional:
+                    context.verify_mode = ssl.CERT_OPTIONAL
+                else:
+                    context.verify_mode = ssl.CERT_REQUIRED
+                context.load_verify_locations(server_options.tls_client_ca)
+            # OpenSSL caches sessions on the server side and issues session
+            # tickets by default. Make sure tickets are not disabled.
+            context.options &= ~getattr(ssl, 'OP_NO_TICKET', 0)
+            return context
+
+        ctx = OpenSSL.SSL.Context(OpenSSL.SSL.SSLv23_METHOD)
+        ctx.use_privatekey_file(server_options.private_key)
+        ctx.use_certificate_file(server_options.certificate)
+
+        def default_callback(conn, cert, errnum, errdepth, ok):
+            return ok == 1
+
+        # See the OpenSSL document for SSL_CTX_set_verify.
+        if server_options.tls_client_auth:
+            verify_mode = OpenSSL.SSL.VERIFY_PEER
+            if not server_options.tls_client_cert_optional:
+                verify_mode |= OpenSSL.SSL.VERIFY_FAIL_IF_NO_PEER_CERT
+            ctx.set_verify(verify_mode, default_callback)
+            ctx.load_verify_locations(server_options.tls_client_ca, None)
+        else:
+            ctx.set_verify(OpenSSL.SSL.VERIFY_NONE, default_callback)
+
+        # Session tickets are enabled by default.
+        ctx.set_session_cache_mode(OpenSSL.SSL.SESS_CACHE_SERVER)
+        # Sessions of authenticated clients are resumed only when the
+        # session id context is set.
+        ctx.set_session_id('pywebsocket')
+        return ctx
+
     def server_bind(self):
         """Override SocketServer.TCPServer.server_bind to enable multiple
         sockets bind.
@@ -488,6 +1347,10 @@ class WebSocketServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
             self._logger.info('Bind on: %r', addrinfo)
             if self.allow_reuse_address:
                 socket_.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            if self.websocket_server_options.processes > 1:
+                # Let the kernel distribute connections among the server
+                # processes listening on the same port.
+                socket_.setsockopt(socket.SOL_SOCKET, _SO_REUSEPORT, 1)
             try:
                 socket_.bind(self.server_address)
             except Exception, e:
@@ -541,6 +1404,16 @@ class WebSocketServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
             self._logger.info('Close on: %r', addrinfo)
             socket_.close()
 
+        if self._worker_pool is not None:
+            self._worker_pool.stop()
+        self._rejected_requests_lock.acquire()
+        try:
+            for request in self._rejected_requests:
+                self.close_request(request)
+            self._rejected_requests.clear()
+        finally:
+            self._rejected_requests_lock.release()
+
     def fileno(self):
         """Override SocketServer.TCPServer.fileno."""
 
@@ -556,94 +1429,285 @@ class WebSocketServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
             util.get_stack_trace())
         # Note: client_address is a tuple.
 
+    def _set_tcp_nodelay(self, accepted_socket):
+        """Disables Nagle's algorithm so that frames (or buffers flushed in
+        cork mode) are sent without waiting for ACKs of previous ones.
+        """
+
+        try:
+            accepted_socket.setsockopt(
+                socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        except socket.error, e:
+            self._logger.debug('Failed to set TCP_NODELAY: %r', e)
+
     def get_request(self):
         """Override TCPServer.get_request to wrap OpenSSL.SSL.Connection
         object with _StandaloneSSLConnection to provide makefile method. We
         cannot substitute OpenSSL.SSL.Connection.makefile since it's readonly
         attribute.
+
+        The TLS handshake is not done here but in finish_request so that a
+        slow client doesn't block accepting other connections.
         """
 
         accepted_socket, client_address = self.socket.accept()
 
+        # Listening sockets are non-blocking in serve_forever. Accepted
+        # sockets inherit it on some platforms.
+        accepted_socket.setblocking(1)
+        self._set_tcp_nodelay(accepted_socket)
+
         server_options = self.websocket_server_options
         if server_options.use_tls:
-            if server_options.tls_module == _TLS_BY_STANDARD_MODULE:
-                try:
-                    accepted_socket.do_handshake()
-                except ssl.SSLError, e:
-                    self._logger.debug('%r', e)
-                    raise
-
-                # Print cipher in use. Handshake is done on accept.
-                self._logger.debug('Cipher: %s', accepted_socket.cipher())
-                self._logger.debug('Client cert: %r',
-                                   accepted_socket.getpeercert())
-            elif server_options.tls_module == _TLS_BY_PYOPENSSL:
-                # We cannot print the cipher in use. pyOpenSSL doesn't provide
-                # any method to fetch that.
-
-                ctx = OpenSSL.SSL.Context(OpenSSL.SSL.SSLv23_METHOD)
-                ctx.use_privatekey_file(server_options.private_key)
-                ctx.use_certificate_file(server_options.certificate)
-
-                def default_callback(conn, cert, errnum, errdepth, ok):
-                    return ok == 1
-
-                # See the OpenSSL document for SSL_CTX_set_verify.
-                if server_options.tls_client_auth:
-                    verify_mode = OpenSSL.SSL.VERIFY_PEER
-                    if not server_options.tls_client_cert_optional:
-                        verify_mode |= OpenSSL.SSL.VERIFY_FAIL_IF_NO_PEER_CERT
-                    ctx.set_verify(verify_mode, default_callback)
-                    ctx.load_verify_locations(server_options.tls_client_ca,
-                                              None)
-                else:
-                    ctx.set_verify(OpenSSL.SSL.VERIFY_NONE, default_callback)
-
-                accepted_socket = OpenSSL.SSL.Connection(ctx, accepted_socket)
+            if server_options.tls_module == _TLS_BY_PYOPENSSL:
+                accepted_socket = OpenSSL.SSL.Connection(
+                    self._tls_context, accepted_socket)
                 accepted_socket.set_accept_state()
-
-                # Convert SSL related error into socket.error so that
-                # SocketServer ignores them and keeps running.
-                #
-                # TODO(tyoshino): Convert all kinds of errors.
-                try:
-                    accepted_socket.do_handshake()
-                except OpenSSL.SSL.Error, e:
-                    # Set errno part to 1 (SSL_ERROR_SSL) like the ssl module
-                    # does.
-                    self._logger.debug('%r', e)
-                    raise socket.error(1, '%r' % e)
-                cert = accepted_socket.get_peer_certificate()
-                if cert is not None:
-                    self._logger.debug('Client cert subject: %r',
-                                       cert.get_subject().get_components())
                 accepted_socket = _StandaloneSSLConnection(accepted_socket)
-            else:
+            elif server_options.tls_module != _TLS_BY_STANDARD_MODULE:
                 raise ValueError('No TLS support module is available')
 
         return accepted_socket, client_address
 
+    def finish_request(self, request, client_address):
+        """Override SocketServer.BaseServer.finish_request to do the TLS
+        handshake on the thread processing the request.
+        """
+
+        if self.websocket_server_options.use_tls:
+            try:
+                self._do_tls_handshake(request)
+            except socket.error, e:
+                # Failed handshakes used to be ignored in get_request.
+                # Keep them out of the error log.
+                self._logger.debug('TLS handshake with %r failed: %r',
+                                   client_address, e)
+                return
+
+        BaseHTTPServer.HTTPServer.finish_request(
+            self, request, client_address)
+
+    def _do_tls_handshake(self, request):
+        """Does the TLS handshake on an accepted connection. Raises
+        socket.error if it fails or doesn't complete in
+        --tls-handshake-timeout seconds.
+        """
+
+        server_options = self.websocket_server_options
+        timeout = server_options.tls_handshake_timeout
+        if server_options.tls_module == _TLS_BY_STANDARD_MODULE:
+            # ssl.SSLError is a subclass of socket.error.
+            request.settimeout(timeout)
+            request.do_handshake()
+            request.settimeout(None)
+
+            # Print cipher in use.
+            self._logger.debug('Cipher: %s', request.cipher())
+            self._logger.debug('Client cert: %r', request.getpeercert())
+            return
+
+        # pyOpenSSL doesn't support socket timeouts. Do the handshake in
+        # non-blocking mode and wait for the socket until the deadline.
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+        request.setblocking(0)
+        while True:
+            try:
+                request.do_handshake()
+                break
+            except (OpenSSL.SSL.WantReadError,
+                    OpenSSL.SSL.WantWriteError), e:
+                wait_timeout = None
+                if deadline is not None:
+                    wait_timeout = deadline - time.time()
+                    if wait_timeout <= 0:
+                        raise socket.timeout('TLS handshake timed out')
+                if isinstance(e, OpenSSL.SSL.WantReadError):
+                    r, w, x = select.select([request], [], [], wait_timeout)
+                else:
+                    r, w, x = select.select([], [request], [], wait_timeout)
+            except OpenSSL.SSL.Error, e:
+                # Set errno part to 1 (SSL_ERROR_SSL) like the ssl module
+                # does.
+                raise socket.error(1, '%r' % e)
+        request.setblocking(1)
+
+        # We cannot print the cipher in use. pyOpenSSL doesn't provide any
+        # method to fetch that.
+        cert = request.get_peer_certificate()
+        if cert is not None:
+            self._logger.debug('Client cert subject: %r',
+                               cert.get_subject().get_components())
+
+    def process_request(self, request, client_address):
+        """Override SocketServer.ThreadingMixIn.process_request to process
+        the request on the worker pool if --max-workers is given.
+        """
+
+        if self._worker_pool is None:
+            SocketServer.ThreadingMixIn.process_request(
+                self, request, client_address)
+            return
+
+        if not self._worker_pool.submit(request, client_address):
+            self._logger.warning(
+                'Rejecting request from %r as all worker threads are busy',
+                client_address)
+            self._reject_request(request, client_address)
+
+    def _reject_request(self, request, client_address):
+        """Responds 503 Service Unavailable to a request without processing
+        it. The connection is closed by serve_forever when the client closes
+        it or after _REJECTED_REQUEST_LINGER seconds. Until then, data sent
+        by the client is read and discarded so that closing the socket
+        doesn't reset the connection before the client reads the response.
+
+        TLS connections are closed without a response since sending it would
+        need a TLS handshake, which may block the calling thread.
+        """
+
+        if self.websocket_server_options.use_tls:
+            self.close_request(request)
+            return
+
+        try:
+            request.sendall(_build_error_response(
+                common.HTTP_STATUS_SERVICE_UNAVAILABLE,
+                [('Retry-After', '1')]))
+            request.shutdown(socket.SHUT_WR)
+            request.setblocking(0)
+        except Exception, e:
+            self._logger.debug('Failed to send 503 to %r: %r',
+                               client_address, e)
+            self.close_request(request)
+            return
+
+        self._rejected_requests_lock.acquire()
+        try:
+            self._rejected_requests[request] = (
+                time.time() + _REJECTED_REQUEST_LINGER)
+        finally:
+            self._rejected_requests_lock.release()
+
+    def _get_rejected_requests(self):
+        self._rejected_requests_lock.acquire()
+        try:
+            return self._rejected_requests.keys()
+        finally:
+            self._rejected_requests_lock.release()
+
+    def _process_rejected_requests(self, readable_sockets):
+        """Discards data received on rejected requests, and returns the ones
+        to close as the client has closed the connection or the linger time
+        has passed.
+        """
+
+        now = time.time()
+        closed_requests = []
+        self._rejected_requests_lock.acquire()
+        try:
+            for request, deadline in self._rejected_requests.items():
+                if request in readable_sockets:
+                    try:
+                        if request.recv(_MAX_HANDSHAKE_REQUEST_SIZE):
+                            continue
+                    except Exception, e:
+                        self._logger.debug('%r', e)
+                elif now < deadline:
+                    continue
+                del self._rejected_requests[request]
+                closed_requests.append(request)
+        finally:
+            self._rejected_requests_lock.release()
+        return closed_requests
+
+    def get_accept_stats(self):
+        """Returns a dictionary of counters of accepted connections:
+        accepted, errors (failed accepts), wakeups (of the accept loop which
+        accepted connections) and max_accepted_per_wakeup.
+        """
+
+        stats = self._accept_stats
+        return {'accepted': stats.accepted,
+                'errors': stats.errors,
+                'wakeups': stats.wakeups,
+                'max_accepted_per_wakeup': stats.max_accepted_per_wakeup}
+
+    def _accept_requests(self, listening_socket):
+        """Accepts connections on the non-blocking listening_socket until it
+        would block and processes them. At most request_queue_size
+        connections are accepted so that the other sockets get their turn.
+        """
+
+        accepted = 0
+        self.socket = listening_socket
+        try:
+            while accepted < self.request_queue_size:
+                try:
+                    request, client_address = self.get_request()
+                except socket.error, e:
+                    if e.args[0] not in _WOULD_BLOCK_ERRORS:
+                        # The peer may have reset the connection, or another
+                        # process may have accepted it.
+                        self._logger.debug('Accept failed: %r', e)
+                        self._accept_stats.errors += 1
+                    break
+                accepted += 1
+                if not self.verify_request(request, client_address):
+                    self.shutdown_request(request)
+                    continue
+                try:
+                    self.process_request(request, client_address)
+                except Exception:
+                    self.handle_error(request, client_address)
+                    self.shutdown_request(request)
+        finally:
+            self.socket = None
+            self._accept_stats.record(accepted)
+
     def serve_forever(self, poll_interval=0.5):
-        """Override SocketServer.BaseServer.serve_forever."""
+        """Override SocketServer.BaseServer.serve_forever.
+
+        Listening sockets are watched by epoll where available, and
+        connections are accepted until the backlog is drained on each
+        wakeup.
+        """
 
         self.__ws_serving = True
         self.__ws_is_shut_down.clear()
-        handle_request = self.handle_request
-        if hasattr(self, '_handle_request_noblock'):
-            handle_request = self._handle_request_noblock
-        else:
-            self._logger.warning('Fallback to blocking request handler')
+        poller = _create_poller()
+        listening_sockets = {}
+        for socket_, unused_addrinfo in self._sockets:
+            socket_.setblocking(0)
+            listening_sockets[socket_.fileno()] = socket_
+            poller.register(socket_.fileno())
+        # Map from file descriptors to rejected requests registered to the
+        # poller.
+        rejected_requests = {}
         try:
             while self.__ws_serving:
-                r, w, e = select.select(
-                    [socket_[0] for socket_ in self._sockets],
-                    [], [], poll_interval)
-                for socket_ in r:
-                    self.socket = socket_
-                    handle_request()
-                self.socket = None
+                for request in self._get_rejected_requests():
+                    if request.fileno() not in rejected_requests:
+                        rejected_requests[request.fileno()] = request
+                        poller.register(request.fileno())
+                readable_requests = []
+                for fd, readable, unused_writable in poller.poll(
+                    poll_interval):
+                    if fd in listening_sockets:
+                        self._accept_requests(listening_sockets[fd])
+                    elif fd in rejected_requests:
+                        readable_requests.append(rejected_requests[fd])
+                for request in self._process_rejected_requests(
+                    readable_requests):
+                    fd = request.fileno()
+                    if rejected_requests.get(fd) is request:
+                        del rejected_requests[fd]
+                        poller.unregister(fd)
+                    self.close_request(request)
         finally:
+            for fd in listening_sockets.keys() + rejected_requests.keys():
+                poller.unregister(fd)
             self.__ws_is_shut_down.set()
 
     def shutdown(self):
@@ -653,6 +1717,402 @@ class WebSocketServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
         self.__ws_is_shut_down.wait()
 
 
+class EventLoopWebSocketServer(WebSocketServer):
+    """WebSocketServer serving all connections on one thread.
+
+    Sockets are non-blocking and watched by epoll (select where epoll is not
+    available). Accepting connections, opening handshakes and frames are
+    processed as the sockets become ready, and WebSocket handlers are called
+    for each event by web_socket_on_open, web_socket_on_message and
+    web_socket_on_close instead of web_socket_transfer_data. Handlers must
+    not block as they run on the event loop thread.
+
+    Only WebSocket requests (RFC 6455) for handlers defining
+    web_socket_on_message are served. TLS is not supported.
+    """
+
+    def __init__(self, options):
+        """Override WebSocketServer.__init__."""
+
+        WebSocketServer.__init__(self, options)
+
+        self._poller = None
+        # Map from file descriptors to _EventLoopConnection instances.
+        self._connections = {}
+        # Connections which have data to send or are to be closed.
+        self._pending_connections = set()
+        # Connections waiting for the peer's close frame.
+        self._closing_connections = set()
+
+        self._serving = False
+        self._is_shut_down = threading.Event()
+
+    def serve_forever(self, poll_interval=0.5):
+        """Override WebSocketServer.serve_forever."""
+
+        self._serving = True
+        self._is_shut_down.clear()
+        self._poller = _create_poller()
+        listening_sockets = {}
+        for socket_, unused_addrinfo in self._sockets:
+            socket_.setblocking(0)
+            listening_sockets[socket_.fileno()] = socket_
+            self._poller.register(socket_.fileno())
+        try:
+            while self._serving:
+                for fd, readable, writable in self._poller.poll(
+                    poll_interval):
+                    if fd in listening_sockets:
+                        self._accept(listening_sockets[fd])
+                        continue
+                    connection = self._connections.get(fd)
+                    if connection is None:
+                        # Closed while processing preceding events.
+                        continue
+                    try:
+                        if writable:
+                            self._send(connection)
+                        if readable and connection.socket is not None:
+                            self._receive(connection)
+                    except Exception:
+                        self.handle_error(connection.socket,
+                                          connection.remote_addr)
+                        self._close(connection)
+                self._send_pending_data()
+                self._expire_closing_connections()
+        finally:
+            for connection in self._connections.values():
+                self._close(connection)
+            for fd in listening_sockets:
+                self._poller.unregister(fd)
+            self._is_shut_down.set()
+
+    def shutdown(self):
+        """Override WebSocketServer.shutdown."""
+
+        self._serving = False
+        self._is_shut_down.wait()
+
+    def _add_pending_connection(self, connection):
+        self._pending_connections.add(connection)
+
+    def _accept(self, listening_socket):
+        """Accepts connections until listening_socket would block, or at
+        most request_queue_size connections.
+        """
+
+        accepted = 0
+        try:
+            while accepted < self.request_queue_size:
+                try:
+                    accepted_socket, client_address = (
+                        listening_socket.accept())
+                except socket.error, e:
+                    if e.args[0] not in _WOULD_BLOCK_ERRORS:
+                        # Another process may have accepted the connection,
+                        # or the peer may have reset it.
+                        self._logger.debug('Accept failed: %r', e)
+                        self._accept_stats.errors += 1
+                    break
+                accepted += 1
+
+                accepted_socket.setblocking(0)
+                self._set_tcp_nodelay(accepted_socket)
+
+                connection = _EventLoopConnection(
+                    self, accepted_socket, client_address)
+                self._connections[connection.fileno] = connection
+                self._poller.register(connection.fileno)
+        finally:
+            self._accept_stats.record(accepted)
+
+    def _close(self, connection):
+        """Closes the socket of connection and calls web_socket_on_close if
+        the opening handshake has completed.
+        """
+
+        if connection.socket is None:
+            return
+
+        self._poller.unregister(connection.fileno)
+        del self._connections[connection.fileno]
+        self._pending_connections.discard(connection)
+        self._closing_connections.discard(connection)
+        connection.socket.close()
+        connection.socket = None
+
+        request = connection.request
+        if request is None:
+            return
+        self._logger.debug('Connection closed (code=%r, reason=%r)',
+                           request.ws_close_code, request.ws_close_reason)
+        on_close = connection.handler_suite.on_close
+        if on_close is not None:
+            try:
+                on_close(request)
+            except Exception:
+                self._logger.error(
+                    '%s raised exception for %s:\n%s',
+                    dispatch._ON_CLOSE_HANDLER_NAME, request.ws_resource,
+                    util.get_stack_trace())
+
+    def _send(self, connection):
+        try:
+            done = connection.send_outgoing_data()
+        except socket.error, e:
+            self._logger.debug('Send failed: %r', e)
+            self._close(connection)
+            return
+
+        if done:
+            if connection.close_after_write:
+                self._close(connection)
+                return
+            if connection.waiting_writable:
+                self._poller.modify(connection.fileno, False)
+                connection.waiting_writable = False
+        elif not connection.waiting_writable:
+            self._poller.modify(connection.fileno, True)
+            connection.waiting_writable = True
+
+        if (connection.closing_deadline is not None and
+            not connection.close_after_write):
+            self._closing_connections.add(connection)
+
+    def _send_pending_data(self):
+        while self._pending_connections:
+            connection = self._pending_connections.pop()
+            if connection.socket is not None:
+                self._send(connection)
+
+    def _expire_closing_connections(self):
+        if not self._closing_connections:
+            return
+        now = time.time()
+        for connection in list(self._closing_connections):
+            if connection.close_after_write:
+                self._closing_connections.discard(connection)
+            elif now >= connection.closing_deadline:
+                self._logger.debug(
+                    'Timed out waiting for close frame from %r',
+                    connection.remote_addr)
+                self._close(connection)
+
+    def _receive(self, connection):
+        try:
+            data = connection.socket.recv(_EVENT_LOOP_RECEIVE_SIZE)
+        except socket.error, e:
+            if e.args[0] in _WOULD_BLOCK_ERRORS:
+                return
+            self._logger.debug('Receive failed: %r', e)
+            self._close(connection)
+            return
+
+        if not data:
+            self._close(connection)
+            return
+        if connection.close_after_write:
+            # Nothing more is processed on this connection.
+            return
+
+        if connection.request is None:
+            self._process_handshake(connection, data)
+        else:
+            self._process_frames(connection, data)
+
+    def _reject(self, connection, status, headers=[]):
+        connection.write(_build_error_response(status, headers))
+        connection.close_after_writing()
+
+    def _process_handshake(self, connection, data):
+        data = connection.handshake_buffer + data
+        end = data.find('\r\n\r\n')
+        if end < 0:
+            if len(data) > _MAX_HANDSHAKE_REQUEST_SIZE:
+                self._logger.info('Too large request from %r',
+                                  connection.remote_addr)
+                self._reject(connection, common.HTTP_STATUS_BAD_REQUEST)
+            else:
+                connection.handshake_buffer = data
+            return
+        connection.handshake_buffer = ''
+        remaining_data = data[end + 4:]
+
+        request = self._create_request(connection, data[:end + 4])
+        if request is None:
+            return
+
+        try:
+            _EventLoopHandshaker(
+                request,
+                self.websocket_server_options.dispatcher).do_handshake()
+        except handshake.VersionException, e:
+            self._logger.info('Handshake failed for version error: %s', e)
+            self._reject(connection, common.HTTP_STATUS_BAD_REQUEST,
+                         [(common.SEC_WEBSOCKET_VERSION_HEADER,
+                           e.supported_versions)])
+            return
+        except handshake.HandshakeException, e:
+            self._logger.info('Handshake failed for error: %s', e)
+            self._reject(connection, e.status)
+            return
+        except handshake.AbortedByUserException, e:
+            self._logger.info('Aborted: %s', e)
+            self._close(connection)
+            return
+
+        connection.request = request
+        if mux.use_mux(request):
+            self._logger.info('Mux is not supported in the event loop mode')
+            request.ws_stream.close_connection(
+                common.STATUS_INTERNAL_ENDPOINT_ERROR, wait_response=False)
+            return
+
+        on_open = connection.handler_suite.on_open
+        if on_open is not None and not self._call_handler(
+            connection, dispatch._ON_OPEN_HANDLER_NAME, on_open):
+            return
+        if remaining_data:
+            self._process_frames(connection, remaining_data)
+
+    def _create_request(self, connection, request_data):
+        """Parses the opening handshake request and checks it as
+        WebSocketRequestHandler.parse_request does. Returns an
+        _EventLoopRequest, or None after rejecting the request.
+        """
+
+        request_line, header_data = request_data.split('\r\n', 1)
+        words = request_line.split()
+        if len(words) != 3:
+            self._logger.info('Bad request line: %r', request_line)
+            self._reject(connection, common.HTTP_STATUS_BAD_REQUEST)
+            return None
+        method, path, protocol = words
+        # header_data ends with an empty line. Split it at LFs as
+        # mimetools.Message reads lines.
+        headers = _parse_handshake_headers(
+            [line + '\n' for line in header_data.split('\n')[:-2]])
+        if headers is None:
+            headers = mimetools.Message(StringIO.StringIO(header_data), 0)
+
+        server_options = self.websocket_server_options
+
+        if server_options.use_basic_auth:
+            auth = headers.getheader('Authorization')
+            if auth != server_options.basic_auth_credential:
+                self._logger.info('Request basic authentication')
+                self._reject(
+                    connection, 401,
+                    [('WWW-Authenticate', 'Basic realm="Pywebsocket"')])
+                return None
+
+        host, port, resource = http_header_util.parse_uri(path)
+        if (resource is None or
+            (host is not None and
+             server_options.validation_host is not None and
+             host != server_options.validation_host) or
+            (port is not None and
+             server_options.validation_port is not None and
+             port != server_options.validation_port)):
+            self._logger.info('Invalid URI: %r', path)
+            self._reject(connection, common.HTTP_STATUS_NOT_FOUND)
+            return None
+
+        try:
+            handler_suite = server_options.dispatcher.get_handler_suite(
+                resource)
+        except dispatch.DispatchException, e:
+            self._logger.info('Dispatch failed for error: %s', e)
+            self._reject(connection, e.status)
+            return None
+        if handler_suite is None or handler_suite.on_message is None:
+            self._logger.info('No event handler for resource: %r', resource)
+            self._reject(connection, common.HTTP_STATUS_NOT_FOUND)
+            return None
+        connection.handler_suite = handler_suite
+
+        request = _EventLoopRequest(
+            connection, method, resource, protocol, headers)
+        _set_stream_options_to_request(request, server_options)
+        return request
+
+    def _process_frames(self, connection, data):
+        request = connection.request
+        try:
+            events = request.ws_stream.feed(data)
+        except stream.InvalidFrameException, e:
+            self._fail(connection, common.STATUS_PROTOCOL_ERROR, e)
+            return
+        except stream.UnsupportedFrameException, e:
+            self._fail(connection, common.STATUS_UNSUPPORTED_DATA, e)
+            return
+        except stream.InvalidUTF8Exception, e:
+            self._fail(connection, common.STATUS_INVALID_FRAME_PAYLOAD_DATA, e)
+            return
+        except stream.MessageTooBigException, e:
+            self._fail(connection, common.STATUS_MESSAGE_TOO_BIG, e)
+            return
+
+        on_message = connection.handler_suite.on_message
+        for event in events:
+            if event.type == stream.EVENT_MESSAGE:
+                if request.server_terminated:
+                    continue
+                if not self._call_handler(
+                    connection, dispatch._ON_MESSAGE_HANDLER_NAME,
+                    on_message, event.data):
+                    return
+            elif event.type == stream.EVENT_CLOSE:
+                self._process_close(connection, event)
+
+    def _process_close(self, connection, event):
+        request = connection.request
+        request.client_terminated = True
+        request.ws_close_code = event.code
+        request.ws_close_reason = event.reason
+
+        if not request.server_terminated:
+            dispatcher = self.websocket_server_options.dispatcher
+            code, reason = dispatcher.passive_closing_handshake(request)
+            if code is None and reason is not None and len(reason) > 0:
+                self._logger.warning(
+                    'Handler specified reason despite code being None')
+                reason = ''
+            if reason is None:
+                reason = ''
+            request.ws_stream.close_connection(code, reason)
+        connection.close_after_writing()
+
+    def _fail(self, connection, code, error):
+        self._logger.debug('%s', error)
+        connection.request.ws_stream.close_connection(
+            code, wait_response=False)
+
+    def _call_handler(self, connection, name, handler, *args):
+        """Calls a web_socket_on_* handler. Returns False if the connection
+        has been failed for an exception raised by the handler.
+        """
+
+        request = connection.request
+        try:
+            handler(request, *args)
+            return True
+        except handshake.AbortedByUserException, e:
+            self._logger.info('Aborted: %s', e)
+            self._close(connection)
+        except Exception, e:
+            self._logger.error('%s raised exception for %s:\n%s',
+                               name, request.ws_resource,
+                               util.get_stack_trace())
+            if not request.server_terminated:
+                request.ws_stream.close_connection(
+                    common.STATUS_INTERNAL_ENDPOINT_ERROR,
+                    wait_response=False)
+            else:
+                connection.close_after_writing()
+        return False
+
+
 class WebSocketRequestHandler(CGIHTTPServer.CGIHTTPRequestHandler):
     """CGIHTTPRequestHandler specialized for WebSocket."""
 
@@ -675,6 +2135,9 @@ class WebSocketRequestHandler(CGIHTTPServer.CGIHTTPRequestHandler):
         # understand what this does.
         CGIHTTPServer.CGIHTTPRequestHandler.setup(self)
 
+        if not self.server.websocket_server_options.use_tls:
+            # The ssl module and pyOpenSSL don't support MSG_PEEK.
+            self.rfile = _PeekingSocketFile(self.connection)
         self.rfile = memorizingfile.MemorizingFile(
             self.rfile,
             max_memorized_lines=_MAX_MEMORIZED_LINES)
@@ -712,7 +2175,24 @@ class WebSocketRequestHandler(CGIHTTPServer.CGIHTTPRequestHandler):
         # handling (self.path, self.command, self.requestline, etc. See also
         # how _StandaloneRequest's members are implemented using these
         # attributes).
-        if not CGIHTTPServer.CGIHTTPRequestHandler.parse_request(self):
+        words = self.raw_requestline.split()
+        if (len(words) == 3 and words[0] == 'GET' and
+            words[2] == 'HTTP/1.1' and not self._options.use_basic_auth):
+            # Try the fast path for WebSocket requests.
+            header_lines = self._read_header_lines()
+            if header_lines[-1] in ('\r\n', '\n'):
+                headers = _parse_handshake_headers(header_lines[:-1])
+                if (headers is not None and
+                    headers.get(common.UPGRADE_HEADER, '').lower() ==
+                        common.WEBSOCKET_UPGRADE_TYPE and
+                    common.SEC_WEBSOCKET_VERSION_HEADER in headers):
+                    result = self._process_websocket_request_fast(
+                        words[1], headers)
+                    if result is not None:
+                        return result
+            if not self._parse_request_from_lines(header_lines):
+                return False
+        elif not CGIHTTPServer.CGIHTTPRequestHandler.parse_request(self):
             return False
 
         if self._options.use_basic_auth:
@@ -778,6 +2258,7 @@ class WebSocketRequestHandler(CGIHTTPServer.CGIHTTPRequestHandler):
         self.path = resource
 
         request = _StandaloneRequest(self, self._options.use_tls)
+        _set_stream_options_to_request(request, self._options)
 
         try:
             # Fallback to default http handler for request paths for which
@@ -792,17 +2273,104 @@ class WebSocketRequestHandler(CGIHTTPServer.CGIHTTPRequestHandler):
             self.send_error(e.status)
             return False
 
+        return self._process_websocket_request(
+            request,
+            lambda: handshake.do_handshake(
+                request,
+                self._options.dispatcher,
+                allowDraft75=self._options.allow_draft75,
+                strict=self._options.strict))
+
+    def _read_header_lines(self):
+        """Reads header lines up to and including the empty line ending
+        them. The lines are read through rfile so that they are memorized.
+        If the request ends or exceeds the limits of httplib first, returns
+        the lines read so far, which don't end with an empty line.
+        """
+
+        lines = []
+        readline = self.rfile.readline
+        while len(lines) <= _MAX_HEADERS:
+            line = readline(_MAX_HEADER_LINE_SIZE + 1)
+            lines.append(line)
+            if line in ('\r\n', '\n'):
+                return lines
+            if not line or len(line) > _MAX_HEADER_LINE_SIZE:
+                break
+        return lines
+
+    def _parse_request_from_lines(self, header_lines):
+        """Runs CGIHTTPRequestHandler.parse_request on header lines already
+        read from rfile.
+        """
+
+        rfile = self.rfile
+        self.rfile = StringIO.StringIO(''.join(header_lines))
+        try:
+            return CGIHTTPServer.CGIHTTPRequestHandler.parse_request(self)
+        finally:
+            self.rfile = rfile
+
+    def _process_websocket_request_fast(self, path, headers):
+        """Processes an RFC 6455 opening handshake request parsed by
+        _parse_handshake_headers, skipping BaseHTTPRequestHandler's parsing
+        and the handshakers for older protocols. Returns None to fall back
+        to the regular path for anything but a WebSocket request to an
+        existing handler.
+        """
+
+        host, port, resource = http_header_util.parse_uri(path)
+        if resource is None:
+            return None
+        server_options = self._options
+        if (host is not None and
+            server_options.validation_host is not None and
+            host != server_options.validation_host):
+            return None
+        if (port is not None and
+            server_options.validation_port is not None and
+            port != server_options.validation_port):
+            return None
+        try:
+            if not server_options.dispatcher.get_handler_suite(resource):
+                return None
+        except dispatch.DispatchException:
+            return None
+
+        # Set what BaseHTTPRequestHandler.parse_request would set.
+        self.close_connection = 1
+        self.command = 'GET'
+        self.path = resource
+        self.request_version = 'HTTP/1.1'
+        self.requestline = self.raw_requestline.rstrip('\r\n')
+        self.headers = headers
+
+        request = _StandaloneRequest(self, server_options.use_tls)
+        _set_stream_options_to_request(request, server_options)
+        return self._process_websocket_request(
+            request, lambda: self._do_hybi_handshake(request))
+
+    def _do_hybi_handshake(self, request):
+        try:
+            hybi.Handshaker(request, self._options.dispatcher).do_handshake()
+        except handshake.HandshakeException, e:
+            if not e.status:
+                e.status = common.HTTP_STATUS_BAD_REQUEST
+            raise
+        self._logger.info('Established (RFC 6455 protocol)')
+
+    def _process_websocket_request(self, request, do_handshake):
+        """Does the opening handshake by do_handshake and transfers data on
+        the WebSocket connection. Returns False.
+        """
+
         # If any Exceptions without except clause setup (including
         # DispatchException) is raised below this point, it will be caught
         # and logged by WebSocketServer.
 
         try:
             try:
-                handshake.do_handshake(
-                    request,
-                    self._options.dispatcher,
-                    allowDraft75=self._options.allow_draft75,
-                    strict=self._options.strict)
+                do_handshake()
             except handshake.VersionException, e:
                 self._logger.info('Handshake failed for version error: %s', e)
                 self.send_response(common.HTTP_STATUS_BAD_REQUEST)
@@ -816,6 +2384,7 @@ class WebSocketRequestHandler(CGIHTTPServer.CGIHTTPRequestHandler):
                 self.send_error(e.status)
                 return False
 
+            request.connection.use_socket_reader()
             request._dispatcher = self._options.dispatcher
             self._options.dispatcher.transfer_data(request)
         except handshake.AbortedByUserException, e:
@@ -974,6 +2543,11 @@ def _build_option_parser():
                       help=('Specifies a pem file which contains a set of '
                             'concatenated CA certificates which are used to '
                             'validate certificates passed from clients'))
+    parser.add_option('--tls-handshake-timeout',
+                      dest='tls_handshake_timeout', type='float',
+                      default=_DEFAULT_TLS_HANDSHAKE_TIMEOUT,
+                      help=('Close TLS connections whose handshake has not '
+                            'completed in the specified seconds.'))
     parser.add_option('--basic-auth', dest='use_basic_auth',
                       action='store_true', default=False,
                       help='Requires Basic authentication.')
@@ -1006,6 +2580,14 @@ def _build_option_parser():
                             'periodically in the specified inteval in '
                             'second. If non-positive integer is specified, '
                             'disable the thread monitor.'))
+    parser.add_option('--accept-monitor-interval-in-sec',
+                      dest='accept_monitor_interval_in_sec',
+                      type='int', default=-1,
+                      help=('If positive integer is specified, log the number '
+                            'and rate of accepted connections periodically '
+                            'in the specified interval in second. If '
+                            'non-positive integer is specified, disable the '
+                            'accept rate monitor.'))
     parser.add_option('--log-max', '--log_max', dest='log_max', type='int',
                       default=_DEFAULT_LOG_MAX_BYTES,
                       help='Log maximum bytes')
@@ -1020,6 +2602,80 @@ def _build_option_parser():
     parser.add_option('-q', '--queue', dest='request_queue_size', type='int',
                       default=_DEFAULT_REQUEST_QUEUE_SIZE,
                       help='request queue size')
+    parser.add_option('--max-workers', '--max_workers', dest='max_workers',
+                      type='int', default=None,
+                      help=('Process requests on a pool of at most the '
+                            'specified number of threads instead of a new '
+                            'thread for each request. Note that a WebSocket '
+                            'connection occupies a thread until it is '
+                            'closed.'))
+    parser.add_option('--worker-queue-size', '--worker_queue_size',
+                      dest='worker_queue_size', type='int',
+                      default=_DEFAULT_WORKER_QUEUE_SIZE,
+                      help=('Maximum number of requests waiting for a '
+                            'worker thread. Requests beyond it are '
+                            'rejected with status code 503.'))
+    parser.add_option('--worker-queue-timeout', '--worker_queue_timeout',
+                      dest='worker_queue_timeout', type='float',
+                      default=None,
+                      help=('Reject requests which have waited for a worker '
+                            'thread for longer than the specified seconds '
+                            'with status code 503. Not limited by '
+                            'default.'))
+    parser.add_option('--processes', dest='processes', type='int', default=1,
+                      help=('Number of server processes. When more than one, '
+                            'a supervisor process runs the specified number '
+                            'of server processes listening on the same port '
+                            'by SO_REUSEPORT, and restarts them when they '
+                            'die.'))
+    parser.add_option('--cpu-affinity', '--cpu_affinity', dest='cpu_affinity',
+                      action='store_true', default=False,
+                      help=('Pin each server process to a CPU. Used with '
+                            '--processes. Linux only.'))
+    parser.add_option('--server-mode', '--server_mode', dest='server_mode',
+                      type='choice', default=_SERVER_MODE_THREAD,
+                      choices=[_SERVER_MODE_THREAD, _SERVER_MODE_EVENTLOOP],
+                      help=('Use a thread for each request if "%s" is '
+                            'specified. Serve all WebSocket connections on '
+                            'one thread calling web_socket_on_* handlers if '
+                            '"%s" is specified.' %
+                            (_SERVER_MODE_THREAD, _SERVER_MODE_EVENTLOOP)))
+    parser.add_option('--max-frame-size', '--max_frame_size',
+                      dest='max_frame_size', type='int', default=None,
+                      help=('Maximum payload size of incoming frames in '
+                            'bytes. Larger frames are rejected with status '
+                            'code 1009 before reading their payload. Not '
+                            'limited by default.'))
+    parser.add_option('--max-message-size', '--max_message_size',
+                      dest='max_message_size', type='int', default=None,
+                      help=('Maximum size of incoming messages in bytes, '
+                            'counting all fragments. Not limited by '
+                            'default.'))
+    parser.add_option('--max-decompressed-size', '--max_decompressed_size',
+                      dest='max_decompressed_size', type='int', default=None,
+                      help=('Maximum size of incoming compressed messages '
+                            'after decompression in bytes. Not limited by '
+                            'default.'))
+    parser.add_option('--cork-flush-delay-ms', '--cork_flush_delay_ms',
+                      dest='cork_flush_delay_ms', type='float', default=None,
+                      help=('Enable cork mode. Outgoing frames are buffered '
+                            'and written together at most the specified '
+                            'milliseconds later. Disabled by default.'))
+    parser.add_option('--cork-flush-threshold', '--cork_flush_threshold',
+                      dest='cork_flush_threshold', type='int', default=None,
+                      help=('In cork mode, write buffered frames as soon as '
+                            'they reach the specified bytes.'))
+    parser.add_option('--keepalive-interval', '--keepalive_interval',
+                      dest='keepalive_interval', type='float', default=None,
+                      help=('Send a ping when nothing has been received on '
+                            'a WebSocket connection for the specified '
+                            'seconds while the handler is waiting for '
+                            'messages. Disabled by default. Not supported '
+                            'with pyOpenSSL.'))
+    parser.add_option('--keepalive-timeout', '--keepalive_timeout',
+                      dest='keepalive_timeout', type='float', default=None,
+                      help=('Fail WebSocket connections which do not answer '
+                            'a ping in the specified seconds.'))
 
     return parser
 
@@ -1046,6 +2702,188 @@ class ThreadMonitor(threading.Thread):
             time.sleep(self._interval_in_sec)
 
 
+class AcceptRateMonitor(threading.Thread):
+    daemon = True
+
+    def __init__(self, server, interval_in_sec):
+        threading.Thread.__init__(self, name='AcceptRateMonitor')
+
+        self._logger = util.get_class_logger(self)
+
+        self._server = server
+        self._interval_in_sec = interval_in_sec
+
+    def run(self):
+        last_stats = self._server.get_accept_stats()
+        last_time = time.time()
+        while True:
+            time.sleep(self._interval_in_sec)
+            stats = self._server.get_accept_stats()
+            now = time.time()
+            accepted = stats['accepted'] - last_stats['accepted']
+            wakeups = stats['wakeups'] - last_stats['wakeups']
+            self._logger.info(
+                'Accepted %d connections (%.1f/s) in %d wakeups, '
+                '%d failed accepts; %d connections in total, at most %d '
+                'per wakeup',
+                accepted,
+                accepted / (now - last_time),
+                wakeups,
+                stats['errors'] - last_stats['errors'],
+                stats['accepted'],
+                stats['max_accepted_per_wakeup'])
+            last_stats = stats
+            last_time = now
+
+
+def _serve(options):
+    """Runs the server in this process until it is shut down."""
+
+    if options.thread_monitor_interval_in_sec > 0:
+        # Run a thread monitor to show the status of server threads for
+        # debugging.
+        ThreadMonitor(options.thread_monitor_interval_in_sec).start()
+
+    if options.server_mode == _SERVER_MODE_EVENTLOOP:
+        server = EventLoopWebSocketServer(options)
+    else:
+        server = WebSocketServer(options)
+    if options.accept_monitor_interval_in_sec > 0:
+        AcceptRateMonitor(
+            server, options.accept_monitor_interval_in_sec).start()
+    server.serve_forever()
+
+
+def _get_cpu_count():
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return 1
+
+
+def _set_cpu_affinity(cpu):
+    """Pins this process to the given CPU. Only supported on Linux."""
+
+    import ctypes
+    import ctypes.util
+
+    libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    # cpu_set_t of glibc is 1024 bits.
+    mask = (ctypes.c_ulong * (1024 / (8 * ctypes.sizeof(ctypes.c_ulong))))()
+    bits_per_word = 8 * ctypes.sizeof(ctypes.c_ulong)
+    mask[cpu / bits_per_word] = 1 << (cpu % bits_per_word)
+    if libc.sched_setaffinity(0, ctypes.sizeof(mask), mask) != 0:
+        raise OSError(ctypes.get_errno(), 'sched_setaffinity failed')
+
+
+def _exit_on_parent_death():
+    """Makes the kernel send SIGTERM to this process when the parent
+    process dies so that server processes don't outlive the supervisor even
+    when it is killed by SIGKILL. Only supported on Linux.
+    """
+
+    try:
+        import ctypes
+        import ctypes.util
+
+        libc = ctypes.CDLL(ctypes.util.find_library('c'))
+        libc.prctl(_PR_SET_PDEATHSIG, signal.SIGTERM)
+    except Exception, e:
+        logging.debug('Failed to set parent death signal: %r', e)
+
+
+def _start_server_process(options, index):
+    """Forks a process running the server and returns its pid."""
+
+    pid = os.fork()
+    if pid:
+        return pid
+
+    # Child process.
+    exit_code = 0
+    try:
+        try:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            if sys.platform.startswith('linux'):
+                _exit_on_parent_death()
+            if options.cpu_affinity:
+                cpu = index % _get_cpu_count()
+                try:
+                    _set_cpu_affinity(cpu)
+                    logging.info('Server process %d pinned to CPU %d',
+                                 os.getpid(), cpu)
+                except Exception, e:
+                    logging.warning('Failed to pin server process to CPU '
+                                    '%d: %r', cpu, e)
+            _serve(options)
+        except KeyboardInterrupt:
+            pass
+        except Exception, e:
+            logging.critical('mod_pywebsocket: %s' % e)
+            logging.critical('mod_pywebsocket: %s' % util.get_stack_trace())
+            exit_code = 1
+    finally:
+        # Don't return to the caller running the supervisor loop.
+        os._exit(exit_code)
+
+
+def _supervise_server_processes(options):
+    """Runs options.processes server processes sharing the listening port
+    by SO_REUSEPORT, and restarts them when they die. Returns when this
+    process receives SIGTERM or SIGINT, after terminating them.
+    """
+
+    # Map from pids to (index, start time) of the server processes.
+    processes = {}
+    terminated = []
+
+    def handle_terminate(signum, frame):
+        terminated.append(signum)
+
+    signal.signal(signal.SIGTERM, handle_terminate)
+
+    try:
+        for index in xrange(options.processes):
+            pid = _start_server_process(options, index)
+            processes[pid] = (index, time.time())
+        logging.info('Started %d server processes: %r',
+                     options.processes, processes.keys())
+
+        while not terminated:
+            try:
+                pid, status = os.wait()
+            except OSError, e:
+                if e.errno == errno.EINTR:
+                    continue
+                raise
+            if pid not in processes:
+                continue
+            index, start_time = processes.pop(pid)
+            logging.warning('Server process %d exited with status %d',
+                            pid, status)
+            if terminated:
+                break
+            if time.time() - start_time < _PROCESS_RESTART_DELAY:
+                # Don't restart processes failing on startup in a busy loop.
+                time.sleep(_PROCESS_RESTART_DELAY)
+            pid = _start_server_process(options, index)
+            processes[pid] = (index, time.time())
+            logging.info('Restarted server process %d as %d', index, pid)
+    except KeyboardInterrupt:
+        pass
+
+    for pid in processes:
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except OSError:
+            pass
+    for pid in processes:
+        try:
+            os.waitpid(pid, 0)
+        except OSError:
+            pass
+
+
 def _parse_args_and_config(args):
     parser = _build_option_parser()
 
@@ -1148,6 +2986,13 @@ def _main(args=None):
                              options.tls_module)
             sys.exit(1)
 
+        if (options.tls_module == _TLS_BY_PYOPENSSL and
+            options.keepalive_interval is not None):
+            # Keepalive pings are written while the handler thread may be
+            # reading, which pyOpenSSL doesn't allow.
+            logging.critical('Keepalive is not supported with pyOpenSSL.')
+            sys.exit(1)
+
         if not options.private_key or not options.certificate:
             logging.critical(
                     'To use TLS, specify private_key and certificate.')
@@ -1179,14 +3024,36 @@ def _main(args=None):
         options.basic_auth_credential = 'Basic ' + base64.b64encode(
             options.basic_auth_credential)
 
-    try:
-        if options.thread_monitor_interval_in_sec > 0:
-            # Run a thread monitor to show the status of server threads for
-            # debugging.
-            ThreadMonitor(options.thread_monitor_interval_in_sec).start()
+    if options.server_mode == _SERVER_MODE_EVENTLOOP:
+        if options.use_tls:
+            logging.critical('TLS is not supported in the event loop server '
+                             'mode.')
+            sys.exit(1)
+        if (options.cork_flush_delay_ms is not None or
+            options.keepalive_interval is not None or
+            options.max_workers is not None):
+            logging.warning('Cork, keepalive and worker pool options are '
+                            'ignored in the event loop server mode.')
+
+    if options.max_workers is not None and options.max_workers <= 0:
+        logging.critical('--max-workers must be positive.')
+        sys.exit(1)
 
-        server = WebSocketServer(options)
-        server.serve_forever()
+    if options.processes > 1:
+        if not hasattr(os, 'fork') or _SO_REUSEPORT is None:
+            logging.critical('--processes requires fork and SO_REUSEPORT.')
+            sys.exit(1)
+        if options.port == 0:
+            logging.critical('Specify a port number to use --processes.')
+            sys.exit(1)
+    elif options.cpu_affinity:
+        logging.warning('--cpu-affinity is ignored without --processes.')
+
+    try:
+        if options.processes > 1:
+            _supervise_server_processes(options)
+        else:
+            _serve(options)
     except Exception, e:
         logging.critical('mod_pywebsocket: %s' % e)
         logging.critical('mod_pywebsocket: %s' % util.get_stack_trace())
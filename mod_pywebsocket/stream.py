@@ -35,9 +35,19 @@ from mod_pywebsocket._stream_base import BadOperationException
 from mod_pywebsocket._stream_base import ConnectionTerminatedException
 from mod_pywebsocket._stream_base import InvalidFrameException
 from mod_pywebsocket._stream_base import InvalidUTF8Exception
+from mod_pywebsocket._stream_base import MessageTooBigException
 from mod_pywebsocket._stream_base import UnsupportedFrameException
 from mod_pywebsocket._stream_hixie75 import StreamHixie75
+from mod_pywebsocket._stream_hybi import EVENT_CLOSE
+from mod_pywebsocket._stream_hybi import EVENT_FRAGMENT
+from mod_pywebsocket._stream_hybi import EVENT_MESSAGE
+from mod_pywebsocket._stream_hybi import EVENT_PING
+from mod_pywebsocket._stream_hybi import EVENT_PONG
 from mod_pywebsocket._stream_hybi import Frame
+from mod_pywebsocket._stream_hybi import FrameParser
+from mod_pywebsocket._stream_hybi import PreparedMessage
+from mod_pywebsocket._stream_hybi import ProtocolCore
+from mod_pywebsocket._stream_hybi import ProtocolEvent
 from mod_pywebsocket._stream_hybi import Stream
 from mod_pywebsocket._stream_hybi import StreamOptions
 
@@ -51,6 +61,8 @@ from mod_pywebsocket._stream_hybi import create_pong_frame
 from mod_pywebsocket._stream_hybi import create_binary_frame
 from mod_pywebsocket._stream_hybi import create_text_frame
 from mod_pywebsocket._stream_hybi import create_closing_handshake_body
+from mod_pywebsocket._stream_hybi import parse_frame
+from mod_pywebsocket._stream_hybi import parse_frame_as_frame_object
 
 
 # vi:sts=4 sw=4 et
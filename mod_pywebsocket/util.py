@@ -32,6 +32,7 @@
 
 
 import array
+import binascii
 import errno
 
 # Import hash classes from a module available and recommended for each Python
@@ -48,10 +49,12 @@ except ImportError:
     sha1_hash = sha.sha
 
 import StringIO
+import collections
 import logging
 import os
 import re
 import socket
+import threading
 import traceback
 import zlib
 
@@ -60,6 +63,11 @@ try:
 except ImportError:
     pass
 
+try:
+    import numpy
+except ImportError:
+    pass
+
 
 def get_stack_trace():
     """Get the current stack trace as string.
@@ -152,6 +160,69 @@ def get_class_logger(o):
         '%s.%s' % (o.__class__.__module__, o.__class__.__name__))
 
 
+class LRUCache(object):
+    """A thread-safe mapping which holds at most max_size entries.
+
+    When a new entry is put into a full cache, the least recently used
+    entry is evicted.
+    """
+
+    def __init__(self, max_size):
+        if max_size <= 0:
+            raise ValueError('max_size must be positive: %r' % max_size)
+
+        self._max_size = max_size
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """Returns the value for key and marks it as most recently used.
+        Returns default if key is not in the cache.
+        """
+
+        self._lock.acquire()
+        try:
+            try:
+                value = self._entries.pop(key)
+            except KeyError:
+                return default
+            self._entries[key] = value
+            return value
+        finally:
+            self._lock.release()
+
+    def put(self, key, value):
+        """Puts value for key evicting the least recently used entry if the
+        cache is full.
+        """
+
+        self._lock.acquire()
+        try:
+            self._entries.pop(key, None)
+            if len(self._entries) >= self._max_size:
+                self._entries.popitem(last=False)
+            self._entries[key] = value
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        """Removes all entries."""
+
+        self._lock.acquire()
+        try:
+            self._entries.clear()
+        finally:
+            self._lock.release()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+# Payloads shorter than this are masked by _mask_using_long even when NumPy is
+# available since the overhead of creating NumPy arrays dominates for them.
+_NUMPY_MASKING_MIN_SIZE = 256
+
+
 class NoopMasker(object):
     """A NoOp masking object.
 
@@ -182,6 +253,14 @@ class RepeatedXorMasker(object):
         self._masking_key = masking_key
         self._masking_key_index = 0
 
+    def _get_rotated_masking_key(self):
+        """Returns the masking key rotated so that it starts at the current
+        position.
+        """
+
+        index = self._masking_key_index
+        return self._masking_key[index:] + self._masking_key[:index]
+
     def _mask_using_swig(self, s):
         """Perform the mask via SWIG."""
         masked_data = fast_masking.mask(
@@ -190,8 +269,57 @@ class RepeatedXorMasker(object):
                 (self._masking_key_index + len(s)) % len(self._masking_key))
         return masked_data
 
+    def _mask_using_numpy(self, s):
+        """Perform the mask via NumPy, 8 octets at a time."""
+
+        length = len(s)
+        masking_key = self._get_rotated_masking_key()
+        masking_key_size = len(masking_key)
+        if length < _NUMPY_MASKING_MIN_SIZE or 8 % masking_key_size != 0:
+            return self._mask_using_long(s)
+
+        # Repeat the key to fill a 64-bit word. As the number of octets
+        # masked as words is a multiple of the key size, the remaining octets
+        # start at the beginning of word_key again.
+        word_key = masking_key * (8 / masking_key_size)
+        num_words = length / 8
+        words = numpy.frombuffer(s, dtype=numpy.uint64, count=num_words)
+        masked_words = numpy.bitwise_xor(
+            words, numpy.frombuffer(word_key, dtype=numpy.uint64))
+
+        result = [masked_words.tostring()]
+        for i in xrange(num_words * 8, length):
+            result.append(chr(ord(s[i]) ^ ord(word_key[i % 8])))
+
+        self._masking_key_index = (
+                (self._masking_key_index + length) % masking_key_size)
+
+        return ''.join(result)
+
+    def _mask_using_long(self, s):
+        """Perform the mask via python by converting the string and the
+        repeated masking key into long integers and XORing them at once. The
+        long integer arithmetic processes many octets per machine word.
+        """
+
+        length = len(s)
+        if length == 0:
+            return ''
+
+        masking_key = self._get_rotated_masking_key()
+        masking_key_size = len(masking_key)
+        repeated_key = masking_key * (length / masking_key_size + 1)
+
+        masked = (int(binascii.hexlify(s), 16) ^
+                  int(binascii.hexlify(repeated_key[:length]), 16))
+
+        self._masking_key_index = (
+                (self._masking_key_index + length) % masking_key_size)
+
+        return binascii.unhexlify('%0*x' % (length * 2, masked))
+
     def _mask_using_array(self, s):
-        """Perform the mask via python."""
+        """Perform the mask via python, one octet at a time."""
         result = array.array('B')
         result.fromstring(s)
 
@@ -211,8 +339,10 @@ class RepeatedXorMasker(object):
 
     if 'fast_masking' in globals():
         mask = _mask_using_swig
+    elif 'numpy' in globals():
+        mask = _mask_using_numpy
     else:
-        mask = _mask_using_array
+        mask = _mask_using_long
 
 
 # By making wbits option negative, we can suppress CMF/FLG (2 octet) and
@@ -370,11 +500,20 @@ class _RFC1979Inflater(object):
     def __init__(self, window_bits=zlib.MAX_WBITS):
         self._inflater = _Inflater(window_bits)
 
-    def filter(self, bytes):
-        # Restore stripped LEN and NLEN field of a non-compressed block added
-        # for Z_SYNC_FLUSH.
-        self._inflater.append(bytes + '\x00\x00\xff\xff')
-        return self._inflater.decompress(-1)
+    def filter(self, bytes, end=True, size=-1):
+        """Decompresses bytes. When a message is given in pieces, end should
+        be False for all but the last piece.
+
+        If size is positive, at most size bytes are decompressed and the
+        rest of the input is left unconsumed.
+        """
+
+        if end:
+            # Restore stripped LEN and NLEN field of a non-compressed block
+            # added for Z_SYNC_FLUSH.
+            bytes += '\x00\x00\xff\xff'
+        self._inflater.append(bytes)
+        return self._inflater.decompress(size)
 
 
 class DeflateSocket(object):
@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+#
+# Copyright 2014, Google Inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+#
+#     * Redistributions of source code must retain the above copyright
+# notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above
+# copyright notice, this list of conditions and the following disclaimer
+# in the documentation and/or other materials provided with the
+# distribution.
+#     * Neither the name of Google Inc. nor the names of its
+# contributors may be used to endorse or promote products derived from
+# this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""Benchmark for the per-message overhead of sending and receiving small
+messages with and without extensions. The best of several runs is reported.
+
+Run this script under the src directory, i.e. the directory containing
+mod_pywebsocket, test, etc.
+
+    python test/benchmark_filter_pipeline.py
+"""
+
+
+import optparse
+import time
+
+import set_sys_path  # Update sys.path to locate mod_pywebsocket module.
+
+from mod_pywebsocket import common
+from mod_pywebsocket.extensions import DeflateFrameExtensionProcessor
+from mod_pywebsocket.extensions import PerMessageDeflateExtensionProcessor
+from mod_pywebsocket import stream
+from test import mock
+
+
+def _create_stream(processor_class, extension_name, read_data=''):
+    request = mock.MockRequest(connection=mock.MockConn(read_data))
+    request.ws_version = common.VERSION_HYBI_LATEST
+    options = stream.StreamOptions()
+    options.unmask_receive = False
+    if processor_class is not None:
+        processor = processor_class(
+            common.ExtensionParameter(extension_name))
+        processor.get_extension_response()
+        processor.setup_stream_options(options)
+    return stream.Stream(request, options)
+
+
+class _NullConn(object):
+    remote_addr = 'fake_address'
+
+    def write(self, data):
+        pass
+
+
+_CONFIGURATIONS = [
+    ('none', None, None),
+    ('deflate-frame', DeflateFrameExtensionProcessor,
+     common.DEFLATE_FRAME_EXTENSION),
+    ('permessage-deflate', PerMessageDeflateExtensionProcessor,
+     common.PERMESSAGE_DEFLATE_EXTENSION),
+]
+
+
+def _measure_send(processor_class, extension_name, message, iterations):
+    ws_stream = _create_stream(processor_class, extension_name)
+    ws_stream._request.connection = _NullConn()
+    start = time.time()
+    for unused_i in xrange(iterations):
+        ws_stream.send_message(message)
+    return (time.time() - start) / iterations * 1000 * 1000
+
+
+def _measure_receive(processor_class, extension_name, message, iterations):
+    # Frames sent by a stream with the same configuration are what a
+    # stream receiving them expects.
+    sender = _create_stream(processor_class, extension_name)
+    for unused_i in xrange(iterations):
+        sender.send_message(message)
+    data = sender._request.connection.written_data()
+
+    ws_stream = _create_stream(processor_class, extension_name, data)
+    start = time.time()
+    for unused_i in xrange(iterations):
+        ws_stream.receive_message()
+    return (time.time() - start) / iterations * 1000 * 1000
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--message-size', dest='message_size', type='int',
+                      default=16, help='Size of each message.')
+    parser.add_option('--iterations', dest='iterations', type='int',
+                      default=100000,
+                      help='Number of messages for each measurement.')
+    parser.add_option('--repeat', dest='repeat', type='int', default=5,
+                      help='Number of runs of each measurement.')
+    options, unused_args = parser.parse_args()
+
+    message = 'a' * options.message_size
+    print '%20s %14s %14s' % ('extension', 'send (us)', 'receive (us)')
+    for name, processor_class, extension_name in _CONFIGURATIONS:
+        send_results = []
+        receive_results = []
+        for unused_i in xrange(options.repeat):
+            send_results.append(_measure_send(
+                processor_class, extension_name, message,
+                options.iterations))
+            receive_results.append(_measure_receive(
+                processor_class, extension_name, message,
+                options.iterations))
+        print '%20s %14.2f %14.2f' % (
+            name, min(send_results), min(receive_results))
+
+
+if __name__ == '__main__':
+    main()
+
+
+# vi:sts=4 sw=4 et
@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+#
+# Copyright 2014, Google Inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+#
+#     * Redistributions of source code must retain the above copyright
+# notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above
+# copyright notice, this list of conditions and the following disclaimer
+# in the documentation and/or other materials provided with the
+# distribution.
+#     * Neither the name of Google Inc. nor the names of its
+# contributors may be used to endorse or promote products derived from
+# this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+"""Benchmark for building frame headers.
+
+Compares stream.create_header with the implementation which checked ranges
+and concatenated chr() results on every call.
+
+Run this script under the src directory, i.e. the directory containing
+mod_pywebsocket, test, etc.
+
+    python test/benchmark_frame_header.py
+"""
+
+
+import optparse
+import struct
+import time
+
+import set_sys_path  # Update sys.path to locate mod_pywebsocket module.
+
+from mod_pywebsocket import common
+from mod_pywebsocket import stream
+
+
+def _create_length_header_by_concatenation(length, mask):
+    if mask:
+        mask_bit = 1 << 7
+    else:
+        mask_bit = 0
+
+    if length < 0:
+        raise ValueError('length must be non negative integer')
+    elif length <= 125:
+        return chr(mask_bit | length)
+    elif length < (1 << 16):
+        return chr(mask_bit | 126) + struct.pack('!H', length)
+    elif length < (1 << 63):
+        return chr(mask_bit | 127) + struct.pack('!Q', length)
+    else:
+        raise ValueError('Payload is too big for one frame')
+
+
+def _create_header_by_concatenation(
+    opcode, payload_length, fin, rsv1, rsv2, rsv3, mask):
+    if opcode < 0 or 0xf < opcode:
+        raise ValueError('Opcode out of range')
+
+    if payload_length < 0 or (1 << 63) <= payload_length:
+        raise ValueError('payload_length out of range')
+
+    if (fin | rsv1 | rsv2 | rsv3) & ~1:
+        raise ValueError('FIN bit and Reserved bit parameter must be 0 or 1')
+
+    header = ''
+
+    first_byte = ((fin << 7)
+                  | (rsv1 << 6) | (rsv2 << 5) | (rsv3 << 4)
+                  | opcode)
+    header += chr(first_byte)
+    header += _create_length_header_by_concatenation(payload_length, mask)
+
+    return header
+
+
+_IMPLEMENTATIONS = [
+    ('concatenation', _create_header_by_concatenation),
+    ('current', stream.create_header),
+]
+
+_DEFAULT_LENGTHS = '5,125,126,65535,65536'
+
+
+def _measure(create_header, opcode, length, mask, iterations):
+    start = time.time()
+    for unused_i in xrange(iterations):
+        create_header(opcode, length, 1, 0, 0, 0, mask)
+    elapsed = time.time() - start
+    return iterations / elapsed / 1000 / 1000
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--lengths', dest='lengths', default=_DEFAULT_LENGTHS,
+                      help='Comma-separated payload lengths.')
+    parser.add_option('--iterations', dest='iterations', type='int',
+                      default=1000000,
+                      help='Number of headers built for each measurement.')
+    options, unused_args = parser.parse_args()
+
+    print '%10s %5s %s' % ('length', 'mask', ''.join(
+        ['%16s' % name for name, unused_function in _IMPLEMENTATIONS]))
+    for length in map(int, options.lengths.split(',')):
+        for mask in (False, True):
+            results = []
+            for unused_name, create_header in _IMPLEMENTATIONS:
+                results.append(_measure(create_header, common.OPCODE_TEXT,
+                                        length, mask, options.iterations))
+            print '%10d %5s %s' % (length, mask, ''.join(
+                ['%9.2f Mops/s' % result for result in results]))
+
+
+if __name__ == '__main__':
+    main()
+
+
+# vi:sts=4 sw=4 et
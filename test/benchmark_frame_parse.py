@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+#
+# Copyright 2014, Google Inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+#
+#     * Redistributions of source code must retain the above copyright
+# notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above
+# copyright notice, this list of conditions and the following disclaimer
+# in the documentation and/or other materials provided with the
+# distribution.
+#     * Neither the name of Google Inc. nor the names of its
+# contributors may be used to endorse or promote products derived from
+# this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""Benchmark for memory usage and speed of parsing received frames.
+
+Parses many small masked frames and keeps the resulting objects, comparing
+stream.parse_frame_as_frame_object with the implementation which returned a
+tuple from parse_frame and then built a Frame with an instance __dict__.
+Each implementation runs in a forked process so that the peak RSS of one
+doesn't affect another.
+
+Run this script under the src directory, i.e. the directory containing
+mod_pywebsocket, test, etc.
+
+    python test/benchmark_frame_parse.py
+"""
+
+
+import cStringIO
+import optparse
+import os
+import resource
+import sys
+import time
+
+import set_sys_path  # Update sys.path to locate mod_pywebsocket module.
+
+from mod_pywebsocket import stream
+
+
+class _DictFrame(object):
+    """Frame as it was before having __slots__."""
+
+    def __init__(self, fin=1, rsv1=0, rsv2=0, rsv3=0,
+                 opcode=None, payload=''):
+        self.fin = fin
+        self.rsv1 = rsv1
+        self.rsv2 = rsv2
+        self.rsv3 = rsv3
+        self.opcode = opcode
+        self.payload = payload
+
+
+def _parse_as_tuple(receive_bytes):
+    opcode, payload, fin, rsv1, rsv2, rsv3 = stream.parse_frame(
+        receive_bytes)
+    return _DictFrame(fin=fin, rsv1=rsv1, rsv2=rsv2, rsv3=rsv3,
+                      opcode=opcode, payload=payload)
+
+
+def _parse_as_frame_object(receive_bytes):
+    return stream.parse_frame_as_frame_object(receive_bytes)
+
+
+_IMPLEMENTATIONS = [
+    ('tuple', _parse_as_tuple),
+    ('current', _parse_as_frame_object),
+]
+
+
+def _get_frame_size(frame):
+    size = sys.getsizeof(frame)
+    if hasattr(frame, '__dict__'):
+        size += sys.getsizeof(frame.__dict__)
+    return size
+
+
+def _measure(parse, data, num_frames):
+    """Parses num_frames frames from data keeping all of them. Returns
+    the elapsed time, the size of each frame object and the growth of the
+    peak RSS in KiB.
+    """
+
+    receive_bytes = cStringIO.StringIO(data).read
+    start_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    frames = []
+    start = time.time()
+    for unused_i in xrange(num_frames):
+        frames.append(parse(receive_bytes))
+    elapsed = time.time() - start
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - start_rss
+    return elapsed, _get_frame_size(frames[0]), rss
+
+
+def _measure_in_child(parse, data, num_frames):
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        os.write(write_fd, repr(_measure(parse, data, num_frames)))
+        os._exit(0)
+    os.close(write_fd)
+    result = ''
+    while True:
+        received = os.read(read_fd, 1024)
+        if not received:
+            break
+        result += received
+    os.close(read_fd)
+    os.waitpid(pid, 0)
+    return eval(result)
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--frames', dest='frames', type='int',
+                      default=1000000,
+                      help='Number of frames parsed for each measurement.')
+    parser.add_option('--payload-size', dest='payload_size', type='int',
+                      default=5, help='Payload size of each frame.')
+    options, unused_args = parser.parse_args()
+
+    frame = stream.create_text_frame(
+        'a' * options.payload_size, mask=True)
+    data = frame * options.frames
+
+    print '%10s %14s %14s %16s' % (
+        'impl', 'frames/s', 'bytes/frame', 'peak RSS (KiB)')
+    for name, parse in _IMPLEMENTATIONS:
+        elapsed, frame_size, rss = _measure_in_child(
+            parse, data, options.frames)
+        print '%10s %14.0f %14d %16d' % (
+            name, options.frames / elapsed, frame_size, rss)
+
+
+if __name__ == '__main__':
+    main()
+
+
+# vi:sts=4 sw=4 et
@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+#
+# Copyright 2014, Google Inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+#
+#     * Redistributions of source code must retain the above copyright
+# notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above
+# copyright notice, this list of conditions and the following disclaimer
+# in the documentation and/or other materials provided with the
+# distribution.
+#     * Neither the name of Google Inc. nor the names of its
+# contributors may be used to endorse or promote products derived from
+# this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""Benchmark for the masking backends of util.RepeatedXorMasker.
+
+Run this script under the src directory, i.e. the directory containing
+mod_pywebsocket, test, etc.
+
+    python test/benchmark_masking.py
+
+Backends which are not available in the running environment (the SWIG
+fast_masking module, NumPy) are skipped.
+"""
+
+
+import optparse
+import os
+import time
+
+import set_sys_path  # Update sys.path to locate mod_pywebsocket module.
+
+from mod_pywebsocket import util
+
+
+_DEFAULT_SIZES = '16,125,1024,16384,65536,1048576'
+
+# Each measurement runs for at least this amount of bytes masked.
+_BYTES_PER_MEASUREMENT = 1 << 24
+
+
+def _available_backends():
+    backends = [('array', util.RepeatedXorMasker._mask_using_array),
+                ('long', util.RepeatedXorMasker._mask_using_long)]
+    if 'numpy' in util.__dict__:
+        backends.append(('numpy', util.RepeatedXorMasker._mask_using_numpy))
+    if 'fast_masking' in util.__dict__:
+        backends.append(('swig', util.RepeatedXorMasker._mask_using_swig))
+    return backends
+
+
+def _measure(backend, payload, max_time_in_sec):
+    iterations = max(1, _BYTES_PER_MEASUREMENT / len(payload))
+    masker = util.RepeatedXorMasker(os.urandom(4))
+
+    start = time.time()
+    count = 0
+    while count < iterations:
+        backend(masker, payload)
+        count += 1
+        if time.time() - start > max_time_in_sec:
+            break
+    elapsed = time.time() - start
+    return len(payload) * count / elapsed / 1000 / 1000
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--sizes', dest='sizes', default=_DEFAULT_SIZES,
+                      help='Comma-separated payload sizes in bytes.')
+    parser.add_option('--max-time', dest='max_time', type='float',
+                      default=2.0,
+                      help='Maximum time in seconds spent on each '
+                           'backend/size combination.')
+    options, unused_args = parser.parse_args()
+
+    backends = _available_backends()
+    print 'Default backend: %s' % util.RepeatedXorMasker.mask.__name__
+    print '%10s %s' % ('size', ''.join(
+        ['%12s' % name for name, unused_backend in backends]))
+    for size in map(int, options.sizes.split(',')):
+        payload = os.urandom(size)
+        results = []
+        for unused_name, backend in backends:
+            results.append(_measure(backend, payload, options.max_time))
+        print '%10d %s' % (size, ''.join(
+            ['%8.1f MB/s' % result for result in results]))
+
+
+if __name__ == '__main__':
+    main()
+
+
+# vi:sts=4 sw=4 et
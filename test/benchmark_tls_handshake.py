@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+#
+# Copyright 2014, Google Inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+#
+#     * Redistributions of source code must retain the above copyright
+# notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above
+# copyright notice, this list of conditions and the following disclaimer
+# in the documentation and/or other materials provided with the
+# distribution.
+#     * Neither the name of Google Inc. nor the names of its
+# contributors may be used to endorse or promote products derived from
+# this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""Benchmark for the cost of TLS handshakes on the server side when a TLS
+context is created for each connection (as the standalone server used to do
+with pyOpenSSL) and when one context is shared by all connections. The best
+of several runs is reported.
+
+Resumed handshakes are not measured since the ssl module of Python 2 cannot
+resume sessions on the client side.
+
+Run this script under the src directory, i.e. the directory containing
+mod_pywebsocket, test, etc.
+
+    python test/benchmark_tls_handshake.py
+"""
+
+
+import optparse
+import os
+import socket
+import ssl
+import threading
+import time
+
+
+_CERT_DIR = os.path.join(os.path.dirname(__file__), 'cert')
+
+
+def _create_server_context(options):
+    context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+    try:
+        # The test certificate uses a key too small for the default security
+        # level of recent OpenSSL.
+        context.set_ciphers('DEFAULT:@SECLEVEL=0')
+    except ssl.SSLError:
+        pass
+    context.load_cert_chain(options.certificate, options.private_key)
+    return context
+
+
+def _run_client(client_socket):
+    context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+    try:
+        context.set_ciphers('DEFAULT:@SECLEVEL=0')
+    except ssl.SSLError:
+        pass
+    tls_socket = context.wrap_socket(client_socket)
+    tls_socket.recv(1)
+    tls_socket.close()
+
+
+def _measure(options, shared):
+    """Returns the time in milliseconds per handshake."""
+
+    shared_context = _create_server_context(options)
+    elapsed = 0
+    for unused_i in xrange(options.handshakes):
+        server_socket, client_socket = [
+            socket.socket(_sock=s) for s in socket.socketpair()]
+        client = threading.Thread(target=_run_client, args=(client_socket,))
+        client.start()
+
+        start = time.time()
+        if shared:
+            context = shared_context
+        else:
+            context = _create_server_context(options)
+        tls_socket = context.wrap_socket(server_socket, server_side=True)
+        elapsed += time.time() - start
+
+        tls_socket.sendall('x')
+        client.join()
+        tls_socket.close()
+    return elapsed / options.handshakes * 1000
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('-c', '--certificate', dest='certificate',
+                      default=os.path.join(_CERT_DIR, 'cert.pem'),
+                      help='TLS certificate file.')
+    parser.add_option('-k', '--private-key', dest='private_key',
+                      default=os.path.join(_CERT_DIR, 'key.pem'),
+                      help='TLS private key file.')
+    parser.add_option('--handshakes', dest='handshakes', type='int',
+                      default=200,
+                      help='Number of handshakes for each measurement.')
+    parser.add_option('--repeat', dest='repeat', type='int', default=5,
+                      help='Number of runs of each measurement.')
+    options, unused_args = parser.parse_args()
+
+    print '%24s %16s' % ('context', 'handshake (ms)')
+    for name, shared in [('per connection', False), ('shared', True)]:
+        results = []
+        for unused_i in xrange(options.repeat):
+            results.append(_measure(options, shared))
+        print '%24s %16.3f' % (name, min(results))
+
+
+if __name__ == '__main__':
+    main()
+
+
+# vi:sts=4 sw=4 et
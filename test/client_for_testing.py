@@ -268,6 +268,10 @@ class _TLSSocket(object):
     def send(self, bytes):
         return self._ssl.write(bytes)
 
+    def sendall(self, bytes):
+        while bytes:
+            bytes = bytes[self._ssl.write(bytes):]
+
     def recv(self, size=-1):
         return self._ssl.read(size)
 
@@ -57,7 +57,7 @@ class _MockConnBase(object):
     def written_data(self):
         """Get bytes written to this mock."""
 
-        return ''.join(self._write_data)
+        return ''.join([str(data) for data in self._write_data])
 
 
 class MockConn(_MockConnBase):
@@ -78,6 +78,7 @@ class MockConn(_MockConnBase):
         _MockConnBase.__init__(self)
         self._read_data = read_data
         self._read_pos = 0
+        self.read_available_call_count = 0
 
     def readline(self):
         """Override mod_python.apache.mp_conn.readline."""
@@ -97,6 +98,12 @@ class MockConn(_MockConnBase):
         end_index = min(len(self._read_data), self._read_pos + length)
         return self._read_up_to(end_index)
 
+    def read_available(self, length):
+        """Mimic read_available() of the standalone server's connection."""
+
+        self.read_available_call_count += 1
+        return self.read(length)
+
     def _read_up_to(self, end_index):
         line = self._read_data[self._read_pos:end_index]
         self._read_pos = end_index
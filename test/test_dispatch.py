@@ -34,12 +34,16 @@
 
 
 import os
+import time
 import unittest
 
 import set_sys_path  # Update sys.path to locate mod_pywebsocket module.
 
+from mod_pywebsocket import common
 from mod_pywebsocket import dispatch
 from mod_pywebsocket import handshake
+from mod_pywebsocket.stream import Stream
+from mod_pywebsocket.stream import StreamOptions
 from test import mock
 
 
@@ -122,6 +126,36 @@ class DispatcherTest(unittest.TestCase):
                 'def web_socket_do_extra_handshake(request):pass\n'
                 'def web_socket_transfer_data(request):pass\n'))
 
+    def test_source_handler_file_with_event_handlers(self):
+        handler_suite = dispatch._source_handler_file(
+                'def web_socket_do_extra_handshake(request):pass\n'
+                'def web_socket_on_open(request):\n'
+                '    request.ws_stream.send_message("open")\n'
+                'def web_socket_on_message(request, message):\n'
+                '    request.ws_stream.send_message(message)\n'
+                'def web_socket_on_close(request):\n'
+                '    request.closed = True\n')
+        self.failUnless(handler_suite.on_open)
+        self.failUnless(handler_suite.on_message)
+        self.failUnless(handler_suite.on_close)
+
+        # web_socket_transfer_data is created to call them.
+        request = mock.MockRequest(
+            connection=mock.MockConn('\x00Hello\xff\xff\x00'))
+        handler_suite.transfer_data(request)
+        self.assertEqual('\x00open\xff\x00Hello\xff\xff\x00',
+                         request.connection.written_data())
+        self.failUnless(request.closed)
+
+        self.assertRaises(
+            dispatch.DispatchException, dispatch._source_handler_file,
+            'def web_socket_do_extra_handshake(request):pass\n'
+            'def web_socket_on_open(request):pass\n')
+        self.assertRaises(
+            dispatch.DispatchException, dispatch._source_handler_file,
+            'def web_socket_do_extra_handshake(request):pass\n'
+            'web_socket_on_message = 1\n')
+
     def test_source_warnings(self):
         dispatcher = dispatch.Dispatcher(_TEST_HANDLERS_DIR, None)
         warnings = dispatcher.source_warnings()
@@ -229,6 +263,19 @@ class DispatcherTest(unittest.TestCase):
             self.failUnless(str(e).find('Intentional') != -1,
                             'Unexpected exception: %s' % e)
 
+    def test_transfer_data_stops_keepalive(self):
+        dispatcher = dispatch.Dispatcher(_TEST_HANDLERS_DIR, None)
+        request = mock.MockRequest(connection=mock.MockConn(''))
+        request.ws_version = common.VERSION_HYBI_LATEST
+        request.ws_resource = '/sub/exception_in_transfer'
+        request.ws_protocol = 'p3'
+        stream_options = StreamOptions()
+        stream_options.keepalive_interval = 100
+        request.ws_stream = Stream(request, stream_options)
+        self.assertRaises(Exception, dispatcher.transfer_data, request)
+        self.assertEqual(
+            None, request.ws_stream._on_keepalive_timer(time.time()))
+
     def test_abort_transfer_data(self):
         dispatcher = dispatch.Dispatcher(_TEST_HANDLERS_DIR, None)
         request = mock.MockRequest()
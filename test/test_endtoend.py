@@ -37,17 +37,24 @@ the port on which the Apache server is running.
 """
 
 
+import base64
+from distutils import spawn
 import logging
 import os
+import shutil
 import signal
 import socket
 import subprocess
 import sys
+import tempfile
+import threading
 import time
 import unittest
 
 import set_sys_path  # Update sys.path to locate mod_pywebsocket module.
 
+from mod_pywebsocket import standalone
+from mod_pywebsocket import stream
 from test import client_for_testing
 from test import mux_client_for_testing
 
@@ -125,6 +132,36 @@ def _unmasked_frame_check_procedure(client):
     client.assert_connection_closed()
 
 
+def _send_handshake_and_frame_in_one_write(socket_):
+    """Sends an opening handshake for the echo handler followed by a text
+    frame in one write. Returns the response headers and the bytes received
+    after them once a frame header and the echoed 4 octet payload have
+    arrived.
+    """
+
+    socket_.settimeout(5)
+    socket_.sendall(
+        'GET /echo HTTP/1.1\r\n'
+        'Host: localhost\r\n'
+        'Upgrade: websocket\r\n'
+        'Connection: Upgrade\r\n'
+        'Sec-WebSocket-Key: %s\r\n'
+        'Sec-WebSocket-Version: 13\r\n'
+        'Origin: http://localhost\r\n'
+        '\r\n' % base64.b64encode(os.urandom(16)) +
+        stream.create_text_frame('test', mask=True))
+
+    received = ''
+    while True:
+        header_end = received.find('\r\n\r\n')
+        if header_end >= 0 and len(received) >= header_end + 4 + 6:
+            return received[:header_end], received[header_end + 4:]
+        data = socket_.recv(1024)
+        if not data:
+            return received, None
+        received += data
+
+
 def _mux_echo_check_procedure(mux_client):
     mux_client.connect()
     mux_client.send_flow_control(1, 1024)
@@ -197,13 +234,13 @@ class EndToEndTestBase(unittest.TestCase):
         return subprocess.Popen([sys.executable] + commandline, close_fds=True,
                                 stdout=stdout, stderr=stderr)
 
-    def _run_server(self):
+    def _run_server(self, extra_args=[]):
         args = [self.standalone_command,
                 '-H', 'localhost',
                 '-V', 'localhost',
                 '-p', str(self.test_port),
                 '-P', str(self.test_port),
-                '-d', self.document_root]
+                '-d', self.document_root] + extra_args
 
         # Inherit the level set to the root logger by test runner.
         root_logger = logging.getLogger()
@@ -658,6 +695,340 @@ class EndToEndHyBiTest(EndToEndTestBase):
         options.version = 99
         self._run_http_fallback_test(options, 400)
 
+    def test_worker_pool(self):
+        """Tests that requests are rejected with 503 when all worker threads
+        are busy, and that the thread is reused when it becomes idle.
+        """
+
+        server = self._run_server(
+            ['--max-workers', '1', '--worker-queue-size', '0'])
+        try:
+            time.sleep(_SERVER_WARMUP_IN_SEC)
+
+            client = client_for_testing.create_client(self._options)
+            try:
+                client.connect()
+                client.send_message('test')
+                client.assert_receive('test')
+
+                overflowing_client = client_for_testing.create_client(
+                    self._options)
+                try:
+                    overflowing_client.connect()
+                    self.fail('Could not catch HttpStatusException')
+                except client_for_testing.HttpStatusException, e:
+                    self.assertEqual(503, e.status)
+                finally:
+                    overflowing_client.close_socket()
+
+                client.send_close()
+                client.assert_receive_close()
+                client.assert_connection_closed()
+            finally:
+                client.close_socket()
+
+            # Wait for the thread to finish processing the first request.
+            time.sleep(0.1)
+
+            client = client_for_testing.create_client(self._options)
+            try:
+                _echo_check_procedure(client)
+            finally:
+                client.close_socket()
+        finally:
+            self._kill_process(server.pid)
+
+    def test_processes(self):
+        """Tests the server running multiple processes."""
+
+        if not sys.platform.startswith('linux'):
+            # Server processes survive the supervisor killed by
+            # _kill_process on other platforms.
+            return
+
+        server = self._run_server(['--processes', '2'])
+        try:
+            time.sleep(_SERVER_WARMUP_IN_SEC * 2)
+
+            for unused in range(4):
+                client = client_for_testing.create_client(self._options)
+                try:
+                    _echo_check_procedure(client)
+                finally:
+                    client.close_socket()
+        finally:
+            self._kill_process(server.pid)
+
+    def test_handshake_and_frame_in_one_write(self):
+        """Tests that a frame sent together with the opening handshake is
+        not lost when the server switches to reading frames.
+        """
+
+        server = self._run_server()
+        try:
+            time.sleep(_SERVER_WARMUP_IN_SEC)
+
+            socket_ = socket.create_connection(('localhost', self.test_port))
+            try:
+                response, frames = _send_handshake_and_frame_in_one_write(
+                    socket_)
+                self.assertTrue(response.startswith('HTTP/1.1 101 '))
+                self.assertEqual('\x81\x04test', frames)
+            finally:
+                socket_.close()
+        finally:
+            self._kill_process(server.pid)
+
+    def test_accept_backlog(self):
+        """Tests that all connections queued in the listen backlog are
+        served.
+        """
+
+        if not hasattr(signal, 'SIGSTOP'):
+            return
+
+        server = self._run_server()
+        try:
+            time.sleep(_SERVER_WARMUP_IN_SEC)
+
+            errors = []
+
+            def run_client():
+                client = client_for_testing.create_client(self._options)
+                try:
+                    _echo_check_procedure(client)
+                except Exception, e:
+                    errors.append(e)
+                finally:
+                    client.close_socket()
+
+            # Stop the server so that the connections queue up.
+            os.kill(server.pid, signal.SIGSTOP)
+            threads = [threading.Thread(target=run_client)
+                       for unused in range(10)]
+            for thread in threads:
+                thread.start()
+            time.sleep(0.1)
+            os.kill(server.pid, signal.SIGCONT)
+            for thread in threads:
+                thread.join()
+            self.assertEqual([], errors)
+        finally:
+            self._kill_process(server.pid)
+
+
+class EndToEndTLSTest(EndToEndTestBase):
+    """End-to-end tests of TLS connections. The openssl command is used to
+    create a certificate and as a client. The tests do nothing when it's
+    not available.
+    """
+
+    def setUp(self):
+        EndToEndTestBase.setUp(self)
+
+        self._options.use_tls = True
+
+        self._openssl = spawn.find_executable('openssl')
+        self._cert_dir = None
+        if self._openssl is None:
+            return
+
+        # The key in test/cert is too small for recent OpenSSL.
+        self._cert_dir = tempfile.mkdtemp()
+        self._certificate = os.path.join(self._cert_dir, 'cert.pem')
+        self._private_key = os.path.join(self._cert_dir, 'key.pem')
+        devnull = open(os.devnull, 'w')
+        try:
+            subprocess.check_call(
+                [self._openssl, 'req', '-x509', '-newkey', 'rsa:2048',
+                 '-nodes', '-days', '1', '-subj', '/CN=localhost',
+                 '-keyout', self._private_key, '-out', self._certificate],
+                stdout=devnull, stderr=devnull)
+        finally:
+            devnull.close()
+
+    def tearDown(self):
+        if self._cert_dir is not None:
+            shutil.rmtree(self._cert_dir)
+
+    def _run_tls_server(self, extra_args=[]):
+        return self._run_server(
+            ['-t', '-c', self._certificate, '-k', self._private_key] +
+            extra_args)
+
+    def _run_s_client(self, args):
+        """Runs openssl s_client connecting to the server with args and
+        returns its output.
+        """
+
+        s_client = subprocess.Popen(
+            [self._openssl, 's_client',
+             '-connect', 'localhost:%d' % self.test_port] + args,
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT, close_fds=True)
+        return s_client.communicate('')[0]
+
+    def test_echo_on_two_connections(self):
+        if self._openssl is None:
+            return
+
+        server = self._run_tls_server()
+        try:
+            time.sleep(_SERVER_WARMUP_IN_SEC)
+
+            for unused_i in xrange(2):
+                client = client_for_testing.create_client(self._options)
+                try:
+                    client.connect()
+                    client.send_message('test')
+                    client.assert_receive('test')
+                    client.send_close()
+                    client.assert_receive_close()
+                finally:
+                    client.close_socket()
+        finally:
+            self._kill_process(server.pid)
+
+    def test_connections_share_context(self):
+        if self._openssl is None or not standalone._import_ssl():
+            return
+
+        options, unused_args = standalone._parse_args_and_config(
+            ['-H', '127.0.0.1', '-p', '0', '-d', self.document_root,
+             '-t', '-c', self._certificate, '-k', self._private_key])
+        options.tls_module = standalone._TLS_BY_STANDARD_MODULE
+        options.scan_dir = options.websock_handlers
+        options.cgi_directories = []
+        options.is_executable_method = None
+        server = standalone.WebSocketServer(options)
+        try:
+            if server._tls_context is None:
+                # SSLContext is not available.
+                return
+
+            # serve_forever sets the listening socket to accept on.
+            server.socket = server._sockets[0][0]
+            clients = [
+                socket.create_connection(('127.0.0.1', server.server_port))
+                for unused_i in xrange(2)]
+            try:
+                for unused_client in clients:
+                    request, unused_address = server.get_request()
+                    try:
+                        self.assertTrue(request.context is server._tls_context)
+                    finally:
+                        request.close()
+            finally:
+                for client in clients:
+                    client.close()
+        finally:
+            server.server_close()
+
+    def test_handshake_and_frame_in_one_write(self):
+        """Tests that a frame sent together with the opening handshake is
+        not lost. With TLS, the frame is usually read into the buffer of the
+        file object used for the handshake.
+        """
+
+        if self._openssl is None or not standalone._import_ssl():
+            return
+
+        import ssl
+
+        server = self._run_tls_server()
+        try:
+            time.sleep(_SERVER_WARMUP_IN_SEC)
+
+            socket_ = ssl.wrap_socket(
+                socket.create_connection(('localhost', self.test_port)))
+            try:
+                response, frames = _send_handshake_and_frame_in_one_write(
+                    socket_)
+                self.assertTrue(response.startswith('HTTP/1.1 101 '))
+                self.assertEqual('\x81\x04test', frames)
+            finally:
+                socket_.close()
+        finally:
+            self._kill_process(server.pid)
+
+    def test_stalled_handshake(self):
+        """Tests that clients stalling in the TLS handshake don't keep other
+        clients from being served, and that they are disconnected after
+        --tls-handshake-timeout seconds.
+        """
+
+        if self._openssl is None:
+            return
+
+        tls_modules = ['ssl']
+        try:
+            import OpenSSL.SSL
+            tls_modules.append('pyopenssl')
+        except ImportError:
+            pass
+
+        for tls_module in tls_modules:
+            server = self._run_tls_server(
+                ['--tls-module', tls_module, '--tls-handshake-timeout', '1'])
+            try:
+                time.sleep(_SERVER_WARMUP_IN_SEC)
+
+                # One client sends nothing, and another stops in the middle
+                # of a ClientHello.
+                stalled_clients = [
+                    socket.create_connection(('localhost', self.test_port))
+                    for unused_i in xrange(2)]
+                stalled_clients[1].sendall('\x16\x03\x01\x02\x00\x01')
+                start = time.time()
+                try:
+                    client = client_for_testing.create_client(self._options)
+                    try:
+                        client.connect()
+                        client.send_message('test')
+                        client.assert_receive('test')
+                    finally:
+                        client.close_socket()
+                    self.assertTrue(time.time() - start < 1)
+
+                    for stalled_client in stalled_clients:
+                        stalled_client.settimeout(5)
+                        try:
+                            self.assertEqual('', stalled_client.recv(1))
+                        except socket.error, e:
+                            # The server may reset the connection as the
+                            # ClientHello is left unread.
+                            self.assertFalse(isinstance(e, socket.timeout))
+                    self.assertTrue(time.time() - start < 3)
+                finally:
+                    for stalled_client in stalled_clients:
+                        stalled_client.close()
+            finally:
+                self._kill_process(server.pid)
+
+    def test_session_resumption(self):
+        """Tests that connections share one TLS context by resuming a
+        session. Both the session cache and the session ticket keys belong
+        to a context, so a session can't be resumed on a connection using
+        another context.
+        """
+
+        if self._openssl is None:
+            return
+
+        server = self._run_tls_server()
+        try:
+            time.sleep(_SERVER_WARMUP_IN_SEC)
+
+            # -reconnect connects five more times resuming the session of the
+            # first connection. s_client doesn't resume TLS 1.3 sessions
+            # with it as the tickets arrive after the handshake.
+            output = self._run_s_client(['-tls1_2', '-reconnect'])
+            results = [line.split(',')[0] for line in output.splitlines()
+                       if line.startswith(('New,', 'Reused,'))]
+            self.assertEqual(['New'] + ['Reused'] * 5, results)
+        finally:
+            self._kill_process(server.pid)
+
 
 class EndToEndHyBi00Test(EndToEndTestBase):
     def setUp(self):
@@ -683,6 +1054,82 @@ class EndToEndHyBi00Test(EndToEndTestBase):
         self._run_test(_echo_check_procedure_with_goodbye)
 
 
+class EndToEndEventLoopTest(EndToEndTestBase):
+    def setUp(self):
+        EndToEndTestBase.setUp(self)
+
+    def _run_test(self, test_function):
+        server = self._run_server(['--server-mode', 'eventloop'])
+        try:
+            time.sleep(_SERVER_WARMUP_IN_SEC)
+
+            client = client_for_testing.create_client(self._options)
+            try:
+                test_function(client)
+            finally:
+                client.close_socket()
+        finally:
+            self._kill_process(server.pid)
+
+    def test_echo(self):
+        self._run_test(_echo_check_procedure)
+
+    def test_echo_binary(self):
+        self._run_test(_echo_check_procedure_with_binary)
+
+    def test_echo_server_close(self):
+        self._run_test(_echo_check_procedure_with_goodbye)
+
+    def test_echo_deflate_frame(self):
+        self._options.enable_deflate_frame()
+        self._run_test(_echo_check_procedure)
+
+    def test_unmasked_frame(self):
+        self._run_test(_unmasked_frame_check_procedure)
+
+    def test_close_on_invalid_frame(self):
+        def test_function(client):
+            client.connect()
+
+            client.send_message('\x80', raw=True)
+            client.assert_receive_close(
+                client_for_testing.STATUS_INVALID_FRAME_PAYLOAD_DATA)
+
+        self._run_test(test_function)
+
+    def test_handshake_and_frame_in_one_write(self):
+        server = self._run_server(['--server-mode', 'eventloop'])
+        try:
+            time.sleep(_SERVER_WARMUP_IN_SEC)
+
+            socket_ = socket.create_connection(('localhost', self.test_port))
+            try:
+                response, frames = _send_handshake_and_frame_in_one_write(
+                    socket_)
+                self.assertTrue(response.startswith('HTTP/1.1 101 '))
+                self.assertEqual('\x81\x04test', frames)
+            finally:
+                socket_.close()
+        finally:
+            self._kill_process(server.pid)
+
+    def test_handler_without_event_handlers(self):
+        """Tests that handlers defining only web_socket_transfer_data are
+        not served.
+        """
+
+        self._options.resource = '/close'
+
+        def test_function(client):
+            try:
+                client.connect()
+                self.fail('Could not catch HttpStatusException')
+            except client_for_testing.HttpStatusException, e:
+                self.assertEqual(404, e.status)
+
+        self._run_test(test_function)
+
+
 class EndToEndTestWithEchoClient(EndToEndTestBase):
     def setUp(self):
         EndToEndTestBase.setUp(self)
@@ -271,6 +271,32 @@ class PerMessageDeflateExtensionProcessorBuildingTest(unittest.TestCase):
         self.assertEqual('permessage-deflate', response.name())
         self.assertEqual(0, len(response.get_parameters()))
 
+    def test_repeated_offer(self):
+        parameter = common.ExtensionParameter('permessage-deflate')
+        parameter.add_parameter('server_max_window_bits', '11')
+        first_processor = extensions.PerMessageDeflateExtensionProcessor(
+            parameter)
+        second_processor = extensions.PerMessageDeflateExtensionProcessor(
+            parameter)
+
+        first_response = first_processor.get_extension_response()
+        second_response = second_processor.get_extension_response()
+        self.assertEqual([('server_max_window_bits', '11')],
+                         second_response.get_parameters())
+        self.assertIsNot(first_response, second_response)
+
+        # Compression state must not be shared between connections.
+        self.assertIsNot(first_processor._framer, second_processor._framer)
+        self.assertIsNot(first_processor._rfc1979_deflater,
+                         second_processor._rfc1979_deflater)
+        self.assertEqual(11, second_processor._rfc1979_deflater._window_bits)
+
+        # The negotiation result depends on the processor configuration too.
+        third_processor = extensions.PerMessageDeflateExtensionProcessor(
+            parameter)
+        third_processor.set_client_max_window_bits(10)
+        self.assertIsNone(third_processor.get_extension_response())
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -165,6 +165,18 @@ class ExtensionsParserTest(unittest.TestCase):
         for formatted_string in _TEST_BAD_EXTENSION_DATA:
             self.assertRaises(
                 ExtensionParsingException, parse_extensions, formatted_string)
+            # Parse again to check the memoized failure.
+            self.assertRaises(
+                ExtensionParsingException, parse_extensions, formatted_string)
+
+    def test_parse_returns_new_objects(self):
+        first_list = parse_extensions('foo; bar=1, baz')
+        first_list[0].add_parameter('qux', None)
+
+        second_list = parse_extensions('foo; bar=1, baz')
+        self.assertIsNot(first_list[0], second_list[0])
+        self._verify_extension_list(
+            [('foo', [('bar', '1')]), ('baz', [])], second_list)
 
 
 class FormatExtensionsTest(unittest.TestCase):
@@ -97,6 +97,16 @@ class UtilTest(unittest.TestCase):
             self.check_with_size(memorizing_file, size,
                                  ['Hello\n', 'World\n', 'Welcome'])
 
+    def test_detach(self):
+        file_ = StringIO.StringIO('Hello\nWorld\nWelcome')
+        memorizing_file = memorizingfile.MemorizingFile(file_)
+        self.assertEqual('Hello\n', memorizing_file.readline())
+        self.assertEqual('Wor', memorizing_file.readline(3))
+        detached_file, buffered_line = memorizing_file.detach()
+        self.assertTrue(detached_file is file_)
+        self.assertEqual('ld\n', buffered_line)
+        self.assertEqual('Welcome', detached_file.read())
+
 if __name__ == '__main__':
     unittest.main()
 
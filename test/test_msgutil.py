@@ -37,6 +37,7 @@ import array
 import Queue
 import random
 import struct
+import time
 import unittest
 import zlib
 
@@ -47,6 +48,8 @@ from mod_pywebsocket.extensions import DeflateFrameExtensionProcessor
 from mod_pywebsocket.extensions import PerMessageDeflateExtensionProcessor
 from mod_pywebsocket import msgutil
 from mod_pywebsocket.stream import InvalidUTF8Exception
+from mod_pywebsocket.stream import MessageTooBigException
+from mod_pywebsocket.stream import PreparedMessage
 from mod_pywebsocket.stream import Stream
 from mod_pywebsocket.stream import StreamHixie75
 from mod_pywebsocket.stream import StreamOptions
@@ -80,7 +83,8 @@ def _install_extension_processor(processor, request, stream_options):
 def _create_request_from_rawdata(
         read_data,
         deflate_frame_request=None,
-        permessage_deflate_request=None):
+        permessage_deflate_request=None,
+        stream_options=None):
     req = mock.MockRequest(connection=mock.MockConn(''.join(read_data)))
     req.ws_version = common.VERSION_HYBI_LATEST
     req.ws_extension_processors = []
@@ -92,7 +96,8 @@ def _create_request_from_rawdata(
         processor = PerMessageDeflateExtensionProcessor(
                 permessage_deflate_request)
 
-    stream_options = StreamOptions()
+    if stream_options is None:
+        stream_options = StreamOptions()
     if processor is not None:
         _install_extension_processor(processor, req, stream_options)
     req.ws_stream = Stream(req, stream_options)
@@ -190,6 +195,165 @@ class BasicMessageTest(unittest.TestCase):
         self.assertEqual('\x01\x05Hello\x00\x01 \x00\x05World\x80\x01!',
                          request.connection.written_data())
 
+    def test_send_message_buffers(self):
+        request = _create_request()
+        msgutil.send_message(request, ['Hello', ' ', 'World'])
+        self.assertEqual('\x81\x0bHello World',
+                         request.connection.written_data())
+
+        request = _create_request()
+        msgutil.send_message(request, [u'\u65e5', 'a'])
+        self.assertEqual('\x81\x04\xe6\x97\xa5a',
+                         request.connection.written_data())
+
+        # str parts of text messages are taken as encoded in UTF-8.
+        request = _create_request()
+        msgutil.send_message(request, ['\xe6\x97\xa5', u'a'])
+        self.assertEqual('\x81\x04\xe6\x97\xa5a',
+                         request.connection.written_data())
+
+        request = _create_request()
+        request.ws_stream.set_outgoing_max_frame_payload_size(2)
+        msgutil.send_message(request, ['\xe6\x97\xa5', u'a'])
+        self.assertEqual('\x01\x02\xe6\x97\x80\x02\xa5a',
+                         request.connection.written_data())
+
+        request = _create_request()
+        self.assertRaises(msgutil.BadOperationException,
+                          msgutil.send_message,
+                          request, ['a', u'\u65e5'], binary=True)
+
+    def test_send_large_message_without_concatenation(self):
+        payload = 'a' * (1 << 16)
+        request = _create_request()
+        msgutil.send_message(request, [payload, payload], binary=True)
+        # The header and each payload buffer are written separately.
+        self.assertEqual(['\x82\x7f\x00\x00\x00\x00\x00\x02\x00\x00',
+                          payload, payload],
+                         request.connection._write_data)
+
+    def test_send_message_with_max_frame_payload_size(self):
+        request = _create_request()
+        request.ws_stream.set_outgoing_max_frame_payload_size(5)
+        msgutil.send_message(request, 'HelloWorld!')
+        self.assertEqual('\x01\x05Hello\x00\x05World\x80\x01!',
+                         request.connection.written_data())
+
+        # Text messages are fragmented after being encoded.
+        request = _create_request()
+        request.ws_stream.set_outgoing_max_frame_payload_size(2)
+        msgutil.send_message(request, u'\u65e5')
+        self.assertEqual('\x01\x02\xe6\x97\x80\x01\xa5',
+                         request.connection.written_data())
+
+        request = _create_request()
+        request.ws_stream.set_outgoing_max_frame_payload_size(5)
+        msgutil.send_message(request, 'Hello', end=False, binary=True)
+        msgutil.send_message(request, 'World!', binary=True)
+        self.assertEqual('\x02\x05Hello\x00\x05World\x80\x01!',
+                         request.connection.written_data())
+
+    def test_send_messages(self):
+        request = _create_request()
+        msgutil.send_messages(request, ['Hello', u'\u65e5', ''])
+        self.assertEqual(1, len(request.connection._write_data))
+        self.assertEqual('\x81\x05Hello\x81\x03\xe6\x97\xa5\x81\x00',
+                         request.connection.written_data())
+
+        request = _create_request()
+        msgutil.send_messages(request, iter(['Hello', 'World!']), binary=True)
+        self.assertEqual(1, len(request.connection._write_data))
+        self.assertEqual('\x82\x05Hello\x82\x06World!',
+                         request.connection.written_data())
+
+        request = _create_request()
+        msgutil.send_messages(request, [])
+        self.assertEqual([], request.connection._write_data)
+
+        request = _create_request()
+        self.assertRaises(msgutil.BadOperationException,
+                          msgutil.send_messages,
+                          request, [u'\u65e5'], True)
+
+    def test_send_prepared(self):
+        prepared = PreparedMessage(u'\u65e5')
+        requests = [_create_request() for i in xrange(3)]
+        for request in requests:
+            msgutil.send_prepared(request, prepared)
+            self.assertEqual('\x81\x03\xe6\x97\xa5',
+                             request.connection.written_data())
+        self.assertEqual(1, len(prepared._frames))
+
+        # Streams with another configuration build their own frames.
+        request = _create_request()
+        request.ws_stream.set_outgoing_max_frame_payload_size(2)
+        msgutil.send_prepared(request, prepared)
+        self.assertEqual('\x01\x02\xe6\x97\x80\x01\xa5',
+                         request.connection.written_data())
+        self.assertEqual(2, len(prepared._frames))
+
+        prepared = PreparedMessage('Hello', binary=True)
+        request = _create_request()
+        msgutil.send_prepared(request, prepared)
+        self.assertEqual('\x82\x05Hello', request.connection.written_data())
+
+        self.assertRaises(msgutil.BadOperationException,
+                          PreparedMessage, u'\u65e5', True)
+
+    def test_send_prepared_masked(self):
+        stream_options = StreamOptions()
+        stream_options.mask_send = True
+        prepared = PreparedMessage('Hello')
+        request = _create_request_from_rawdata(
+            '', stream_options=stream_options)
+        msgutil.send_prepared(request, prepared)
+        # Masked frames are not shared.
+        self.assertEqual({}, prepared._frames)
+        written_data = request.connection.written_data()
+        self.assertEqual('\x81\x85', written_data[:2])
+        masker = util.RepeatedXorMasker(written_data[2:6])
+        self.assertEqual('Hello', masker.mask(written_data[6:]))
+
+    def test_send_message_cork(self):
+        stream_options = StreamOptions()
+        stream_options.cork_flush_delay = 60
+        stream_options.cork_flush_threshold = 16
+        request = _create_request_from_rawdata(
+            '', stream_options=stream_options)
+        msgutil.send_message(request, 'Hello')
+        msgutil.send_message(request, 'World')
+        self.assertEqual([], request.connection._write_data)
+        request.ws_stream.flush()
+        self.assertEqual(['\x81\x05Hello\x81\x05World'],
+                         request.connection._write_data)
+
+        # Reaching the threshold flushes the buffer.
+        msgutil.send_message(request, 'Hello')
+        msgutil.send_message(request, 'WebSocket')
+        self.assertEqual('\x81\x05Hello\x81\x05World'
+                         '\x81\x05Hello\x81\x09WebSocket',
+                         request.connection.written_data())
+
+        # A close frame is written immediately.
+        msgutil.send_message(request, 'Bye')
+        request.ws_stream.close_connection(wait_response=False)
+        self.assertTrue(
+            request.connection.written_data().endswith(
+                '\x81\x03Bye\x88\x02\x03\xe8'))
+
+    def test_send_message_cork_deadline(self):
+        stream_options = StreamOptions()
+        stream_options.cork_flush_delay = 0.01
+        request = _create_request_from_rawdata(
+            '', stream_options=stream_options)
+        msgutil.send_message(request, 'Hello')
+        msgutil.send_message(request, 'World')
+        deadline = time.time() + 5
+        while not request.connection._write_data and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(['\x81\x05Hello\x81\x05World'],
+                         request.connection._write_data)
+
     def test_send_fragments_immediate_zero_termination(self):
         request = _create_request()
         msgutil.send_message(request, 'Hello World!', False)
@@ -261,6 +425,30 @@ class BasicMessageTest(unittest.TestCase):
             ('\x80\x82', '\xad\x97'))
         self.assertEqual(u'\u6f22\u5b57', msgutil.receive_message(request))
 
+    def test_receive_fragments_erroneous_unicode(self):
+        # The first fragment is invalid as UTF-8. It must be detected without
+        # waiting for the rest of the message, which never arrives here.
+        request = _create_request(('\x01\x82', '\x80\x81'))
+        self.assertRaises(InvalidUTF8Exception,
+                          msgutil.receive_message,
+                          request)
+
+        # The message ends in the middle of a UTF-8 sequence.
+        request = _create_request(
+            ('\x01\x82', 'Hi'), ('\x80\x82', '\xe6\xbc'))
+        self.assertRaises(InvalidUTF8Exception,
+                          msgutil.receive_message,
+                          request)
+
+    def test_receive_fragments_ascii_then_unicode(self):
+        request = _create_request(
+            ('\x01\x85', 'Hello'),
+            ('\x00\x82', ' \xe6'),
+            ('\x80\x82', '\xbc\xa2'))
+        message = msgutil.receive_message(request)
+        self.assertTrue(isinstance(message, unicode))
+        self.assertEqual(u'Hello \u6f22', message)
+
     def test_receive_fragments_immediate_zero_termination(self):
         request = _create_request(
             ('\x01\x8c', 'Hello World!'), ('\x80\x80', ''))
@@ -285,6 +473,109 @@ class BasicMessageTest(unittest.TestCase):
                           msgutil.receive_message,
                           request)
 
+    def test_receive_message_stream(self):
+        request = _create_request(
+            ('\x02\x85', 'Hello'),
+            ('\x00\x81', ' '),
+            ('\x80\x86', 'World!'),
+            ('\x81\x85', 'Hello'))
+        self.assertEqual(['Hello', ' ', 'World!'],
+                         list(msgutil.receive_message_stream(request)))
+        self.assertEqual(common.OPCODE_BINARY,
+                         request.ws_stream.get_last_received_opcode())
+        self.assertEqual([u'Hello'],
+                         list(msgutil.receive_message_stream(request)))
+
+    def test_receive_message_stream_unicode(self):
+        # UTF-8 encodes U+6f22 into e6bca2 and U+5b57 into e5ad97.
+        request = _create_request(
+            ('\x01\x82', '\xe6\xbc'),
+            ('\x00\x82', '\xa2\xe5'),
+            ('\x80\x82', '\xad\x97'))
+        self.assertEqual([u'\u6f22', u'\u5b57'],
+                         list(msgutil.receive_message_stream(request)))
+
+    def test_receive_message_stream_erroneous_unicode(self):
+        request = _create_request(
+            ('\x01\x82', 'Hi'), ('\x80\x82', '\x80\x81'))
+        message = msgutil.receive_message_stream(request)
+        self.assertEqual(u'Hi', message.next())
+        self.assertRaises(InvalidUTF8Exception, message.next)
+
+    def test_receive_message_stream_interleaved_ping(self):
+        request = _create_request(
+            ('\x01\x85', 'Hello'),
+            ('\x89\x85', 'Hello'),
+            ('\x80\x86', 'World!'))
+        self.assertEqual([u'Hello', u'World!'],
+                         list(msgutil.receive_message_stream(request)))
+        self.assertEqual('\x8a\x05Hello',
+                         request.connection.written_data())
+
+    def test_receive_message_stream_duplicate_start(self):
+        request = _create_request(
+            ('\x01\x85', 'Hello'), ('\x01\x85', 'World'))
+        message = msgutil.receive_message_stream(request)
+        self.assertEqual(u'Hello', message.next())
+        self.assertRaises(msgutil.InvalidFrameException, message.next)
+
+    def test_receive_message_stream_not_started(self):
+        request = _create_request(('\x80\x85', 'Hello'))
+        self.assertRaises(msgutil.InvalidFrameException,
+                          msgutil.receive_message_stream,
+                          request)
+
+    def test_receive_message_stream_close(self):
+        request = _create_request(
+            ('\x88\x8a', struct.pack('!H', 1000) + 'Good bye'))
+        self.assertEqual(None, msgutil.receive_message_stream(request))
+        self.assertTrue(request.client_terminated)
+
+    def test_receive_frame_too_big(self):
+        stream_options = StreamOptions()
+        stream_options.incoming_max_frame_payload_size = 5
+        request = _create_request_from_rawdata(
+            ['\x81\x85' + _mask_hybi('Hello'),
+             '\x81\x86' + _mask_hybi('World!')],
+            stream_options=stream_options)
+        self.assertEqual('Hello', msgutil.receive_message(request))
+        self.assertRaises(MessageTooBigException,
+                          msgutil.receive_message, request)
+
+        # The limit is checked before reading the payload. Reading the
+        # missing payload would raise ConnectionTerminatedException.
+        request = _create_request_from_rawdata(
+            ['\x82\xff' + struct.pack('!Q', 1 << 40) + '\x00' * 4],
+            stream_options=stream_options)
+        self.assertRaises(MessageTooBigException,
+                          msgutil.receive_message, request)
+
+    def test_receive_fragments_too_big(self):
+        stream_options = StreamOptions()
+        stream_options.incoming_max_message_size = 10
+        request = _create_request_from_rawdata(
+            ['\x81\x8a' + _mask_hybi('HelloWorld'),
+             '\x01\x85' + _mask_hybi('Hello'),
+             '\x00\x85' + _mask_hybi('World'),
+             '\x80\x81' + _mask_hybi('!')],
+            stream_options=stream_options)
+        self.assertEqual('HelloWorld', msgutil.receive_message(request))
+        self.assertRaises(MessageTooBigException,
+                          msgutil.receive_message, request)
+
+    def test_receive_message_stream_too_big(self):
+        stream_options = StreamOptions()
+        stream_options.incoming_max_message_size = 10
+        request = _create_request_from_rawdata(
+            ['\x01\x85' + _mask_hybi('Hello'),
+             '\x00\x85' + _mask_hybi('World'),
+             '\x80\x81' + _mask_hybi('!')],
+            stream_options=stream_options)
+        message = msgutil.receive_message_stream(request)
+        self.assertEqual(u'Hello', message.next())
+        self.assertEqual(u'World', message.next())
+        self.assertRaises(MessageTooBigException, message.next)
+
     def test_receive_message_discard(self):
         request = _create_request(
             ('\x8f\x86', 'IGNORE'), ('\x81\x85', 'Hello'),
@@ -414,6 +705,159 @@ class BasicMessageTest(unittest.TestCase):
         # Body mismatch.
         msgutil.receive_message(request)
 
+    def test_keepalive(self):
+        stream_options = StreamOptions()
+        stream_options.keepalive_interval = 100
+        request = _create_request_from_rawdata(
+            ['\x8a\x8b', _mask_hybi('keepalive 0'),
+             '\x81\x85', _mask_hybi('World')],
+            stream_options=stream_options)
+        ws_stream = request.ws_stream
+        self.assertEqual(None, request.ws_rtt)
+
+        now = time.time()
+        ws_stream._last_receive_time = now
+        # The handler is waiting for frames.
+        ws_stream._receive_start_time = now - 100
+        self.assertEqual(now + 100, ws_stream._on_keepalive_timer(now))
+        self.assertEqual('', request.connection.written_data())
+
+        # Nothing has been received for the interval.
+        ws_stream._last_receive_time = now - 100
+        self.assertEqual(now + 30, ws_stream._on_keepalive_timer(now))
+        self.assertEqual('\x89\x0bkeepalive 0',
+                         request.connection.written_data())
+        # The ping is still waiting for a pong.
+        self.assertEqual(
+            now + 30, ws_stream._on_keepalive_timer(now + 10))
+
+        ws_stream._receive_start_time = None
+        self.assertEqual('World', msgutil.receive_message(request))
+        self.assertTrue(request.ws_rtt >= 0)
+        # The pong updated the receive time.
+        self.assertTrue(ws_stream._on_keepalive_timer(now) > now + 99)
+
+    def test_keepalive_timeout(self):
+        class ShutdownRecordingConn(mock.MockConn):
+            def shutdown(self):
+                self.shutdown_called = True
+
+        stream_options = StreamOptions()
+        stream_options.keepalive_interval = 100
+        stream_options.keepalive_timeout = 5
+        request = mock.MockRequest(connection=ShutdownRecordingConn(''))
+        request.ws_version = common.VERSION_HYBI_LATEST
+        request.ws_stream = Stream(request, stream_options)
+        ws_stream = request.ws_stream
+
+        now = time.time() + 100
+        ws_stream._receive_start_time = now - 100
+        self.assertEqual(now + 5, ws_stream._on_keepalive_timer(now))
+        self.assertEqual(None, ws_stream._on_keepalive_timer(now + 5))
+        self.assertTrue(request.connection.shutdown_called)
+
+    def test_keepalive_while_not_receiving(self):
+        class ShutdownRecordingConn(mock.MockConn):
+            def shutdown(self):
+                self.shutdown_called = True
+
+        stream_options = StreamOptions()
+        stream_options.keepalive_interval = 100
+        stream_options.keepalive_timeout = 5
+        request = mock.MockRequest(connection=ShutdownRecordingConn(''))
+        request.ws_version = common.VERSION_HYBI_LATEST
+        request.ws_stream = Stream(request, stream_options)
+        ws_stream = request.ws_stream
+
+        # No ping is sent while the handler is not receiving.
+        now = time.time() + 100
+        self.assertEqual(now + 100, ws_stream._on_keepalive_timer(now))
+        self.assertEqual('', request.connection.written_data())
+
+        # The handler has been waiting for frames for the interval.
+        ws_stream._receive_start_time = now - 100
+        self.assertEqual(now + 5, ws_stream._on_keepalive_timer(now))
+
+        # A ping not answered while the handler was busy doesn't fail the
+        # connection. The timeout counts from when it started receiving.
+        ws_stream._receive_start_time = None
+        self.assertEqual(
+            now + 110, ws_stream._on_keepalive_timer(now + 10))
+        ws_stream._receive_start_time = now + 20
+        self.assertEqual(
+            now + 25, ws_stream._on_keepalive_timer(now + 20))
+        self.assertFalse(hasattr(request.connection, 'shutdown_called'))
+        self.assertEqual(None, ws_stream._on_keepalive_timer(now + 25))
+        self.assertTrue(request.connection.shutdown_called)
+
+    def test_keepalive_after_connection_terminated(self):
+        stream_options = StreamOptions()
+        stream_options.keepalive_interval = 100
+        # The peer drops the connection without a closing handshake.
+        request = _create_request_from_rawdata(
+            ['\x81\x85', _mask_hybi('Hello')], stream_options=stream_options)
+        ws_stream = request.ws_stream
+
+        now = time.time()
+        self.assertEqual('Hello', msgutil.receive_message(request))
+        self.assertEqual(now + 100, ws_stream._on_keepalive_timer(now))
+        self.assertRaises(msgutil.ConnectionTerminatedException,
+                          msgutil.receive_message, request)
+        self.assertFalse(request.server_terminated)
+        self.assertFalse(request.client_terminated)
+        # The timer stops so that the scheduler releases the stream.
+        self.assertEqual(None, ws_stream._on_keepalive_timer(now))
+        self.assertEqual('', request.connection.written_data())
+
+    def test_stop_keepalive(self):
+        stream_options = StreamOptions()
+        stream_options.keepalive_interval = 100
+        request = _create_request_from_rawdata(
+            [], stream_options=stream_options)
+        ws_stream = request.ws_stream
+
+        now = time.time()
+        ws_stream._last_receive_time = now - 100
+        ws_stream._receive_start_time = now - 100
+        ws_stream.stop_keepalive()
+        self.assertEqual(None, ws_stream._on_keepalive_timer(now))
+        self.assertEqual('', request.connection.written_data())
+
+    def test_keepalive_while_writing(self):
+        stream_options = StreamOptions()
+        stream_options.keepalive_interval = 100
+        request = _create_request_from_rawdata(
+            [], stream_options=stream_options)
+        ws_stream = request.ws_stream
+
+        now = time.time()
+        ws_stream._last_receive_time = now - 100
+        ws_stream._receive_start_time = now - 100
+        # The handler thread is writing. The ping is retried later.
+        ws_stream._write_lock.acquire()
+        try:
+            self.assertEqual(now + 100, ws_stream._on_keepalive_timer(now))
+        finally:
+            ws_stream._write_lock.release()
+        self.assertEqual('', request.connection.written_data())
+        self.assertEqual(0, len(ws_stream._ping_queue))
+
+        self.assertEqual(now + 30, ws_stream._on_keepalive_timer(now))
+        self.assertEqual('\x89\x0bkeepalive 0',
+                         request.connection.written_data())
+
+    def test_rtt(self):
+        request = _create_request(
+            ('\x8a\x85', 'Hello'), ('\x8a\x85', 'World'),
+            ('\x81\x85', 'World'))
+        ws_stream = request.ws_stream
+        now = time.time()
+        ws_stream._ping_queue.extend([('Hello', now - 1), ('World', now - 3)])
+        msgutil.receive_message(request)
+        # The first sample is taken as is, and later samples are smoothed:
+        # 1 + (3 - 1) / 8
+        self.assertTrue(1.25 <= request.ws_rtt < 1.5)
+
     def test_ping_cannot_be_fragmented(self):
         request = _create_request(('\x09\x85', 'Hello'))
         self.assertRaises(msgutil.InvalidFrameException,
@@ -770,6 +1214,100 @@ class PerMessageDeflateTest(unittest.TestCase):
         expected += compressed_hello
         self.assertEqual(expected, request.connection.written_data())
 
+    def test_send_message_buffers(self):
+        extension = common.ExtensionParameter(
+                common.PERMESSAGE_DEFLATE_EXTENSION)
+        request = _create_request_from_rawdata(
+                '', permessage_deflate_request=extension)
+        msgutil.send_message(request, ['\xe6\x97\xa5', u'a'])
+
+        compress = zlib.compressobj(
+                zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -zlib.MAX_WBITS)
+        compressed = compress.compress('\xe6\x97\xa5a')
+        compressed += compress.flush(zlib.Z_SYNC_FLUSH)
+        compressed = compressed[:-4]
+        expected = '\xc1%c' % len(compressed)
+        expected += compressed
+        self.assertEqual(expected, request.connection.written_data())
+
+    def test_send_messages(self):
+        extension = common.ExtensionParameter(
+                common.PERMESSAGE_DEFLATE_EXTENSION)
+        request = _create_request_from_rawdata(
+                '', permessage_deflate_request=extension)
+        msgutil.send_messages(request, ['Hello', 'World'])
+        self.assertEqual(1, len(request.connection._write_data))
+
+        # The result must be the same as sending them one by one.
+        expected_request = _create_request_from_rawdata(
+                '', permessage_deflate_request=extension)
+        msgutil.send_message(expected_request, 'Hello')
+        msgutil.send_message(expected_request, 'World')
+        self.assertEqual(expected_request.connection.written_data(),
+                         request.connection.written_data())
+
+    def test_send_message_after_rejected_messages(self):
+        extension = common.ExtensionParameter(
+                common.PERMESSAGE_DEFLATE_EXTENSION)
+        request = _create_request_from_rawdata(
+                '', permessage_deflate_request=extension)
+        # The second message is rejected before the first one is compressed.
+        self.assertRaises(msgutil.BadOperationException,
+                          msgutil.send_messages,
+                          request, ['Hello', u'\u65e5'], True)
+        self.assertEqual('', request.connection.written_data())
+        # Compressed with a reference to the first message if it was in the
+        # context.
+        msgutil.send_message(request, 'Hello', binary=True)
+
+        # The compression context must be the same as that of the peer,
+        # which has received nothing before.
+        expected_request = _create_request_from_rawdata(
+                '', permessage_deflate_request=extension)
+        msgutil.send_message(expected_request, 'Hello', binary=True)
+        self.assertEqual(expected_request.connection.written_data(),
+                         request.connection.written_data())
+
+    def test_send_prepared(self):
+        extension = common.ExtensionParameter(
+                common.PERMESSAGE_DEFLATE_EXTENSION)
+        extension.add_parameter('server_no_context_takeover', None)
+        prepared = PreparedMessage('Hello')
+        requests = []
+        for i in xrange(3):
+            request = _create_request_from_rawdata(
+                    '', permessage_deflate_request=extension)
+            msgutil.send_prepared(request, prepared)
+            msgutil.send_prepared(request, prepared)
+            requests.append(request)
+        self.assertEqual(1, len(prepared._frames))
+
+        expected_request = _create_request_from_rawdata(
+                '', permessage_deflate_request=extension)
+        msgutil.send_message(expected_request, 'Hello')
+        msgutil.send_message(expected_request, 'Hello')
+        for request in requests:
+            self.assertEqual(expected_request.connection.written_data(),
+                             request.connection.written_data())
+
+    def test_send_prepared_context_takeover(self):
+        # Compressed data depends on the context. Frames are not shared.
+        extension = common.ExtensionParameter(
+                common.PERMESSAGE_DEFLATE_EXTENSION)
+        prepared = PreparedMessage('Hello')
+        request = _create_request_from_rawdata(
+                '', permessage_deflate_request=extension)
+        msgutil.send_prepared(request, prepared)
+        msgutil.send_prepared(request, prepared)
+        self.assertEqual({}, prepared._frames)
+
+        expected_request = _create_request_from_rawdata(
+                '', permessage_deflate_request=extension)
+        msgutil.send_message(expected_request, 'Hello')
+        msgutil.send_message(expected_request, 'Hello')
+        self.assertEqual(expected_request.connection.written_data(),
+                         request.connection.written_data())
+
     def test_send_empty_message(self):
         """Test that an empty message is compressed correctly."""
 
@@ -1115,6 +1653,68 @@ class PerMessageDeflateTest(unittest.TestCase):
 
         self.assertEqual(None, msgutil.receive_message(request))
 
+    def test_receive_message_stream(self):
+        compress = zlib.compressobj(
+                zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -zlib.MAX_WBITS)
+
+        original = ''.join(chr(random.randint(0, 255)) for i in xrange(2000))
+        compressed = compress.compress(original)
+        compressed += compress.flush(zlib.Z_SYNC_FLUSH)
+        compressed = compressed[:-4]
+
+        data = ''
+        chunk_size = 100
+        for position in xrange(0, len(compressed), chunk_size):
+            chunk = compressed[position:position + chunk_size]
+            if position == 0:
+                first_byte = 0x42
+            else:
+                first_byte = 0x00
+            if position + chunk_size >= len(compressed):
+                first_byte |= 0x80
+            data += '%c\xfe%s' % (first_byte, struct.pack('!H', len(chunk)))
+            data += _mask_hybi(chunk)
+
+        # Close frame
+        data += '\x88\x8a' + _mask_hybi(struct.pack('!H', 1000) + 'Good bye')
+
+        extension = common.ExtensionParameter(
+                common.PERMESSAGE_DEFLATE_EXTENSION)
+        request = _create_request_from_rawdata(
+                data, permessage_deflate_request=extension)
+        chunks = list(msgutil.receive_message_stream(request))
+        self.assertTrue(len(chunks) > 1)
+        self.assertEqual(original, ''.join(chunks))
+
+        self.assertEqual(None, msgutil.receive_message_stream(request))
+
+    def test_receive_message_decompressed_too_big(self):
+        compress = zlib.compressobj(
+                zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -zlib.MAX_WBITS)
+
+        compressed = compress.compress('a' * 100)
+        compressed += compress.flush(zlib.Z_SYNC_FLUSH)
+        compressed = compressed[:-4]
+        data = '\xc1%c' % (len(compressed) | 0x80)
+        data += _mask_hybi(compressed)
+
+        compressed = compress.compress('a' * 1000000)
+        compressed += compress.flush(zlib.Z_SYNC_FLUSH)
+        compressed = compressed[:-4]
+        data += '\xc1\xfe' + struct.pack('!H', len(compressed))
+        data += _mask_hybi(compressed)
+
+        stream_options = StreamOptions()
+        stream_options.incoming_max_decompressed_size = 100
+        extension = common.ExtensionParameter(
+                common.PERMESSAGE_DEFLATE_EXTENSION)
+        request = _create_request_from_rawdata(
+                data, permessage_deflate_request=extension,
+                stream_options=stream_options)
+        self.assertEqual('a' * 100, msgutil.receive_message(request))
+        self.assertRaises(MessageTooBigException,
+                          msgutil.receive_message, request)
+
     def test_receive_message_mixed_btype(self):
         """Test that a message compressed using lots of DEFLATE blocks with
         various flush mode is correctly received.
@@ -1205,6 +1805,17 @@ class MessageTestHixie75(unittest.TestCase):
         self.assertEqual('\x00\xe6\x97\xa5\xff',
                          request.connection.written_data())
 
+    def test_send_prepared(self):
+        request = _create_request_hixie75()
+        msgutil.send_prepared(request, PreparedMessage('Hello'))
+        self.assertEqual('\x00Hello\xff', request.connection.written_data())
+
+    def test_send_messages(self):
+        request = _create_request_hixie75()
+        msgutil.send_messages(request, ['Hello', u'\u65e5'])
+        self.assertEqual('\x00Hello\xff\x00\xe6\x97\xa5\xff',
+                         request.connection.written_data())
+
     def test_receive_message(self):
         request = _create_request_hixie75('\x00Hello\xff\x00World!\xff')
         self.assertEqual('Hello', msgutil.receive_message(request))
@@ -0,0 +1,370 @@
+#!/usr/bin/env python
+#
+# Copyright 2014, Google Inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+#
+#     * Redistributions of source code must retain the above copyright
+# notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above
+# copyright notice, this list of conditions and the following disclaimer
+# in the documentation and/or other materials provided with the
+# distribution.
+#     * Neither the name of Google Inc. nor the names of its
+# contributors may be used to endorse or promote products derived from
+# this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""Tests for standalone module."""
+
+
+import mimetools
+import socket
+import StringIO
+import threading
+import unittest
+
+import set_sys_path  # Update sys.path to locate mod_pywebsocket module.
+
+from mod_pywebsocket import memorizingfile
+from mod_pywebsocket import standalone
+from mod_pywebsocket import util
+
+
+_HANDSHAKE = ('GET /echo HTTP/1.1\r\n'
+              'Host: localhost\r\n'
+              'Upgrade: websocket\r\n'
+              '\r\n')
+
+
+def _split_header_lines(header_data):
+    """Splits header data ending with an empty line into lines as
+    mimetools.Message reads them, excluding the empty line.
+    """
+
+    return [line + '\n' for line in header_data.split('\n')[:-2]]
+
+
+def _create_socket_pair():
+    # Wrap the sockets so that makefile returns socket._fileobject as it
+    # does for accepted sockets.
+    server_socket, client_socket = [
+        socket.socket(_sock=s) for s in socket.socketpair()]
+    # Fail instead of blocking forever when bytes are lost.
+    server_socket.settimeout(5)
+    return server_socket, client_socket
+
+
+class _MockDispatcher(object):
+    """Has handlers only for /echo."""
+
+    def get_handler_suite(self, resource):
+        if resource == '/echo':
+            return object()
+        return None
+
+
+class _MockServer(object):
+    def __init__(self, options):
+        self.websocket_server_options = options
+
+
+class _RequestHandlerForTesting(standalone.WebSocketRequestHandler):
+    """WebSocketRequestHandler which doesn't handle the request on
+    construction, and records WebSocket requests instead of processing them.
+    """
+
+    def __init__(self, connection):
+        options, unused_args = standalone._parse_args_and_config([])
+        options.dispatcher = _MockDispatcher()
+
+        self._logger = util.get_class_logger(self)
+        self._options = options
+        self.request = connection
+        self.client_address = ('127.0.0.1', 0)
+        self.server = _MockServer(options)
+        self.setup()
+
+        self.websocket_request = None
+
+    def _process_websocket_request(self, request, do_handshake):
+        self.websocket_request = request
+        return False
+
+
+class _MockRequestHandler(object):
+    """Has the attributes of WebSocketRequestHandler which
+    _StandaloneConnection uses.
+    """
+
+    def __init__(self, connection, rfile):
+        self.connection = connection
+        self.rfile = rfile
+
+
+class StandaloneConnectionTest(unittest.TestCase):
+    """A unittest for _StandaloneConnection class."""
+
+    def setUp(self):
+        self._server_socket, self._client_socket = _create_socket_pair()
+
+    def tearDown(self):
+        self._server_socket.close()
+        self._client_socket.close()
+
+    def test_pipelined_frame(self):
+        frame = '\x81\x84' + '\x00' * 4 + 'test'
+        self._client_socket.sendall(_HANDSHAKE + frame)
+
+        # A buffered file object reads the frame together with the lines of
+        # the handshake.
+        rfile = memorizingfile.MemorizingFile(
+            self._server_socket.makefile('rb', 8192))
+        while rfile.readline() != '\r\n':
+            pass
+
+        connection = standalone._StandaloneConnection(
+            _MockRequestHandler(self._server_socket, rfile))
+        connection.use_socket_reader()
+        self.assertEqual(frame[:2], connection.read(2))
+        self.assertEqual(frame[2:], connection.read_available(1024))
+
+        self._client_socket.sendall('more')
+        self.assertEqual('more', connection.read(4))
+
+
+class ParseHandshakeHeadersTest(unittest.TestCase):
+    """A unittest for _parse_handshake_headers function."""
+
+    def _assert_same_as_mimetools(self, header_data):
+        headers = standalone._parse_handshake_headers(
+            _split_header_lines(header_data))
+        expected = mimetools.Message(StringIO.StringIO(header_data), 0)
+        self.assertTrue(isinstance(headers, mimetools.Message))
+        self.assertEqual(expected.dict, headers.dict)
+        self.assertEqual(expected.headers, headers.headers)
+        self.assertEqual(expected.gettype(), headers.gettype())
+        return headers
+
+    def test_parse(self):
+        headers = self._assert_same_as_mimetools(
+            'Host: localhost\r\n'
+            'Upgrade:websocket\r\n'
+            'Sec-WebSocket-Version:  13 \r\n'
+            '\r\n')
+        self.assertEqual('websocket', headers['Upgrade'])
+        self.assertEqual('13', headers.getheader('Sec-WebSocket-Version'))
+
+    def test_case_insensitive(self):
+        headers = self._assert_same_as_mimetools(
+            'hOST: localhost\r\n'
+            'UPGRADE: websocket\r\n'
+            '\r\n')
+        self.assertEqual('localhost', headers['Host'])
+        self.assertEqual('websocket', headers.get('upgrade'))
+        self.assertTrue('Upgrade' in headers)
+        self.assertTrue(headers.has_key('HOST'))
+        self.assertEqual(['localhost'], headers.getheaders('host'))
+        self.assertEqual(None, headers.get('Origin'))
+
+    def test_repeated_headers(self):
+        headers = self._assert_same_as_mimetools(
+            'Sec-WebSocket-Protocol: chat\r\n'
+            'sec-websocket-protocol: superchat\r\n'
+            '\r\n')
+        # As with mimetools.Message, the last value wins.
+        self.assertEqual('superchat', headers['Sec-WebSocket-Protocol'])
+        self.assertEqual(['chat', 'superchat'],
+                         headers.getheaders('Sec-WebSocket-Protocol'))
+        self.assertEqual(['Sec-WebSocket-Protocol: chat\r\n',
+                          'sec-websocket-protocol: superchat\r\n'],
+                         headers.getallmatchingheaders(
+                             'Sec-WebSocket-Protocol'))
+
+    def test_folded_headers(self):
+        headers = self._assert_same_as_mimetools(
+            'Sec-WebSocket-Extensions: permessage-deflate;\r\n'
+            '  client_max_window_bits,\r\n'
+            '\tdeflate-frame\r\n'
+            'Host: localhost\r\n'
+            '\r\n')
+        self.assertEqual(
+            'permessage-deflate;\n client_max_window_bits,\n deflate-frame',
+            headers['Sec-WebSocket-Extensions'])
+        self.assertEqual(
+            ' permessage-deflate;\r\n  client_max_window_bits,\r\n'
+            '\tdeflate-frame\r\n',
+            headers.getrawheader('Sec-WebSocket-Extensions'))
+        self.assertEqual('localhost', headers['Host'])
+
+    def test_no_headers(self):
+        headers = self._assert_same_as_mimetools('\r\n')
+        self.assertEqual([], headers.keys())
+
+    def test_lines_left_to_mimetools(self):
+        for header_data in ('From nobody\r\nHost: localhost\r\n\r\n',
+                            ' Host: localhost\r\n\r\n',
+                            'Host: localhost\r\nUpgrade\r\n\r\n',
+                            ': websocket\r\n\r\n',
+                            'Host: localhost\n\nUpgrade: websocket\r\n\r\n'):
+            self.assertEqual(
+                None,
+                standalone._parse_handshake_headers(
+                    _split_header_lines(header_data)),
+                header_data)
+
+
+class PeekingSocketFileTest(unittest.TestCase):
+    """A unittest for _PeekingSocketFile class."""
+
+    def setUp(self):
+        self._server_socket, self._client_socket = _create_socket_pair()
+        self._file = standalone._PeekingSocketFile(self._server_socket)
+
+    def tearDown(self):
+        self._server_socket.close()
+        self._client_socket.close()
+
+    def test_readline_leaves_following_bytes(self):
+        self._client_socket.sendall('Host: localhost\r\n\r\nbody')
+
+        self.assertEqual('Host: localhost\r\n', self._file.readline())
+        self.assertEqual('\r\n', self._file.readline())
+        # The peeked bytes beyond the line are still on the socket.
+        self.assertEqual('body', self._server_socket.recv(1024))
+
+    def test_readline_partial_line(self):
+        self._client_socket.sendall('Host: loc')
+        timer = threading.Timer(
+            0.1, self._client_socket.sendall, ['alhost\r\nbody'])
+        timer.start()
+        try:
+            self.assertEqual('Host: localhost\r\n', self._file.readline())
+        finally:
+            timer.join()
+        self.assertEqual('body', self._server_socket.recv(1024))
+
+    def test_readline_line_longer_than_peek_size(self):
+        line = 'X-Long: ' + 'a' * (standalone._PEEK_SIZE * 2) + '\r\n'
+        self._client_socket.sendall(line + 'body')
+
+        self.assertEqual(line, self._file.readline())
+        self.assertEqual('body', self._server_socket.recv(1024))
+
+    def test_readline_with_size(self):
+        self._client_socket.sendall('Host: localhost\r\nbody')
+
+        self.assertEqual('Host', self._file.readline(4))
+        self.assertEqual(': localhost\r\n', self._file.readline(1024))
+        self.assertEqual('', self._file.readline(0))
+        self.assertEqual('body', self._server_socket.recv(1024))
+
+    def test_readline_at_end(self):
+        self._client_socket.sendall('Host: local')
+        self._client_socket.shutdown(socket.SHUT_WR)
+
+        self.assertEqual('Host: local', self._file.readline())
+        self.assertEqual('', self._file.readline())
+
+
+class WebSocketRequestHandlerTest(unittest.TestCase):
+    """A unittest for WebSocketRequestHandler.parse_request."""
+
+    def setUp(self):
+        self._server_socket, self._client_socket = _create_socket_pair()
+        self._handler = _RequestHandlerForTesting(self._server_socket)
+
+    def tearDown(self):
+        self._server_socket.close()
+        self._client_socket.close()
+
+    def _parse_request(self, request):
+        self._client_socket.sendall(request)
+        self._handler.raw_requestline = self._handler.rfile.readline()
+        return self._handler.parse_request()
+
+    def test_websocket_request(self):
+        self.assertFalse(self._parse_request(
+            'GET /echo HTTP/1.1\r\n'
+            'Host: localhost\r\n'
+            'Upgrade: websocket\r\n'
+            'Connection: Upgrade\r\n'
+            'Sec-WebSocket-Key: dGhlIHNhbXBsZSBub25jZQ==\r\n'
+            'Sec-WebSocket-Protocol: chat\r\n'
+            'Sec-WebSocket-Protocol: superchat\r\n'
+            'Sec-WebSocket-Version: 13\r\n'
+            '\r\n'
+            '\x81\x80'))
+
+        request = self._handler.websocket_request
+        self.assertEqual('/echo', request.uri)
+        self.assertEqual('GET', request.method)
+        headers = request.headers_in
+        # Parsed by the fast path.
+        self.assertTrue(isinstance(headers, standalone._HandshakeHeaders))
+        self.assertEqual('localhost', headers['host'])
+        self.assertEqual(['chat', 'superchat'],
+                         headers.getheaders('Sec-WebSocket-Protocol'))
+        self.assertEqual(
+            ['Connection: Upgrade\r\n'],
+            headers.getallmatchingheaders('Connection'))
+        # The frame following the request is left on the socket.
+        self.assertEqual('\x81\x80', self._server_socket.recv(1024))
+
+    def test_non_websocket_request(self):
+        # The fast path reads the header lines, and then replays them to
+        # CGIHTTPRequestHandler.parse_request.
+        self.assertTrue(self._parse_request(
+            'GET /index.html HTTP/1.1\r\n'
+            'Host: localhost\r\n'
+            'X-Folded: a\r\n'
+            ' b\r\n'
+            'Content-Length: 4\r\n'
+            '\r\n'
+            'body'))
+
+        self.assertEqual(None, self._handler.websocket_request)
+        self.assertEqual('GET', self._handler.command)
+        self.assertEqual('/index.html', self._handler.path)
+        self.assertEqual('HTTP/1.1', self._handler.request_version)
+        self.assertEqual(
+            'GET /index.html HTTP/1.1', self._handler.requestline)
+        headers = self._handler.headers
+        self.assertTrue(isinstance(headers, mimetools.Message))
+        self.assertEqual('a\n b', headers['x-folded'])
+        self.assertEqual('4', headers['Content-Length'])
+        # The body is left for CGI scripts.
+        self.assertEqual('body', self._handler.rfile.read(4))
+
+    def test_websocket_request_to_unknown_resource(self):
+        self.assertTrue(self._parse_request(
+            'GET /unknown HTTP/1.1\r\n'
+            'Host: localhost\r\n'
+            'Upgrade: websocket\r\n'
+            'Sec-WebSocket-Version: 13\r\n'
+            '\r\n'))
+
+        self.assertEqual(None, self._handler.websocket_request)
+        self.assertEqual('/unknown', self._handler.path)
+        self.assertEqual('websocket', self._handler.headers['Upgrade'])
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+
+# vi:sts=4 sw=4 et
@@ -33,12 +33,20 @@
 """Tests for stream module."""
 
 
+import struct
+import threading
+import time
 import unittest
 
 import set_sys_path  # Update sys.path to locate mod_pywebsocket module.
 
 from mod_pywebsocket import common
 from mod_pywebsocket import stream
+from mod_pywebsocket import util
+from mod_pywebsocket._stream_hybi import _KeepaliveScheduler
+from mod_pywebsocket._stream_hybi import _compile_frame_filters
+from mod_pywebsocket._stream_hybi import _compile_message_filters
+from test import mock
 
 
 class StreamTest(unittest.TestCase):
@@ -69,6 +77,358 @@ class StreamTest(unittest.TestCase):
                           stream.create_header,
                           common.OPCODE_TEXT, 1 << 63, 0, 0, 0, 0, 0)
 
+    def test_parse_frame_as_frame_object(self):
+        data = '\x82\x05Hello'
+        position = [0]
+
+        def _receive_bytes(length):
+            received = data[position[0]:position[0] + length]
+            position[0] += length
+            return received
+
+        frame = stream.parse_frame_as_frame_object(
+            _receive_bytes, unmask_receive=False)
+        self.assertEqual(1, frame.fin)
+        self.assertEqual(0, frame.rsv1)
+        self.assertEqual(common.OPCODE_BINARY, frame.opcode)
+        self.assertEqual('Hello', frame.payload)
+        # Frames have no instance dictionary.
+        self.assertRaises(AttributeError, setattr, frame, 'unknown', 1)
+
+        position[0] = 0
+        self.assertEqual(
+            (common.OPCODE_BINARY, 'Hello', 1, 0, 0, 0),
+            stream.parse_frame(_receive_bytes, unmask_receive=False))
+
+    def test_compile_filters(self):
+        class AppendingFilter(object):
+            def __init__(self, suffix):
+                self._suffix = suffix
+
+            def filter(self, message, end=True, binary=False):
+                return '%s%s(%s,%s)' % (message, self._suffix, end, binary)
+
+        class FrameFilter(object):
+            def __init__(self, suffix):
+                self._suffix = suffix
+
+            def filter(self, frame):
+                frame.payload += self._suffix
+
+        # No filters results in no function so that callers can skip
+        # filtering.
+        self.assertEqual(None, _compile_message_filters([]))
+        self.assertEqual(None, _compile_frame_filters([]))
+
+        filter_message = _compile_message_filters(
+            [AppendingFilter('a'), AppendingFilter('b')])
+        self.assertEqual('xa(False,True)b(False,True)',
+                         filter_message('x', False, True))
+        filter_message = _compile_message_filters([AppendingFilter('a')])
+        self.assertEqual('xa(True,False)', filter_message('x'))
+
+        filter_frame = _compile_frame_filters(
+            [FrameFilter('a'), FrameFilter('b')])
+        frame = stream.Frame(payload='x')
+        filter_frame(frame)
+        self.assertEqual('xab', frame.payload)
+
+    def test_create_header_table(self):
+        # Headers built using the table and the struct encoders must be the
+        # same as ones built byte by byte.
+        for opcode in range(16):
+            for bits in range(32):
+                fin, rsv1, rsv2, rsv3, mask = [
+                    (bits >> shift) & 1 for shift in range(5)]
+                first_byte = chr((fin << 7) | (rsv1 << 6) | (rsv2 << 5) |
+                                 (rsv3 << 4) | opcode)
+                for length in (0, 1, 125, 126, 0xffff, 0x10000):
+                    if length <= 125:
+                        expected = first_byte + chr((mask << 7) | length)
+                    elif length <= 0xffff:
+                        expected = (first_byte + chr((mask << 7) | 126) +
+                                    struct.pack('!H', length))
+                    else:
+                        expected = (first_byte + chr((mask << 7) | 127) +
+                                    struct.pack('!Q', length))
+                    self.assertEqual(
+                        expected,
+                        stream.create_header(
+                            opcode, length, fin, rsv1, rsv2, rsv3, mask))
+                    self.assertEqual(
+                        expected[1:],
+                        stream.create_length_header(length, mask == 1))
+
+        # Negative length must not be looked up in the table.
+        self.assertRaises(ValueError,
+                          stream.create_header,
+                          common.OPCODE_TEXT, -1, 1, 0, 0, 0, 0)
+
+    def test_read_ahead(self):
+        # Ten unmasked 5 octet text frames are served by one read.
+        data = '\x81\x05Hello' * 10
+        conn = mock.MockConn(data)
+        request = mock.MockRequest(connection=conn)
+        request.ws_version = common.VERSION_HYBI_LATEST
+        options = stream.StreamOptions()
+        options.unmask_receive = False
+        ws_stream = stream.Stream(request, options)
+        for i in xrange(10):
+            self.assertEqual('Hello', ws_stream.receive_message())
+        self.assertEqual(1, conn.read_available_call_count)
+
+    def test_read_ahead_large_payload(self):
+        # A payload larger than the read-ahead chunk is filled across reads
+        # and the surplus is kept for the next frame.
+        payload = 'a' * (1 << 16)
+        data = ('\x82\x7f\x00\x00\x00\x00\x00\x01\x00\x00' + payload +
+                '\x81\x05Hello')
+        request = mock.MockRequest(connection=mock.MockConn(data))
+        request.ws_version = common.VERSION_HYBI_LATEST
+        options = stream.StreamOptions()
+        options.unmask_receive = False
+        ws_stream = stream.Stream(request, options)
+        self.assertEqual(payload, ws_stream.receive_message())
+        self.assertEqual('Hello', ws_stream.receive_message())
+        self.assertRaises(stream.ConnectionTerminatedException,
+                          ws_stream.receive_message)
+
+
+def _create_masked_frame(first_byte, payload):
+    """Creates a masked frame with a payload of 125 bytes or less."""
+
+    masking_nonce = '\x01\x02\x03\x04'
+    return (chr(first_byte) + chr(0x80 | len(payload)) + masking_nonce +
+            util.RepeatedXorMasker(masking_nonce).mask(payload))
+
+
+class FrameParserTest(unittest.TestCase):
+    """A unittest for FrameParser class."""
+
+    def test_feed_byte_by_byte(self):
+        data = (_create_masked_frame(0x81, 'Hello') +
+                stream.create_binary_frame('a' * 300, mask=True) +
+                _create_masked_frame(0x89, ''))
+        parser = stream.FrameParser()
+        self.assertEqual(2, parser.bytes_needed())
+        frames = []
+        for byte in data:
+            parser.feed(byte)
+            frame = parser.next_frame()
+            if frame is not None:
+                frames.append(frame)
+        self.assertEqual(None, parser.next_frame())
+
+        self.assertEqual(3, len(frames))
+        self.assertEqual(common.OPCODE_TEXT, frames[0].opcode)
+        self.assertEqual('Hello', frames[0].payload)
+        self.assertEqual(common.OPCODE_BINARY, frames[1].opcode)
+        self.assertEqual('a' * 300, frames[1].payload)
+        self.assertEqual(common.OPCODE_PING, frames[2].opcode)
+        self.assertEqual('', frames[2].payload)
+
+    def test_bytes_needed(self):
+        data = _create_masked_frame(0x81, 'Hello')
+        parser = stream.FrameParser()
+        parser.feed(data[:1])
+        self.assertEqual(1, parser.bytes_needed())
+        parser.feed(data[1:2])
+        # The masking key
+        self.assertEqual(4, parser.bytes_needed())
+        parser.feed(data[2:6])
+        self.assertEqual(None, parser.next_frame())
+        self.assertEqual(5, parser.bytes_needed())
+        parser.feed(data[6:] + data)
+        self.assertEqual('Hello', parser.next_frame().payload)
+        self.assertEqual('Hello', parser.next_frame().payload)
+        self.assertEqual(2, parser.bytes_needed())
+
+    def test_invalid_frames(self):
+        parser = stream.FrameParser()
+        parser.feed('\x81\x05Hello')
+        self.assertRaises(stream.InvalidFrameException, parser.next_frame)
+
+        # The limit is checked as soon as the header arrives.
+        parser = stream.FrameParser(max_payload_size=5)
+        parser.feed('\x82\xff' + struct.pack('!Q', 1 << 40) + '\x00' * 4)
+        self.assertRaises(stream.MessageTooBigException, parser.next_frame)
+
+    def test_same_as_parse_frame(self):
+        data = (_create_masked_frame(0x01, 'Hello') +
+                stream.create_binary_frame('a' * 300, mask=True) +
+                stream.create_binary_frame('b' * 70000, mask=True) +
+                _create_masked_frame(0x80, 'World'))
+        parser = stream.FrameParser()
+        parser.feed(data)
+
+        read_sizes = []
+        position = [0]
+
+        def _receive_bytes(length):
+            read_sizes.append(length)
+            received = data[position[0]:position[0] + length]
+            position[0] += length
+            return received
+
+        for unused_i in xrange(4):
+            expected = stream.parse_frame_as_frame_object(_receive_bytes)
+            actual = parser.next_frame()
+            self.assertEqual(
+                (expected.fin, expected.rsv1, expected.rsv2, expected.rsv3,
+                 expected.opcode, expected.payload),
+                (actual.fin, actual.rsv1, actual.rsv2, actual.rsv3,
+                 actual.opcode, actual.payload))
+        # parse_frame doesn't read beyond the frames.
+        self.assertEqual(len(data), sum(read_sizes))
+        self.assertEqual(None, parser.next_frame())
+
+
+class ProtocolCoreTest(unittest.TestCase):
+    """A unittest for ProtocolCore class."""
+
+    def test_receive(self):
+        data = (_create_masked_frame(0x01, 'Hel') +
+                _create_masked_frame(0x89, 'ping') +
+                _create_masked_frame(0x80, 'lo') +
+                _create_masked_frame(0x82, '\xff') +
+                _create_masked_frame(0x88, '\x03\xe9bye') +
+                _create_masked_frame(0x81, 'after close'))
+        core = stream.ProtocolCore()
+        events = []
+        for i in xrange(0, len(data), 3):
+            events.extend(core.feed(data[i:i + 3]))
+
+        self.assertEqual(
+            [stream.EVENT_PING, stream.EVENT_MESSAGE, stream.EVENT_MESSAGE,
+             stream.EVENT_CLOSE],
+            [event.type for event in events])
+        self.assertEqual('ping', events[0].data)
+        self.assertEqual(u'Hello', events[1].data)
+        self.assertFalse(events[1].binary)
+        self.assertEqual('\xff', events[2].data)
+        self.assertTrue(events[2].binary)
+        self.assertEqual(1001, events[3].code)
+        self.assertEqual(u'bye', events[3].reason)
+        self.assertTrue(core.close_received)
+
+        # The ping is answered and the close frame is echoed.
+        self.assertEqual('\x8a\x04ping\x88\x02\x03\xe9',
+                         core.data_to_send())
+        self.assertEqual('', core.data_to_send())
+        self.assertTrue(core.close_sent)
+        self.assertRaises(stream.BadOperationException,
+                          core.send_message, 'Hello')
+
+    def test_receive_close_without_echo(self):
+        core = stream.ProtocolCore(echo_close=False)
+        events = core.feed(_create_masked_frame(0x88, '\x03\xe9'))
+        self.assertEqual(stream.EVENT_CLOSE, events[0].type)
+        self.assertTrue(core.close_received)
+        self.assertFalse(core.close_sent)
+        self.assertEqual('', core.data_to_send())
+
+        core.send_close(common.STATUS_GOING_AWAY, 'bye')
+        self.assertEqual('\x88\x05\x03\xe9bye', core.data_to_send())
+
+    def test_receive_fragments(self):
+        data = (_create_masked_frame(0x01, '\xe6\x97') +
+                _create_masked_frame(0x80, '\xa5'))
+        core = stream.ProtocolCore(receive_fragments=True)
+        events = core.feed(data)
+        self.assertEqual([stream.EVENT_FRAGMENT, stream.EVENT_FRAGMENT],
+                         [event.type for event in events])
+        # A UTF-8 sequence split across fragments is decoded when complete.
+        self.assertEqual(u'', events[0].data)
+        self.assertFalse(events[0].end)
+        self.assertEqual(u'\u65e5', events[1].data)
+        self.assertTrue(events[1].end)
+
+        core = stream.ProtocolCore(receive_fragments=True)
+        self.assertRaises(stream.InvalidFrameException,
+                          core.feed, _create_masked_frame(0x80, 'a'))
+
+    def test_send(self):
+        core = stream.ProtocolCore()
+        core.send_message('Hello')
+        core.send_message('World', binary=True)
+        core.send_ping('p')
+        core.send_close(common.STATUS_GOING_AWAY, 'bye')
+        self.assertEqual('\x81\x05Hello\x82\x05World\x89\x01p'
+                         '\x88\x05\x03\xe9bye',
+                         core.data_to_send())
+        self.assertRaises(stream.BadOperationException, core.send_close)
+
+    def test_send_messages(self):
+        core = stream.ProtocolCore()
+        core.send_messages(['Hello', u'\u65e5'])
+        self.assertEqual('\x81\x05Hello\x81\x03\xe6\x97\xa5',
+                         core.data_to_send())
+
+        # No message of a rejected batch is queued.
+        self.assertRaises(stream.BadOperationException,
+                          core.send_messages, ['Hello', u'\u65e5'], True)
+        self.assertEqual('', core.data_to_send())
+
+    def test_client_and_server(self):
+        client_options = stream.StreamOptions()
+        client_options.mask_send = True
+        client_options.unmask_receive = False
+        client = stream.ProtocolCore(client_options)
+        server = stream.ProtocolCore()
+
+        client.send_message(u'\u65e5')
+        client.send_message('a' * 70000, binary=True)
+        events = server.feed(client.data_to_send())
+        self.assertEqual(u'\u65e5', events[0].data)
+        self.assertEqual('a' * 70000, events[1].data)
+
+        server.send_message('Hello')
+        server.send_close()
+        events = client.feed(server.data_to_send())
+        self.assertEqual(u'Hello', events[0].data)
+        self.assertEqual(common.STATUS_NORMAL_CLOSURE, events[1].code)
+        events = server.feed(client.data_to_send())
+        self.assertEqual(stream.EVENT_CLOSE, events[0].type)
+        self.assertTrue(server.close_received)
+
+
+class _MockKeepaliveStream(object):
+    def __init__(self, deadlines):
+        self.fired = []
+        self._deadlines = deadlines
+        self.done = threading.Event()
+
+    def _on_keepalive_timer(self, now):
+        self.fired.append(now)
+        if not self._deadlines:
+            self.done.set()
+            return None
+        return self._deadlines.pop(0)
+
+
+class KeepaliveSchedulerTest(unittest.TestCase):
+    """A unittest for _KeepaliveScheduler class."""
+
+    def test_schedule(self):
+        # A small wheel makes timers stay in their slot for several
+        # revolutions.
+        scheduler = _KeepaliveScheduler(tick=0.01, wheel_size=4)
+        scheduler.start()
+
+        now = time.time()
+        deadlines = [now + 0.02, now + 0.15, now + 0.1]
+        streams = []
+        for deadline in deadlines:
+            stream_ = _MockKeepaliveStream([deadline + 0.05])
+            scheduler.schedule(deadline, stream_)
+            streams.append(stream_)
+
+        for stream_, deadline in zip(streams, deadlines):
+            self.assertTrue(stream_.done.wait(5))
+            self.assertEqual(2, len(stream_.fired))
+            self.assertTrue(stream_.fired[0] >= deadline)
+            self.assertTrue(stream_.fired[1] >= deadline + 0.05)
+
 
 if __name__ == '__main__':
     unittest.main()
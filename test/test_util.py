@@ -81,6 +81,47 @@ class UtilTest(unittest.TestCase):
                          util.hexify('azAZ09 \t\r\n\x00\xff'))
 
 
+class LRUCacheTest(unittest.TestCase):
+    """A unittest for LRUCache class."""
+
+    def test_get_put(self):
+        cache = util.LRUCache(2)
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(0, cache.get('a', 0))
+
+        cache.put('a', 1)
+        cache.put('b', 2)
+        self.assertEqual(1, cache.get('a'))
+        self.assertEqual(2, cache.get('b'))
+        self.assertEqual(2, len(cache))
+
+        cache.put('a', 3)
+        self.assertEqual(3, cache.get('a'))
+        self.assertEqual(2, len(cache))
+
+    def test_evict_least_recently_used(self):
+        cache = util.LRUCache(2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        # Make 'b' the least recently used entry.
+        cache.get('a')
+        cache.put('c', 3)
+
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(1, cache.get('a'))
+        self.assertEqual(3, cache.get('c'))
+
+    def test_clear(self):
+        cache = util.LRUCache(2)
+        cache.put('a', 1)
+        cache.clear()
+        self.assertEqual(0, len(cache))
+        self.assertIsNone(cache.get('a'))
+
+    def test_invalid_max_size(self):
+        self.assertRaises(ValueError, util.LRUCache, 0)
+
+
 class RepeatedXorMaskerTest(unittest.TestCase):
     """A unittest for RepeatedXorMasker class."""
 
@@ -130,6 +171,25 @@ class RepeatedXorMaskerTest(unittest.TestCase):
                 "\x05s\x1f%\x04s\x0f,\x152K9\x132\x05>\x076\x19c",
                 result)
 
+    def test_mask_backends(self):
+        backends = [util.RepeatedXorMasker._mask_using_array,
+                    util.RepeatedXorMasker._mask_using_long]
+        if 'numpy' in util.__dict__:
+            backends.append(util.RepeatedXorMasker._mask_using_numpy)
+
+        original = ''.join([chr(i % 256) for i in xrange(3000)])
+        for backend in backends:
+            masker = util.RepeatedXorMasker('mASk')
+            self.assertEqual('', backend(masker, ''))
+            # Split the input at positions not aligned to the key size to
+            # check that each backend resumes from the right position.
+            result = ''.join([backend(masker, original[:1]),
+                              backend(masker, original[1:1002]),
+                              backend(masker, original[1002:])])
+            expected = ''.join(
+                [chr((i % 256) ^ ord('mASk'[i % 4])) for i in xrange(3000)])
+            self.assertEqual(expected, result)
+
 
 def get_random_section(source, min_num_chunks):
     chunks = []